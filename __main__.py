@@ -27,6 +27,20 @@ def main():
     parser.add_argument("--threads", default=cpu_count(), help="Number of threads")
     parser.add_argument("--size", default=256, help="Size of one length of the output image")
     parser.add_argument("--dense", action="store_true", help="Use alternative find_misses, adapted for dense datasets")
+    parser.add_argument("--proximity", action="store_true",
+                        help="Take misses from a distance ring around the hits as well as from further away")
+    parser.add_argument("--ring", nargs=2, type=float, default=[1000, 5000], metavar=("MIN", "MAX"),
+                        help="Minimum and maximum distance in metres from the edge of a hit for proximity misses")
+    parser.add_argument("--nearratio", type=float, default=0.5,
+                        help="Fraction of proximity misses in each tile that are inside the ring")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Subset and convert each tile as soon as it is downloaded instead of waiting for all of them")
+    parser.add_argument("--diskbudget", type=float,
+                        help="Maximum size in GB of the downloaded tiles. Used tiles are deleted to stay within it. "
+                             "Implies --streaming")
+    parser.add_argument("--gptbatch", type=int, default=16,
+                        help="Number of Sentinel 1 images subsetted from a tile by each SNAP gpt process")
+    parser.add_argument("--report", help="Path for the JSON report of stage timings, throughput and resource use")
     parser.add_argument("--verbose", action="store_true", help="Enable verbose mode")
     parser.add_argument("--clean", action="store_true", help="Do not look for past dictionaries or skip any steps")
     parser.add_argument("--nomiss", action="store_true", help="Do not generate misses")
@@ -54,6 +68,11 @@ def main():
     else:
         hitdict = os.path.join("..", "%s.dictionary" % args.name)
 
+    if args.report:
+        report = args.report
+    else:
+        report = os.path.join("..", "%s_report.json" % args.name)
+
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
     else:
@@ -68,7 +87,10 @@ def main():
     print("Getting images from Sentinel %s" % args.sentinel)
 
     pipeline.run_pipeline(args.input, args.sedas_username, args.sedas_password, args.name, tilepath, tifpath, outpath, hitdict,
-                          int(args.threads), int(args.size), args.confidence, args.dense, args.clean,args.nomiss,args.sentinel)
+                          int(args.threads), int(args.size), args.confidence, args.dense, args.clean,args.nomiss,args.sentinel,
+                          args.proximity, tuple(args.ring), args.nearratio, args.streaming,
+                          int(args.diskbudget * 1024 ** 3) if args.diskbudget else None, report,
+                          args.gptbatch)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,362 @@
+import argparse
+import copy
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from math import cos, radians
+
+import numpy as np
+import pyproj
+from osgeo import gdal
+
+from bin import metrics
+from bin.convert import convert
+from bin.find_misses import extract_tile_polygon, find_misses
+from bin.get_polygons import get_polygons
+from bin.subset import create_subsets, merge_dicts
+
+STAGES = ['get_polygons', 'find_misses', 'find_misses_dense', 'find_misses_proximity', 'create_subsets', 'convert']
+
+# Stage of the run metrics each benchmarked function records into
+RECORDED_STAGES = {'find_misses': 'misses', 'find_misses_dense': 'misses', 'find_misses_proximity': 'misses',
+                   'create_subsets': 'subset', 'convert': 'convert'}
+
+# Sentinel 2 bands the synthetic tiles are given. convert uses bands 4, 3 and 2
+BANDS = ['B01', 'B02', 'B03', 'B04']
+
+INSPIRE_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<gmd:MD_Metadata xmlns:gmd="http://www.isotc211.org/2005/gmd" xmlns:gco="http://www.isotc211.org/2005/gco">
+  <gmd:identificationInfo>
+    <gmd:MD_DataIdentification>
+      <gmd:abstract>
+        <gco:CharacterString>%s</gco:CharacterString>
+      </gmd:abstract>
+    </gmd:MD_DataIdentification>
+  </gmd:identificationInfo>
+</gmd:MD_Metadata>
+"""
+
+
+def synthetic_supplierId(index):
+    """
+    Makes a Sentinel 2 style product name for a synthetic tile
+
+    :param index: index of the tile
+    :return: supplierId (str)
+    """
+    return "S2B_MSIL1C_20190801T000000_N0208_R000_T%.5dX_20190801T000000" % index
+
+
+def tile_origin(index):
+    """
+    Places the synthetic tiles on a grid far enough apart that they never overlap
+
+    :param index: index of the tile
+    :return: (lat, lon) of the north west corner of the tile
+    """
+    return -10.0 - (index // 20) * 0.5, 20.0 + (index % 20) * 0.5
+
+
+def make_tile(tilepath, index, band_pixels, rng):
+    """
+    Writes one synthetic Sentinel 2 tile: an INSPIRE.xml with the footprint of the tile and one GeoTIFF per band with
+    the .jp2 extension the pipeline looks for. The bands use the UTM zone of the tile and 10m pixels like real tiles
+
+    :param tilepath: path where the tile directory is made
+    :param index: index of the tile
+    :param band_pixels: length of one side of each band in pixels
+    :param rng: numpy RandomState used for the pixel values
+    :return: (supplierId, shapely Polygon of the tile footprint)
+    """
+    supplierId = synthetic_supplierId(index)
+    tile_dir = os.path.join(tilepath, supplierId)
+    os.mkdir(tile_dir)
+
+    lat, lon = tile_origin(index)
+    zone = int((lon + 180) / 6) + 1
+    utm = pyproj.Proj(proj='utm', zone=zone, south=lat < 0, ellps='WGS84')
+    x0, y0 = utm(lon, lat)
+    side = band_pixels * 10
+    corners = [utm(x, y, inverse=True) for x, y in
+               [(x0, y0), (x0 + side, y0), (x0 + side, y0 - side), (x0, y0 - side), (x0, y0)]]
+
+    # INSPIRE footprints list latitude before longitude
+    with open(os.path.join(tile_dir, 'INSPIRE.xml'), 'w') as f:
+        f.write(INSPIRE_TEMPLATE % ' '.join(['%.6f %.6f' % (c[1], c[0]) for c in corners]))
+
+    driver = gdal.GetDriverByName('GTiff')
+    for band in BANDS:
+        name = os.path.join(tile_dir, "T%.5dX_20190801T000000_%s.jp2" % (index, band))
+        dataset = driver.Create(name, band_pixels, band_pixels, 1, gdal.GDT_UInt16)
+        dataset.SetGeoTransform((x0, 10, 0, y0, 0, -10))
+        dataset.SetProjection(pyproj.CRS(utm.srs).to_wkt())
+        dataset.GetRasterBand(1).WriteArray(rng.randint(0, 4096, (band_pixels, band_pixels)).astype(np.uint16))
+        dataset = None
+
+    return supplierId, extract_tile_polygon(tile_dir)
+
+
+def make_geojson(path, tiles, hits, size, rng):
+    """
+    Writes a GeoJSON of hits spread evenly over the synthetic tiles. Half are points and half are small polygons, and
+    each has a random confidence
+
+    :param path: path of the GeoJSON file
+    :param tiles: list of (supplierId, footprint) of the synthetic tiles
+    :param hits: number of features to write
+    :param size: size of the dataset images in pixels, used to keep each hit image inside its tile
+    :param rng: numpy RandomState
+    :return: none
+    """
+    features = []
+    for i in range(hits):
+        minx, miny, maxx, maxy = tiles[i % len(tiles)][1].bounds
+        margin_lat = size * 10 / 111320.0
+        margin_lon = margin_lat / cos(radians(maxy))
+        lon = rng.uniform(minx + margin_lon, maxx - margin_lon)
+        lat = rng.uniform(miny + margin_lat, maxy - margin_lat)
+        if i % 2:
+            geometry = {'type': 'Point', 'coordinates': [lon, lat]}
+        else:
+            d = margin_lat / 10
+            geometry = {'type': 'Polygon', 'coordinates': [[[lon - d, lat - d], [lon + d, lat - d], [lon + d, lat + d],
+                                                            [lon - d, lat + d], [lon - d, lat - d]]]}
+        features.append({'type': 'Feature', 'properties': {'Confidence': int(rng.randint(1, 4))},
+                         'geometry': geometry})
+
+    with open(path, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+
+
+def make_hit_dict(hitlist, tiles):
+    """
+    Assigns each hit to the synthetic tile that contains it, as download_tiles does with the tiles it finds
+
+    :param hitlist: list of (count, polygon, confidence) from get_polygons
+    :param tiles: list of (supplierId, footprint) of the synthetic tiles
+    :return: dictionary of supplierIds to lists of hits
+    """
+    hit_dict = {}
+    for hit in hitlist:
+        for supplierId, footprint in tiles:
+            if footprint.contains(hit[1]):
+                hit_dict.setdefault(supplierId, []).append(hit)
+                break
+    return hit_dict
+
+
+def git_commit():
+    """
+    :return: hash of the commit being benchmarked, or None outside a git checkout
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_stage(func):
+    """
+    Runs one stage with fresh metrics
+
+    :param func: function running the stage
+    :return: (result of func, wall seconds, report of the stages func recorded into)
+    """
+    metrics.run = metrics.RunMetrics()
+    start = time.perf_counter()
+    result = func()
+    wall = time.perf_counter() - start
+    return result, wall, metrics.run.report()['stages']
+
+
+def benchmark_size(workdir, hits, hits_per_tile, size, band_pixels, threads, stages, repeat, seed):
+    """
+    Builds a synthetic dataset of one size and times each stage on it
+
+    :param workdir: directory the synthetic tiles and outputs are written to
+    :param hits: number of hits in the synthetic GeoJSON
+    :param hits_per_tile: number of hits placed in each tile
+    :param size: size of the dataset images in pixels
+    :param band_pixels: length of one side of each synthetic band in pixels
+    :param threads: number of threads each stage is given
+    :param stages: names of the stages to run
+    :param repeat: number of times each stage is run. The fastest run is kept
+    :param seed: seed for the synthetic data and the random miss placement
+    :return: list of result dictionaries
+    """
+    root = os.path.join(workdir, str(hits))
+    tilepath = os.path.join(root, 'tiles')
+    os.makedirs(tilepath)
+    rng = np.random.RandomState(seed)
+    num_tiles = max(1, -(-hits // hits_per_tile))
+    tiles = [make_tile(tilepath, i, band_pixels, rng) for i in range(num_tiles)]
+    geojson = os.path.join(root, 'input.geojson')
+    make_geojson(geojson, tiles, hits, size, rng)
+
+    hitlist = get_polygons(3, size, geojson)
+    hit_dict = make_hit_dict(hitlist, tiles)
+    misspath = os.path.join(root, 'misses.dictionary')
+    miss_dict = {}
+
+    def run_find_misses(dense=False, proximity=False):
+        random.seed(seed)
+        return find_misses(copy.deepcopy(hit_dict), tilepath, size, dense, misspath, threads, proximity)
+
+    def run_create_subsets():
+        tifpath = os.path.join(root, 'tifs')
+        shutil.rmtree(tifpath, ignore_errors=True)
+        full_dict = merge_dicts(copy.deepcopy(hit_dict), miss_dict or run_find_misses())
+        create_subsets(full_dict, tilepath, tifpath, 'bench', size, threads)
+
+    def run_convert():
+        jpgpath = os.path.join(root, 'jpgs')
+        shutil.rmtree(jpgpath, ignore_errors=True)
+        convert(size, os.path.join(root, 'tifs'), jpgpath, 'bench', threads)
+
+    funcs = {
+        'get_polygons': lambda: get_polygons(3, size, geojson),
+        'find_misses': run_find_misses,
+        'find_misses_dense': lambda: run_find_misses(dense=True),
+        'find_misses_proximity': lambda: run_find_misses(proximity=True),
+        'create_subsets': run_create_subsets,
+        'convert': run_convert,
+    }
+    # Items each stage works through, for the throughput
+    items = {'get_polygons': hits, 'create_subsets': 2 * len(hitlist), 'convert': 2 * len(hitlist)}
+
+    results = []
+    for stage in [s for s in STAGES if s in stages]:
+        if stage == 'convert' and not os.path.isdir(os.path.join(root, 'tifs')):
+            run_create_subsets()
+        best = None
+        for _ in range(repeat):
+            result, wall, stage_report = time_stage(funcs[stage])
+            if best is None or wall < best[0]:
+                best = wall, stage_report
+            if stage == 'find_misses':
+                miss_dict = result
+        wall, stage_report = best
+
+        # Stages that poll their threads only notice they have finished every few seconds, so where the stage
+        # recorded per item timings their sum is compared across runs instead of the wall time
+        recorded = stage_report.get(RECORDED_STAGES.get(stage))
+        seconds = recorded['busy_seconds'] if recorded and recorded['items'] else wall
+        count = items.get(stage, len(hitlist))
+        results.append({
+            'stage': stage,
+            'hits': hits,
+            'tiles': num_tiles,
+            'items': count,
+            'wall_seconds': wall,
+            'seconds': seconds,
+            'items_per_second': count / seconds if seconds else None,
+            'latency_p50': recorded['latency_p50'] if recorded else None,
+            'latency_p99': recorded['latency_p99'] if recorded else None,
+        })
+        logging.info("%s with %s hits: %.3fs" % (stage, hits, seconds))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares a benchmark run against an earlier one
+
+    :param results: benchmark report of this run
+    :param baseline: benchmark report to compare against
+    :param threshold: fractional slow down that counts as a regression, e.g. 0.2 for 20%
+    :return: list of (stage, hits, baseline seconds, seconds) for each regression
+    """
+    before = dict([((r['stage'], r['hits']), r['seconds']) for r in baseline['results']])
+    regressions = []
+    for r in results['results']:
+        old = before.get((r['stage'], r['hits']))
+        if old is None:
+            continue
+        change = (r['seconds'] - old) / old if old else 0
+        print("%-22s %8s hits %10.3fs -> %10.3fs %+7.1f%%" % (r['stage'], r['hits'], old, r['seconds'], change * 100))
+        if change > threshold:
+            regressions.append((r['stage'], r['hits'], old, r['seconds']))
+    return regressions
+
+
+def run_benchmark(sizes, hits_per_tile, size, band_pixels, threads, stages, repeat, seed, workdir=None):
+    """
+    Runs the benchmark at each dataset size
+
+    :return: benchmark report dictionary
+    """
+    keep = workdir is not None
+    workdir = os.path.abspath(workdir) if keep else tempfile.mkdtemp(prefix='pipeline_benchmark_')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    # subset writes its temporary csv and vrt files to the working directory
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        results = []
+        for hits in sizes:
+            results += benchmark_size(workdir, hits, hits_per_tile, size, band_pixels, threads, stages, repeat, seed)
+    finally:
+        os.chdir(cwd)
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'commit': git_commit(),
+        'created': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'settings': {'hits_per_tile': hits_per_tile, 'size': size, 'band_pixels': band_pixels, 'threads': threads,
+                     'repeat': repeat, 'seed': seed},
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times each stage of the pipeline on synthetic Sentinel 2 tiles")
+    parser.add_argument("--sizes", nargs='+', type=int, default=[10, 100, 1000], help="Numbers of hits to benchmark")
+    parser.add_argument("--hitspertile", type=int, default=20, help="Number of hits placed in each synthetic tile")
+    parser.add_argument("--size", type=int, default=64, help="Size of one length of the dataset images")
+    parser.add_argument("--bandpixels", type=int, default=1098, help="Size of one length of the synthetic bands")
+    parser.add_argument("--threads", type=int, default=1, help="Number of threads given to each stage")
+    parser.add_argument("--stages", nargs='+', default=STAGES, choices=STAGES, help="Stages to benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each stage. The fastest is kept")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic data")
+    parser.add_argument("--workdir", help="Directory to keep the synthetic data in. Defaults to a temporary directory")
+    parser.add_argument("--output", default="benchmark.json", help="Path for the JSON results")
+    parser.add_argument("--compare", help="Path of earlier JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Fractional slow down counted as a regression when comparing")
+    parser.add_argument("--verbose", action="store_true", help="Enable verbose mode")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    results = run_benchmark(args.sizes, args.hitspertile, args.size, args.bandpixels, args.threads, args.stages,
+                            args.repeat, args.seed, args.workdir)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    logging.info("Benchmark results written to %s" % args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            for stage, hits, old, new in regressions:
+                logging.error("%s with %s hits regressed from %.3fs to %.3fs" % (stage, hits, old, new))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,11 @@ from osgeo import gdal
 from threading import Thread
 from tqdm import tqdm
 
+from bin import metrics
+
+# gdal_translate options that take bands 4, 3 and 2 into an 8 bit jpeg
+JPG_OPTIONS = ['-scale', '-b 4', '-b 3', '-b 2', '-of jpeg', '-ot Byte']
+
 
 def convert_to_jpg(tif, side, options_list, name, destination):
     gdal.PushErrorHandler('CPLQuietErrorHandler')
@@ -47,7 +52,7 @@ def convert_to_jpg(tif, side, options_list, name, destination):
 
     jpgname = destination + '/' + name+ '_' + fileinfo[0] + '_' + fileinfo[1] + '_' + str(side) + '.jpg'
     gdal.Translate(jpgname, tif, options=options_string)
-    return
+    return jpgname
 
 
 def convert_batch(arr, side, options_list, destination, name, already_done, pbar):
@@ -57,7 +62,10 @@ def convert_batch(arr, side, options_list, destination, name, already_done, pbar
         if id in already_done:
             continue
         try:
-            convert_to_jpg(el, side, options_list, name, destination)
+            with metrics.run.timed("convert") as timer:
+                timer.bytes_read = os.path.getsize(el)
+                jpgname = convert_to_jpg(el, side, options_list, name, destination)
+                timer.bytes_written = os.path.getsize(jpgname)
         except Exception:
             continue
 
@@ -67,7 +75,7 @@ def convert_batch(arr, side, options_list, destination, name, already_done, pbar
 def convert(size, sourcedir, destdir, name, threads):
     if size <= 256 and size >= 1:
 
-        options_list = ['-scale', '-b 4', '-b 3', '-b 2', '-of jpeg', '-ot Byte']
+        options_list = list(JPG_OPTIONS)
 
         list = glob.glob(sourcedir + '/*.tif')
 
@@ -79,6 +87,7 @@ def convert(size, sourcedir, destdir, name, threads):
         pbar = tqdm(total=len(list), desc="Converting images to jpegs", unit="image")
 
         conv_thread = []
+        metrics.run.stage("convert", workers=threads)
 
         for t in range(threads):
             arr = [list[i] for i in range(len(list)) if i % threads == t]
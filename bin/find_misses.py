@@ -1,3 +1,4 @@
+import logging
 import os
 import pickle
 import shapely.geometry as sp
@@ -6,12 +7,17 @@ import time
 import xml.etree.ElementTree as et
 from functools import partial
 from glob import glob
+from math import cos, floor, pi, radians, sin
 from multiprocessing.pool import Pool
 from random import random
 from tqdm import tqdm
 
+from bin import metrics
 from bin.square_polygon import square_polygon
 
+# Number of random locations tried before giving up on finding a single proximity miss
+MAX_ATTEMPTS = 1000
+
 
 def format(string):
     """
@@ -183,7 +189,8 @@ def find_misses_one_tile_dense(num_hits, size, hit_dict, tile_path, miss_dict, p
     # Each thread keeps doing this until the total number of misses is reached
     while counter < num_hits:
         counter += 1
-        miss = find_one_miss(tile, size, hit_list, miss_list)
+        with metrics.run.timed("misses"):
+            miss = find_one_miss(tile, size, hit_list, miss_list)
         id = num_hits + counter
         miss_list.append((id, miss, 0))
 
@@ -216,6 +223,7 @@ def find_misses_dense(hit_dict, tilepath, size, threads):
 
     # Creates threads
     miss_threads = []
+    metrics.run.stage("misses", workers=threads)
 
     # Creates progress bar to monitor progress
     pbar = tqdm(total=num_hits, desc='Finding miss polygons', unit='polygon')
@@ -262,9 +270,267 @@ def find_misses_normal(hit_dict, tilepath, size, threads):
 
     # Creates multiprocess pool to find all the misses
     find_misses_one_tile_partial = partial(find_misses_one_tile, num_hits, misses_per_image, size, hit_dict, images)
+    stage = metrics.run.stage("misses", workers=threads)
+    with Pool(threads) as pool:
+        for result, seconds in tqdm(pool.imap_unordered(partial(metrics.call_timed, find_misses_one_tile_partial),
+                                                        range(len(images))),
+                                    total=len(images), desc='Finding miss polygons', unit='polygon'):
+            stage.record(seconds)
+            if result is not False:
+                miss_dict[result[0]] = result[1]
+
+        pool.close()
+        pool.join()
+
+    return miss_dict
+
+
+class EnvelopeGrid(object):
+    """
+    Uniform grid spatial index over polygon envelopes. Polygons can be added as they are found, so the same index
+    serves for both the hits on a tile and the misses that have already been chosen.
+    """
+
+    def __init__(self, cell_size):
+        """
+        :param cell_size: side length of a grid cell in degrees. Roughly the size of one image works well
+        """
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def _cells(self, bounds):
+        (minx, miny, maxx, maxy) = bounds
+        for i in range(int(floor(minx / self.cell_size)), int(floor(maxx / self.cell_size)) + 1):
+            for j in range(int(floor(miny / self.cell_size)), int(floor(maxy / self.cell_size)) + 1):
+                yield i, j
+
+    def insert(self, polygon):
+        """
+        Adds a polygon to the index
+
+        :param polygon: shapely polygon
+        :return: none
+        """
+        for cell in self._cells(polygon.bounds):
+            self.cells.setdefault(cell, []).append(polygon)
+
+    def intersects(self, polygon):
+        """
+        Checks if the envelope of a polygon intersects the envelope of any indexed polygon
+
+        :param polygon: shapely polygon
+        :return: boolean
+        """
+        envelope = polygon.envelope
+        for cell in self._cells(polygon.bounds):
+            for indexed in self.cells.get(cell, []):
+                if indexed.envelope.intersects(envelope):
+                    return True
+        return False
+
+
+def metres_to_degrees(metres, lat):
+    """
+    Approximates a distance in metres as a number of degrees of longitude and latitude
+
+    :param metres: distance in metres (float)
+    :param lat: latitude the distance is measured at (float)
+    :return: tuple of (degrees longitude, degrees latitude)
+    """
+    degrees_lat = metres / 111320.0
+    degrees_lon = metres / (111320.0 * max(cos(radians(lat)), 0.01))
+    return degrees_lon, degrees_lat
+
+
+def ring_polygon(hit_polygon, size, ring):
+    """
+    Finds a random polygon whose edge lies in a distance ring around the edge of a hit polygon, so it never overlaps
+    the hit whatever the size of the images
+
+    :param hit_polygon: shapely polygon of the hit
+    :param size: Number of pixels we want the final image to be
+    :param ring: tuple of (minimum, maximum) distance in metres from the edge of the hit
+    :return: shapely polygon
+    """
+    (minx, miny, maxx, maxy) = hit_polygon.bounds
+    distance = ring[0] + random() * (ring[1] - ring[0])
+    bearing = random() * 2 * pi
+    # The gap is measured along the axis the bearing is closest to, the same way far_from_hits grows the hits
+    (degrees_lon, degrees_lat) = metres_to_degrees(distance + int(size) / 2 * 10, (miny + maxy) / 2)
+    scale = 1 / max(abs(cos(bearing)), abs(sin(bearing)))
+    lon = (minx + maxx) / 2 + (degrees_lon + (maxx - minx) / 2) * cos(bearing) * scale
+    lat = (miny + maxy) / 2 + (degrees_lat + (maxy - miny) / 2) * sin(bearing) * scale
+    return square_polygon(lat, lon, size)
+
+
+def far_from_hits(candidate_polygon, hit_index, distance):
+    """
+    Checks that a candidate polygon is further than distance from every hit polygon
+
+    :param candidate_polygon: shapely polygon of a candidate miss image
+    :param hit_index: EnvelopeGrid of the hit polygons on this tile
+    :param distance: distance in metres
+    :return: boolean
+    """
+    (minx, miny, maxx, maxy) = candidate_polygon.bounds
+    (degrees_lon, degrees_lat) = metres_to_degrees(distance, candidate_polygon.centroid.y)
+    grown = sp.box(minx - degrees_lon, miny - degrees_lat, maxx + degrees_lon, maxy + degrees_lat)
+    return not hit_index.intersects(grown)
+
+
+def find_one_proximity_miss(tile, size, hit_list, hit_index, miss_index, ring, near):
+    """
+    Finds a single miss polygon, either inside the distance ring of a random hit or further away than the ring
+
+    :param tile: Sentinel tile polygon
+    :param size: size of miss image in pixels
+    :param hit_list: list of hit polygons in this tile image
+    :param hit_index: EnvelopeGrid of the hit polygons in this tile image
+    :param miss_index: EnvelopeGrid of already identified miss polygons in this tile image
+    :param ring: tuple of (minimum, maximum) distance in metres from the edge of a hit
+    :param near: True to find a miss inside the ring, False to find one outside it
+    :return: miss polygon, or None if no location was found
+    """
+    for _ in range(MAX_ATTEMPTS):
+        if near:
+            hit = hit_list[int(random() * len(hit_list))]
+            candidate_polygon = ring_polygon(hit[1], size, ring)
+        else:
+            candidate_polygon = rand_polygon(tile, size)
+            if not far_from_hits(candidate_polygon, hit_index, ring[1]):
+                continue
+
+        if tile.contains(candidate_polygon.envelope) and not (
+                hit_index.intersects(candidate_polygon) or miss_index.intersects(candidate_polygon)):
+            return candidate_polygon
+    return None
+
+
+def find_misses_one_tile_proximity(size, ring, near_ratio, hit_dict, first_ids, tile_path):
+    """
+    Finds the miss polygons in one tile. There is one miss for every hit in the tile, of which near_ratio are taken
+    from the distance ring around the hits and the rest from further away
+
+    :param size: size of miss image in pixels
+    :param ring: tuple of (minimum, maximum) distance in metres from the edge of a hit
+    :param near_ratio: fraction of the misses that should be near to a hit (float between 0 and 1)
+    :param hit_dict: dictionary of all hit polygons
+    :param first_ids: dictionary of the first id number to give the misses in each tile
+    :param tile_path: path to the Sentinel tile
+    :return: key,value for miss_list
+    """
+
+    supplierId = os.path.splitext(os.path.basename(tile_path))[0]
+
+    try:
+        tile = extract_tile_polygon(tile_path)
+    except FileNotFoundError:
+        return False
+
+    hit_list = hit_dict.get(supplierId, [])
+    miss_list = []
+    if not hit_list:
+        return (supplierId, miss_list)
+
+    (minx, miny, maxx, maxy) = hit_list[0][1].bounds
+    hit_index = EnvelopeGrid(max(maxx - minx, maxy - miny))
+    miss_index = EnvelopeGrid(hit_index.cell_size)
+    for hit in hit_list:
+        hit_index.insert(hit[1])
+
+    num_near = int(round(len(hit_list) * near_ratio))
+    for n in range(len(hit_list)):
+        near = n < num_near
+        miss = find_one_proximity_miss(tile, size, hit_list, hit_index, miss_index, ring, near)
+        if miss is None:
+            # Fall back to the other kind of miss rather than leave the tile short
+            logging.warning("Could not find %s miss %s of %s in tile %s, looking %s instead" % (
+                "a near" if near else "a far", n + 1, len(hit_list), supplierId, "further away" if near else "nearby"))
+            miss = find_one_proximity_miss(tile, size, hit_list, hit_index, miss_index, ring, not near)
+        if miss is None:
+            logging.warning("Could not find miss %s of %s in tile %s" % (n + 1, len(hit_list), supplierId))
+            continue
+        miss_index.insert(miss)
+        miss_list.append((first_ids[supplierId] + n, miss, 0))
+
+    return (supplierId, miss_list)
+
+
+def allocate_miss_ids(hit_dict, supplierIds):
+    """
+    Gives every tile a block of miss id numbers the size of its number of hits, starting after the hit ids
+
+    :param hit_dict: the dictionary containing all the classification hits
+    :param supplierIds: list of the supplier IDs of all the tiles
+    :return: dictionary of the first miss id number in each tile
+    """
+    num_hits = sum([len(hit_dict[key]) for key in hit_dict.keys()])
+
+    first_ids = {}
+    next_id = num_hits + 1
+    for supplierId in supplierIds:
+        first_ids[supplierId] = next_id
+        next_id += len(hit_dict.get(supplierId, []))
+    return first_ids
+
+
+def find_misses_tile(tile_path, hit_dict, first_ids, size, proximity=False, ring=(1000, 5000), near_ratio=0.5):
+    """
+    Finds one miss polygon for every hit in a single tile. Used when tiles are processed one at a time as they arrive
+
+    :param tile_path: path to the Sentinel tile
+    :param hit_dict: dictionary of all hit polygons
+    :param first_ids: dictionary of the first id number to give the misses in each tile
+    :param size: size of miss image in pixels
+    :param proximity: boolean to take hard negative misses from around the hits
+    :param ring: tuple of (minimum, maximum) distance in metres from a hit for proximity misses
+    :param near_ratio: fraction of proximity misses that are inside the ring
+    :return: list of miss polygons, empty if the tile bounds could not be read
+    """
+    if proximity:
+        result = find_misses_one_tile_proximity(size, ring, near_ratio, hit_dict, first_ids, tile_path)
+        return result[1] if result is not False else []
+
+    supplierId = os.path.splitext(os.path.basename(tile_path))[0]
+    try:
+        tile = extract_tile_polygon(tile_path)
+    except FileNotFoundError:
+        return []
+
+    hit_list = hit_dict.get(supplierId, [])
+    miss_list = []
+    for n in range(len(hit_list)):
+        miss = find_one_miss(tile, size, hit_list, miss_list)
+        miss_list.append((first_ids[supplierId] + n, miss, 0))
+    return miss_list
+
+
+def find_misses_proximity(hit_dict, tilepath, size, threads, ring, near_ratio):
+    """
+    Identifies polygons that will be classification misses for the dataset. Takes hard negatives from a distance
+    ring around the hits in each tile, and the remainder from further away
+
+    :param hit_dict: the dictionary containing all the classification hits
+    :param tilepath: path where all Sentinel tiles are stored
+    :param size: size of final images in pixels
+    :param threads: number of threads
+    :param ring: tuple of (minimum, maximum) distance in metres from the edge of a hit
+    :param near_ratio: fraction of the misses in each tile that should be near to a hit
+    :return: dictionary containing all classification misses
+    """
+
+    miss_dict = {}
+
+    images = sorted(glob(tilepath + '/*'))
+    first_ids = allocate_miss_ids(hit_dict, [os.path.splitext(os.path.basename(image))[0] for image in images])
+
+    find_misses_one_tile_partial = partial(find_misses_one_tile_proximity, size, ring, near_ratio, hit_dict, first_ids)
+    stage = metrics.run.stage("misses", workers=threads)
     with Pool(threads) as pool:
-        for result in tqdm(pool.imap_unordered(find_misses_one_tile_partial, range(len(images))),
-                           total=len(images), desc='Finding miss polygons', unit='polygon'):
+        for result, seconds in tqdm(pool.imap_unordered(partial(metrics.call_timed, find_misses_one_tile_partial),
+                                                        images),
+                                    total=len(images), desc='Finding miss polygons', unit='tile'):
+            stage.record(seconds)
             if result is not False:
                 miss_dict[result[0]] = result[1]
 
@@ -274,9 +540,10 @@ def find_misses_normal(hit_dict, tilepath, size, threads):
     return miss_dict
 
 
-def find_misses(hit_dict, tilepath, size, dense, misspath, threads):
+def find_misses(hit_dict, tilepath, size, dense, misspath, threads, proximity=False, ring=(1000, 5000),
+                near_ratio=0.5):
     """
-    Find miss polygons for the dataset. Uses normal method unless dense variable is True
+    Find miss polygons for the dataset. Uses normal method unless dense or proximity variables are True
 
     :param hit_dict: the dictionary containing all the classification hits
     :param tilepath: path where all Sentinel tiles are stored
@@ -284,10 +551,15 @@ def find_misses(hit_dict, tilepath, size, dense, misspath, threads):
     :param dense: boolean determining method of finding misses
     :param misspath: path to miss dictionary (same as hit path)
     :param threads: Number of threads
+    :param proximity: boolean to take hard negative misses from around the hits
+    :param ring: tuple of (minimum, maximum) distance in metres from a hit for proximity misses
+    :param near_ratio: fraction of proximity misses in each tile that are inside the ring
     :return: none
     """
 
-    if dense:
+    if proximity:
+        miss_dict = find_misses_proximity(hit_dict, tilepath, size, threads, ring, near_ratio)
+    elif dense:
         miss_dict = find_misses_dense(hit_dict, tilepath, size, threads)
     else:
         miss_dict = find_misses_normal(hit_dict, tilepath, size, threads)
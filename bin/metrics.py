@@ -0,0 +1,214 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = [0.01, 0.03, 0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000]
+
+
+class StageMetrics(object):
+    """
+    Timing and throughput of one stage of the pipeline. Safe to record into from several threads at once.
+    """
+
+    def __init__(self, name, workers=1):
+        self.name = name
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.started = None
+        self.finished = None
+
+    def record(self, latency, bytes_read=0, bytes_written=0, error=False):
+        """
+        Records one item going through the stage
+
+        :param latency: seconds the item took
+        :param bytes_read: number of bytes read while processing the item
+        :param bytes_written: number of bytes written while processing the item
+        :param error: True if the item failed
+        :return: none
+        """
+        now = time.time()
+        with self.lock:
+            self.latencies.append(latency)
+            self.errors += int(error)
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+            if self.started is None or now - latency < self.started:
+                self.started = now - latency
+            if self.finished is None or now > self.finished:
+                self.finished = now
+        logging.debug("%s item took %.3fs" % (self.name, latency))
+
+    def add_bytes(self, bytes_read=0, bytes_written=0):
+        with self.lock:
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+
+    def report(self):
+        """
+        :return: dictionary summarising the stage
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+            wall = (self.finished - self.started) if latencies else 0
+            busy = sum(latencies)
+            histogram = OrderedDict([("<=%ss" % bound, 0) for bound in BUCKETS] + [(">%ss" % BUCKETS[-1], 0)])
+            for latency in latencies:
+                for bound in BUCKETS:
+                    if latency <= bound:
+                        histogram["<=%ss" % bound] += 1
+                        break
+                else:
+                    histogram[">%ss" % BUCKETS[-1]] += 1
+
+            return OrderedDict([
+                ("items", len(latencies)),
+                ("errors", self.errors),
+                ("workers", self.workers),
+                ("wall_seconds", wall),
+                ("busy_seconds", busy),
+                ("items_per_second", len(latencies) / wall if wall else None),
+                ("utilisation", busy / (wall * self.workers) if wall else None),
+                ("latency_mean", busy / len(latencies) if latencies else None),
+                ("latency_p50", percentile(latencies, 50)),
+                ("latency_p90", percentile(latencies, 90)),
+                ("latency_p99", percentile(latencies, 99)),
+                ("latency_histogram", histogram),
+                ("bytes_read", self.bytes_read),
+                ("bytes_written", self.bytes_written),
+            ])
+
+
+class Timer(object):
+    """
+    Returned by timed so the caller can add the bytes an item read and wrote
+    """
+
+    def __init__(self):
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(int(len(ordered) * p / 100.0), len(ordered) - 1)]
+
+
+class RunMetrics(object):
+    """
+    Collects the metrics of every stage in a run of the pipeline
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = OrderedDict()
+        self.started = time.time()
+
+    def stage(self, name, workers=None):
+        """
+        Gets the metrics of a stage, creating it if needed
+
+        :param name: name of the stage
+        :param workers: number of workers running the stage, if known
+        :return: StageMetrics
+        """
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = StageMetrics(name)
+            if workers is not None:
+                self.stages[name].workers = workers
+            return self.stages[name]
+
+    @contextmanager
+    def timed(self, name):
+        """
+        Context manager that records the time taken by the block as one item of a stage
+
+        :param name: name of the stage
+        :return: Timer to add bytes read and written to
+        """
+        timer = Timer()
+        start = time.perf_counter()
+        error = False
+        try:
+            yield timer
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.stage(name).record(time.perf_counter() - start, timer.bytes_read, timer.bytes_written, error)
+
+    def report(self):
+        """
+        :return: dictionary summarising the run
+        """
+        result = OrderedDict([
+            ("started", self.started),
+            ("wall_seconds", time.time() - self.started),
+            ("stages", OrderedDict([(name, stage.report()) for name, stage in self.stages.items()])),
+        ])
+        if resource is not None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            result["resources"] = OrderedDict([
+                ("cpu_user_seconds", usage.ru_utime + children.ru_utime),
+                ("cpu_system_seconds", usage.ru_stime + children.ru_stime),
+                # kilobytes on linux
+                ("max_rss", usage.ru_maxrss),
+            ])
+        return result
+
+    def log_summary(self):
+        for name, stage in self.stages.items():
+            summary = stage.report()
+            logging.info("%s: %s items in %.1fs, %s per second, utilisation %s" % (
+                name, summary["items"], summary["wall_seconds"], _round(summary["items_per_second"]),
+                _round(summary["utilisation"])))
+
+    def write_report(self, path):
+        """
+        Writes the run report as JSON
+
+        :param path: path of the report file
+        :return: none
+        """
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        logging.info("Run report written to %s" % path)
+
+
+def _round(value):
+    return None if value is None else round(value, 2)
+
+
+def call_timed(func, item):
+    """
+    Runs func(item) and returns the result along with the seconds it took. Used for work done in a process pool,
+    where the worker can not record into the metrics of the parent process.
+
+    :param func: function to run
+    :param item: argument to pass to it
+    :return: tuple of (result, seconds)
+    """
+    start = time.perf_counter()
+    result = func(item)
+    return result, time.perf_counter() - start
+
+
+# Metrics for the current run of the pipeline
+run = RunMetrics()
@@ -3,16 +3,19 @@ import pickle
 from os import listdir
 from os.path import isfile, isdir
 
+from bin import metrics
 from bin.convert import convert
 from bin.find_misses import find_misses
 from bin.get_polygons import get_polygons
-from bin.sentinel_tile_download import download_tiles
-from bin.subset import create_subsets,merge_dicts
+from bin.sentinel_tile_download import download_tiles, resume_downloads, search_tiles
+from bin.stream import run_streaming
+from bin.subset import GPT_BATCH_SIZE, create_subsets,merge_dicts
 from bin.sentinel1_tile_download import sentinel1_tile_download
 
 
 def run_pipeline(input, username, password, name, tilepath, tifpath, outpath, hit_dict_name, threads, size, confidence, dense,
-                 clean, no_miss,sentinel):
+                 clean, no_miss,sentinel, proximity=False, ring=(1000, 5000), near_ratio=0.5, streaming=False,
+                 disk_budget=None, report_path=None, gpt_batch=GPT_BATCH_SIZE):
     """
     Runs the dataset pipeline
 
@@ -28,12 +31,28 @@ def run_pipeline(input, username, password, name, tilepath, tifpath, outpath, hi
     :param clean: Bypasses dictionary files and does everything from scratch
     :param dense: Uses dense version of find_misses
     :param no_miss: Doesn't find misses
+    :param proximity: Takes misses from a distance ring around the hits
+    :param ring: (minimum, maximum) distance in metres from a hit for proximity misses
+    :param near_ratio: Fraction of proximity misses in each tile that are inside the ring
+    :param streaming: Moves each tile on to the later stages as soon as it is downloaded instead of running each stage
+                      over every tile in turn
+    :param disk_budget: Number of bytes the downloaded tiles may take up. Used tiles are removed to stay within it.
+                        Implies streaming
+    :param report_path: path where the JSON report of the stage timings and resource use is written. None only logs a
+                        summary
+    :param gpt_batch: Number of Sentinel 1 images subsetted from a tile by each gpt process
     :return: none
     """
     # TODO: Add logging
     # 0.5 If hit_dict has already been written, use that instead to save time
     logging.info("STAGE 1: Analysing input file and downloading imagery")
     hitpath = './dicts/' + hit_dict_name
+    if streaming or disk_budget:
+        run_pipeline_streaming(input, username, password, name, tilepath, tifpath, outpath, hit_dict_name, threads, size,
+                               confidence, clean, no_miss, sentinel, proximity, ring, near_ratio, disk_budget, gpt_batch)
+        finish_report(report_path)
+        return
+
     if not clean and isfile(hitpath) and isdir(tilepath) and listdir(tilepath):
         logging.info("Found a dictionary file. Reading and bypassing tile download...")
         with open(hitpath, 'rb') as f:
@@ -54,12 +73,57 @@ def run_pipeline(input, username, password, name, tilepath, tifpath, outpath, hi
             with open(misspath, 'rb') as f:
                 miss_dict = pickle.load(f)
         else:
-            miss_dict = find_misses(hit_dict, tilepath, size, dense, misspath, threads)
+            miss_dict = find_misses(hit_dict, tilepath, size, dense, misspath, threads, proximity, ring, near_ratio)
 
     # 4. Create subsets from full image tiles
     if no_miss==False:
         full_dict = merge_dicts(hit_dict, miss_dict)
     else:
         full_dict=hit_dict
-    create_subsets(full_dict, tilepath, tifpath, name, size, threads,int(sentinel))
+    create_subsets(full_dict, tilepath, tifpath, name, size, threads,int(sentinel), gpt_batch)
     convert(size, tifpath, outpath,name, threads)
+    finish_report(report_path)
+
+
+def finish_report(report_path):
+    """
+    Logs how long each stage took and writes the run report
+
+    :param report_path: path where the JSON report is written, or None
+    :return: none
+    """
+    metrics.run.log_summary()
+    if report_path:
+        metrics.run.write_report(report_path)
+
+
+def run_pipeline_streaming(input, username, password, name, tilepath, tifpath, outpath, hit_dict_name, threads, size,
+                           confidence, clean, no_miss, sentinel, proximity, ring, near_ratio, disk_budget=None,
+                           gpt_batch=GPT_BATCH_SIZE):
+    """
+    Runs the dataset pipeline with the stages overlapping. Every hit is first assigned to a tile, then each tile is
+    downloaded and passed straight on to miss generation, subsetting and conversion.
+
+    See run_pipeline for the parameters
+    """
+    hitpath = './dicts/' + hit_dict_name
+    if not clean and isfile(hitpath):
+        logging.info("Found a dictionary file. Reading and bypassing tile search...")
+        with open(hitpath, 'rb') as f:
+            hit_dict = pickle.load(f)
+        # The dictionary is written before any tile is downloaded, so a run that stopped part way has tiles left to get
+        downloads = resume_downloads(hit_dict, username, password, tilepath, sentinel=int(sentinel))
+        logging.info("%s tiles still to download" % len(downloads))
+    else:
+        hitlist = get_polygons(confidence, size, input)
+        hit_dict, downloads = search_tiles(hitlist, username, password, tilepath, hitpath, threads=threads,
+                                           sentinel=int(sentinel))
+
+    misspath = './dicts/' + hit_dict_name.split('.')[0] + '_misses.dictionary'
+    miss_dict = None
+    if not no_miss and not clean and isfile(misspath):
+        with open(misspath, 'rb') as f:
+            miss_dict = pickle.load(f)
+
+    run_streaming(hit_dict, downloads, tilepath, tifpath, outpath, name, size, threads, int(sentinel), misspath,
+                  no_miss, miss_dict, proximity, ring, near_ratio, disk_budget=disk_budget, gpt_batch=gpt_batch)
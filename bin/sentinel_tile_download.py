@@ -4,6 +4,7 @@ import pickle
 import threading
 import time
 from datetime import datetime, timedelta
+from functools import partial
 
 from google.cloud import storage
 from sedas_pyapi.sedas_api import SeDASAPI
@@ -11,6 +12,9 @@ from sedas_pyapi.bulk_download import SeDASBulkDownload
 from tqdm import tqdm
 from sentinelsat.sentinel import SentinelAPI
 
+from bin import metrics
+from bin.tile_cache import path_size
+
 
 
 
@@ -47,7 +51,59 @@ def download_one_tile_S2(supplierId, tilepath, bucket):
 
 
 
-def request_tile_S2(arr, startdate, enddate, cloud_cover, hit_dict, tilepath, bucket, sedas, pbar):
+def download_one_tile_S1(supplierId, tilepath, scihub):
+    """
+    Downloads an image from the Copernicus hub into tilepath, looking it up by its supplier ID
+
+    :param supplierId: supplier ID for Sentinel Tile
+    :param tilepath: path to Sentinel tiles
+    :param scihub: SentinelAPI object
+    :return:
+    """
+    result = scihub.query(identifier=supplierId)
+    if not result:
+        raise FileNotFoundError("Tile %s could not be found on the Copernicus hub" % supplierId)
+    scihub.download(list(result.keys())[0], directory_path=tilepath)
+
+
+def tile_on_disk(supplierId, tilepath):
+    """
+    Checks if a tile has been downloaded, either as a folder or as a zip
+
+    :param supplierId: supplier ID for Sentinel Tile
+    :param tilepath: path to Sentinel tiles
+    :return: True if the tile is in tilepath
+    """
+    base = os.path.join(tilepath, supplierId)
+    return any([os.path.exists(path) for path in [base, base + '.zip', base + '.SAFE']])
+
+
+def resume_downloads(hit_dict, username, password, tilepath, sentinel=2):
+    """
+    Makes a download function for each tile in a hit dictionary that is not in tilepath yet, so a streaming run that
+    stopped part way through can download the rest without searching for every polygon again
+
+    :param hit_dict: dictionary of all hits, with supplierIds as keys
+    :param username: SeDAS username
+    :param password: SeDAS password
+    :param tilepath: path where Sentinel tiles will be downloaded
+    :param sentinel: Sentinel 1 (1) or Sentinel 2 (2)
+    :return: dictionary of supplierIds to functions that download the tiles not yet in tilepath
+    """
+    missing = [supplierId for supplierId in hit_dict if not tile_on_disk(supplierId, tilepath)]
+    if not missing:
+        return {}
+
+    if sentinel == 1:
+        scihub = SentinelAPI(username, password, 'https://scihub.copernicus.eu/dhus')
+        return dict([(supplierId, partial(download_one_tile_S1, supplierId, tilepath, scihub))
+                     for supplierId in missing])
+
+    bucket = storage.Client().get_bucket("gcp-public-data-sentinel-2")
+    return dict([(supplierId, partial(download_one_tile_S2, supplierId, tilepath, bucket)) for supplierId in missing])
+
+
+def request_tile_S2(arr, startdate, enddate, cloud_cover, hit_dict, tilepath, bucket, sedas, pbar, pending=None):
     """
     Requests to download image from SeDAS server
 
@@ -58,22 +114,29 @@ def request_tile_S2(arr, startdate, enddate, cloud_cover, hit_dict, tilepath, bu
     :param hit_dict: dictionary of all hits, with supplierIds as keys
     :param downloader: the SeDAS downloader object
     :param sedas: SeDAS search object
+    :param pending: if given, new tiles are not downloaded. Instead a function that downloads them is stored here
     :return: none
     """
 
     for hit in arr:
-        result = sedas.search_sar(hit[1].envelope.wkt, startdate, enddate)
+        with metrics.run.timed("search"):
+            result = sedas.search_sar(hit[1].envelope.wkt, startdate, enddate)
         supplierId = str(result['products'][0]['supplierId'])
         intersection = list(set([el['supplierId'] for el in result['products']]) & set(hit_dict.keys()))
         if intersection:
             hit_dict[intersection[0]].append(hit)
         else:
             hit_dict[supplierId] = [hit]
-            download_one_tile_S2(result['products'][0]['supplierId'], tilepath, bucket)
+            if pending is None:
+                with metrics.run.timed("download") as timer:
+                    download_one_tile_S2(result['products'][0]['supplierId'], tilepath, bucket)
+                    timer.bytes_written = path_size(os.path.join(tilepath, supplierId))
+            else:
+                pending[supplierId] = partial(download_one_tile_S2, supplierId, tilepath, bucket)
         pbar.update(1)
 
 
-def request_tile_S1(arr, startdate, enddate, hit_dict, tilepath,scihub,pbar):
+def request_tile_S1(arr, startdate, enddate, hit_dict, tilepath,scihub,pbar, pending=None):
     """
     Requests to download image from SeDAS server
     :param arr: array of hits to download, in the same format as hitlist
@@ -83,11 +146,13 @@ def request_tile_S1(arr, startdate, enddate, hit_dict, tilepath,scihub,pbar):
     :param hit_dict: dictionary of all hits, with supplierIds as keys
     :param downloader: the SeDAS downloader object
     :param sedas: SeDAS search object
+    :param pending: if given, new tiles are not downloaded. Instead a function that downloads them is stored here
     :return: none
     """
 
     for hit in arr:
-        result = scihub.query(hit[1].envelope.wkt, date=(startdate, enddate),platformname='Sentinel-1',limit=20,producttype="GRD")
+        with metrics.run.timed("search"):
+            result = scihub.query(hit[1].envelope.wkt, date=(startdate, enddate),platformname='Sentinel-1',limit=20,producttype="GRD")
         try:
             supplierId = str(list(result.values())[0]['title'])
         except:
@@ -98,7 +163,12 @@ def request_tile_S1(arr, startdate, enddate, hit_dict, tilepath,scihub,pbar):
             hit_dict[intersection[0]].append(hit)
         else:
             hit_dict[supplierId] = [hit]
-            scihub.download(list(result.keys())[0], directory_path=tilepath)
+            if pending is None:
+                with metrics.run.timed("download") as timer:
+                    scihub.download(list(result.keys())[0], directory_path=tilepath)
+                    timer.bytes_written = path_size(os.path.join(tilepath, supplierId + '.zip'))
+            else:
+                pending[supplierId] = partial(scihub.download, list(result.keys())[0], directory_path=tilepath)
         pbar.update(1)
 
 def request_tile_S1_sedas(arr, startdate, enddate,  hit_dict, downloader, sedas, pbar):
@@ -132,7 +202,7 @@ def request_tile_S1_sedas(arr, startdate, enddate,  hit_dict, downloader, sedas,
 
 
 
-def download_tiles(hitlist, username, password, tilepath, hitpath, cloud_cover=5, threads=1,sentinel=2):
+def download_tiles(hitlist, username, password, tilepath, hitpath, cloud_cover=5, threads=1,sentinel=2, pending=None):
     """
     Downloads all Sentinel tiles that include hit polygons
 
@@ -143,6 +213,7 @@ def download_tiles(hitlist, username, password, tilepath, hitpath, cloud_cover=5
     :param hitpath: path where the hit dictionary will be stored
     :param cloud_cover: Maximum percentage of cloud cover
     :param threads: Number of threads we will use to download the files
+    :param pending: if given, tiles are not downloaded. A function that downloads each new tile is stored here instead
     :return: hit dictionary
     """
     # TODO: Add date change functionality
@@ -184,16 +255,18 @@ def download_tiles(hitlist, username, password, tilepath, hitpath, cloud_cover=5
     # Progress bar
     pbar = tqdm(total=len(hitlist), desc='Analysing polygons and downloading Sentinel tiles', unit='polygon')
 
+    metrics.run.stage("search", workers=threads)
+    metrics.run.stage("download", workers=threads)
     download_threads = []
     for t in range(threads):
         arr = [hitlist[i] for i in range(len(hitlist)) if i % threads == t]
         if int(sentinel)==1:
-            download_threads.append(threading.Thread(target=request_tile_S1, args=(arr, startDate, endDate, hit_dict, tilepath, scihub,pbar)))
+            download_threads.append(threading.Thread(target=request_tile_S1, args=(arr, startDate, endDate, hit_dict, tilepath, scihub,pbar, pending)))
             #download_threads.append(threading.Thread(target=request_tile_S1_sedas,
             #                                         args=(arr, startDate, endDate, hit_dict, downloader, sedas, pbar)))
         else:
             download_threads.append(threading.Thread(target=request_tile_S2, args=(
-                arr, startDate, endDate, cloud_cover, hit_dict, tilepath, bucket, sedas, pbar)))
+                arr, startDate, endDate, cloud_cover, hit_dict, tilepath, bucket, sedas, pbar, pending)))
         download_threads[t].daemon = True
         download_threads[t].start()
 
@@ -209,3 +282,21 @@ def download_tiles(hitlist, username, password, tilepath, hitpath, cloud_cover=5
         pickle.dump(hit_dict, f)
 
     return hit_dict
+
+
+def search_tiles(hitlist, username, password, tilepath, hitpath, cloud_cover=5, threads=1, sentinel=2):
+    """
+    Assigns every hit polygon to a Sentinel tile without downloading any of the tiles
+
+    :param hitlist: List of tuples, with format (count,polygon_coordinates, classification)
+    :param username: SeDAS username
+    :param password: SeDAS password
+    :param tilepath: path where Sentinel tiles will be downloaded
+    :param hitpath: path where the hit dictionary will be stored
+    :param cloud_cover: Maximum percentage of cloud cover
+    :param threads: Number of threads we will use to search for the tiles
+    :return: hit dictionary, and a dictionary of supplierIds to functions that download the tiles not yet in tilepath
+    """
+    pending = {}
+    hit_dict = download_tiles(hitlist, username, password, tilepath, hitpath, cloud_cover, threads, sentinel, pending)
+    return hit_dict, pending
@@ -0,0 +1,226 @@
+import logging
+import os
+import pickle
+import queue
+import threading
+import time
+from tqdm import tqdm
+
+from bin import metrics
+from bin.convert import JPG_OPTIONS, convert_to_jpg
+from bin.find_misses import allocate_miss_ids, find_misses_tile
+from bin.subset import GPT_BATCH_SIZE, one_subset, rungpt
+from bin.tile_cache import TileCache, path_size
+
+# Put on a queue after the last item so the workers of the next stage know to stop
+DONE = object()
+
+
+class Stage(object):
+    """
+    A pool of worker threads that takes items from an input queue, passes each one to a function and puts everything
+    the function yields on an output queue. The queues are bounded, so a slow stage holds back the stages before it.
+    """
+
+    def __init__(self, name, func, inbox, outbox, workers):
+        """
+        :param name: name of the stage, used for logging
+        :param func: function taking one item and returning an iterable of items for the next stage
+        :param inbox: queue to take items from
+        :param outbox: queue to put results on, or None if this is the last stage
+        :param workers: number of worker threads
+        """
+        self.name = name
+        self.func = func
+        self.inbox = inbox
+        self.outbox = outbox
+        self.remaining = workers
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._work) for _ in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+
+    def start(self):
+        metrics.run.stage(self.name, workers=len(self.threads))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            item = self.inbox.get()
+            if item is DONE:
+                # Put it back so the other workers of this stage see it too
+                self.inbox.put(DONE)
+                break
+            # Only the time spent in func counts towards the metrics, not the time spent waiting on a full outbox
+            busy = 0
+            error = False
+            start = time.perf_counter()
+            try:
+                results = iter(self.func(item) or [])
+                busy += time.perf_counter() - start
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        result = next(results)
+                    except StopIteration:
+                        break
+                    finally:
+                        busy += time.perf_counter() - start
+                    if self.outbox is not None:
+                        self.outbox.put(result)
+            except Exception as e:
+                error = True
+                if not busy:
+                    # func itself raised before returning its results
+                    busy = time.perf_counter() - start
+                logging.error("Stage %s failed on %s: %s" % (self.name, item, e))
+            metrics.run.stage(self.name).record(busy, error=error)
+
+        # The last worker to finish tells the next stage there is nothing more coming
+        with self.lock:
+            self.remaining -= 1
+            last = self.remaining == 0
+        if last and self.outbox is not None:
+            self.outbox.put(DONE)
+
+
+def run_streaming(hit_dict, downloads, tilepath, tifpath, outpath, name, size, threads, sentinel, misspath,
+                  no_miss=False, miss_dict=None, proximity=False, ring=(1000, 5000), near_ratio=0.5, queue_size=2,
+                  disk_budget=None, gpt_batch=GPT_BATCH_SIZE):
+    """
+    Runs the download, miss, subset and conversion stages at the same time. Each tile moves on to miss generation,
+    subsetting and conversion as soon as its download completes, instead of waiting for every tile to download.
+
+    :param hit_dict: dictionary of all hits, with supplierIds as keys
+    :param downloads: dictionary of supplierIds to functions that download tiles not yet in tilepath
+    :param tilepath: path where downloaded Sentinel tiles should be placed
+    :param tifpath: path where subsetted tifs should be placed
+    :param outpath: path where finished jpgs should be placed
+    :param name: identifying name of the dataset
+    :param size: Size of final image files in pixels
+    :param threads: Number of threads
+    :param sentinel: Sentinel 1 (1) or Sentinel 2 (2)
+    :param misspath: path where the miss dictionary will be stored
+    :param no_miss: Doesn't find misses
+    :param miss_dict: previously found misses to reuse, or None to find new ones
+    :param proximity: Takes misses from a distance ring around the hits
+    :param ring: (minimum, maximum) distance in metres from a hit for proximity misses
+    :param near_ratio: Fraction of proximity misses in each tile that are inside the ring
+    :param queue_size: number of tiles that can wait between stages before the earlier stage is held back
+    :param disk_budget: number of bytes the downloaded tiles may take up. Tiles are removed once all their subsets
+                        have been made. None keeps every tile
+    :param gpt_batch: number of Sentinel 1 images subsetted from a tile by each gpt process
+    :return: dictionary of all the misses found
+    """
+    for path in [tilepath, tifpath, outpath]:
+        if not os.path.isdir(path):
+            os.mkdir(path)
+
+    supplierIds = sorted(hit_dict.keys())
+    first_ids = allocate_miss_ids(hit_dict, supplierIds)
+    found_misses = {} if miss_dict is None else dict(miss_dict)
+    misses_lock = threading.Lock()
+
+    # Identifies already subsetted and converted images so we can skip them
+    image_nums = set([int(f.split("_")[0]) for f in os.listdir(tifpath) if f.endswith(".tif")])
+    already_done = set([int(f.split("_")[0]) for f in os.listdir(outpath) if f.endswith(".jpg")])
+
+    total = sum([len(v) for v in hit_dict.values()])
+    if not no_miss:
+        total *= 2
+    pbar = tqdm(total=total, desc="Streaming dataset", unit="image")
+
+    cache = TileCache(tilepath, disk_budget, downloads) if disk_budget else None
+
+    def download(supplierId):
+        if cache is not None:
+            # Pins the tile until the subset stage has finished with it
+            cache.acquire(supplierId)
+        elif supplierId in downloads:
+            logging.debug("Downloading tile %s" % supplierId)
+            downloads[supplierId]()
+            base = os.path.join(tilepath, supplierId)
+            metrics.run.stage("download").add_bytes(bytes_written=path_size(base) + path_size(base + '.zip'))
+        yield supplierId
+
+    def misses(supplierId):
+        polygons = list(hit_dict[supplierId])
+        if not no_miss:
+            if supplierId not in found_misses:
+                tile_misses = find_misses_tile(os.path.join(tilepath, supplierId), hit_dict, first_ids, size,
+                                               proximity, ring, near_ratio)
+                with misses_lock:
+                    found_misses[supplierId] = tile_misses
+            polygons += found_misses[supplierId]
+        if cache is not None:
+            cache.add_pending(supplierId, len(polygons))
+        yield supplierId, polygons
+
+    def subset(tile):
+        supplierId, polygons = tile
+        try:
+            for tif in subset_tile(supplierId, polygons):
+                yield tif
+        finally:
+            if cache is not None:
+                cache.release(supplierId)
+
+    def subset_tile(supplierId, polygons):
+        if sentinel == 1:
+            rungpt([supplierId], {supplierId: polygons}, tilepath, tifpath, tqdm(disable=True), size, gpt_batch)
+            if cache is not None:
+                cache.complete(supplierId, len(polygons))
+            for count, polygon, confidence in polygons:
+                tif = os.path.join(tifpath, "%s_%s_%s.tif" % (str(count).zfill(5), confidence, supplierId))
+                if os.path.exists(tif):
+                    yield tif
+            return
+
+        for count, polygon, confidence in polygons:
+            filename = "%.5d_%s_%s_%s" % (count, confidence, supplierId, name)
+            if int(count) not in image_nums:
+                one_subset(supplierId, filename, polygon, tilepath, tifpath, size, sentinel)
+            if cache is not None:
+                cache.complete(supplierId)
+            tif = os.path.join(tifpath, filename + ".tif")
+            if os.path.exists(tif):
+                yield tif
+
+    def convert(tif):
+        if int(os.path.basename(tif).split('_')[0]) not in already_done:
+            jpgname = convert_to_jpg(tif, size, list(JPG_OPTIONS), name, outpath)
+            metrics.run.stage("convert").add_bytes(os.path.getsize(tif), os.path.getsize(jpgname))
+        pbar.update(1)
+
+    # Every tile is known before anything is downloaded, so the first queue does not need to be bounded
+    tile_queue = queue.Queue()
+    for supplierId in supplierIds:
+        tile_queue.put(supplierId)
+    tile_queue.put(DONE)
+
+    downloaded_queue = queue.Queue(maxsize=queue_size)
+    polygon_queue = queue.Queue(maxsize=queue_size)
+    tif_queue = queue.Queue(maxsize=queue_size * threads)
+
+    # Subsetting stays on one thread as in create_subsets; gdalwarp already uses several cores
+    stages = [
+        Stage("download", download, tile_queue, downloaded_queue, 2 if sentinel == 1 else threads).start(),
+        Stage("misses", misses, downloaded_queue, polygon_queue, 1).start(),
+        Stage("subset", subset, polygon_queue, tif_queue, 1).start(),
+        Stage("convert", convert, tif_queue, None, threads).start(),
+    ]
+    for stage in stages:
+        stage.join()
+    pbar.close()
+
+    if not no_miss:
+        with open(misspath, 'wb') as f:
+            pickle.dump(found_misses, f)
+
+    return found_misses
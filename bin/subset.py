@@ -4,11 +4,16 @@ import glob
 import os
 import threading
 import time
+from functools import partial
 from tqdm import tqdm
 from zipfile import ZipFile
 import shapely
 
-from subset.s1_ard_pypeline.ard.ard import gpt
+from bin import metrics
+from subset.s1_ard_pypeline.ard.batch import GptPool
+
+# Default number of polygons subsetted by each gpt process in rungpt
+GPT_BATCH_SIZE = 16
 
 
 def merge_dicts(hit_dict, miss_dict):
@@ -114,13 +119,17 @@ def subset_wrapper(supplierIds, full_dict, tilepath, tifpath, name, size, pbar,s
             if int(count) in image_nums:
                 continue
             filename = "%.5d_%s_%s_%s" % (count, confidence, supplierId, name)
-            one_subset(supplierId, filename, polygon, tilepath, tifpath, size,sentinel)
+            with metrics.run.timed("subset") as timer:
+                one_subset(supplierId, filename, polygon, tilepath, tifpath, size,sentinel)
+                tif = os.path.join(tifpath, filename + ".tif")
+                if os.path.exists(tif):
+                    timer.bytes_written = os.path.getsize(tif)
 
 
     return
 
 
-def create_subsets(full_dict, tile_path, tif_path, name, size, threads=1,sentinel=2):
+def create_subsets(full_dict, tile_path, tif_path, name, size, threads=1,sentinel=2, gpt_batch=GPT_BATCH_SIZE):
     """
     Converts full Sentinel tiles into tifs of hits and misses of the right size
 
@@ -130,6 +139,7 @@ def create_subsets(full_dict, tile_path, tif_path, name, size, threads=1,sentine
     :param tif_path: path where all the tifs will be stored
     :param size: size of each tif in pixels
     :param threads: Number of threads
+    :param gpt_batch: Number of Sentinel 1 polygons subsetted by each gpt process
     """
 
     threads=1
@@ -139,6 +149,7 @@ def create_subsets(full_dict, tile_path, tif_path, name, size, threads=1,sentine
     full_dict_len = sum([len(full_dict[x]) for x in full_dict.keys()])
     # Creates progress bar to monitor progress
     pbar = tqdm(total=full_dict_len, desc="Subsetting tiles", unit="image")
+    metrics.run.stage("subset", workers=threads)
 
     subset_threads = []
     for t in range(threads):
@@ -150,7 +161,7 @@ def create_subsets(full_dict, tile_path, tif_path, name, size, threads=1,sentine
 
         # Starts threading for bla
         if sentinel==1:
-            subset_threads.append(threading.Thread(target=rungpt, args=(arr, full_dict, tile_path, tif_path, pbar, size)))
+            subset_threads.append(threading.Thread(target=rungpt, args=(arr, full_dict, tile_path, tif_path, pbar, size, gpt_batch)))
         else:
             subset_threads.append(
                 threading.Thread(target=subset_wrapper, args=(arr, full_dict, tile_path, tif_path, name, size, pbar,sentinel)))
@@ -164,13 +175,16 @@ def create_subsets(full_dict, tile_path, tif_path, name, size, threads=1,sentine
     pbar.close()
     return
 
-def rungpt(supplierIds, full_dict, tilepath, tifpath, pbar, size):
+def rungpt(supplierIds, full_dict, tilepath, tifpath, pbar, size, batch_size=GPT_BATCH_SIZE):
     """
-    Runs SNAP gpt command to resample and bla the a Sentinel tile
+    Runs SNAP gpt command to resample and bla the a Sentinel tile. The polygons of each tile are run in batches of one
+    graph that reads the tile once and has a Subset, Convert-Datatype and Write branch for each polygon, so neither the
+    JVM start up nor the read of the tile is paid for every polygon
     :param supplierIds: list of supplierIds of Sentinel tiles
     :param full_dict: dictionary containing the polygons that will be subsetted in each tile
     :param tilepath: directory path to the Sentinel tiles
     :param tifpath: directory path to where tif files will be stored
+    :param batch_size: number of polygons subsetted by each gpt process
     """
 
     # Stores all subsets that fails
@@ -181,32 +195,41 @@ def rungpt(supplierIds, full_dict, tilepath, tifpath, pbar, size):
     tiffiles = [file for file in tif_folder if file.endswith(".tif")]
     image_nums = [file.split("_")[0] for file in tiffiles]
 
-    for supplierId in supplierIds:
-        #print(supplierId)
-
-        for count, polygon, confidence in full_dict[supplierId]:
-            if str(count) in image_nums:
-                print('Already downloaded. Continuing...')
-                continue
-            #print(polygon.envelope.wkt)
-            #poly = list(polygon.exterior.coords)
-            #polygon = [(p[1],p[0] )for p in poly]
-            #polygon = shapely.geometry.Polygon(polygon)
-
-            try:
-                pbar.update(1)
-                print('Subsetting polygon %s' % count)
+    stage = metrics.run.stage("subset")
+
+    def finished(count, confidence, supplierId, submitted, future):
+        pbar.update(1)
+        # If a process fails, it'll store the index of the bla where the failure occurred.
+        if future.exception() is not None:
+            print(future.exception())
+            print('Error with Polygon %s - category %s' % (count, confidence))
+            errorlist.append(count)
+            stage.record(time.perf_counter() - submitted, error=True)
+            return
+        tif = os.path.join(tifpath, "%s_%s_%s.tif" % (str(count).zfill(5), confidence, supplierId))
+        stage.record(time.perf_counter() - submitted, bytes_written=os.path.getsize(tif) if os.path.exists(tif) else 0)
+
+    with GptPool(batch_size=batch_size) as pool:
+        for supplierId in supplierIds:
+            polygons = []
+            for count, polygon, confidence in full_dict[supplierId]:
+                if str(count) in image_nums:
+                    print('Already downloaded. Continuing...')
+                    continue
+                polygons.append((count, polygon, confidence))
+
+            # Each batch stays within one tile so the tile is only read once per batch
+            for start in range(0, len(polygons), max(1, batch_size)):
+                batch = polygons[start:start + max(1, batch_size)]
+                print('Subsetting polygons %s' % ', '.join([str(count) for count, _, _ in batch]))
                 # Runs a SNAP graph to resample to 10m resolution, bla to the geography, and to finally bla to a pixel of square length size
-                gpt(
-                    r'./subset/graphs/subset_and_convert.xml',
-                    {'count': str(count).zfill(5), 'confidence': confidence, 'polygon': polygon.envelope.wkt,
-                     'supplierId': supplierId,
-                     'tilepath': os.path.abspath(tilepath), 'tifpath': tifpath, 'size': size})
-
-            # If a process fails, it'll store the index of the bla where the failure occurred.
-            except Exception as e:
-                print(e)
-                print('Error with Polygon %s - category %s' % (count, confidence))
-                errorlist.append(count)
-                continue
+                futures = pool.submit_batch([
+                    (r'./subset/graphs/subset_and_convert.xml',
+                     {'count': str(count).zfill(5), 'confidence': confidence, 'polygon': polygon.envelope.wkt,
+                      'supplierId': supplierId,
+                      'tilepath': os.path.abspath(tilepath), 'tifpath': tifpath, 'size': size})
+                    for count, polygon, confidence in batch])
+                submitted = time.perf_counter()
+                for (count, polygon, confidence), future in zip(batch, futures):
+                    future.add_done_callback(partial(finished, count, confidence, supplierId, submitted))
     print(errorlist)
\ No newline at end of file
@@ -0,0 +1,206 @@
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+from bin import metrics
+
+# Size assumed for a tile before any tile has been downloaded and measured
+DEFAULT_TILE_BYTES = 1024 ** 3
+
+
+def path_size(path):
+    """
+    Finds the number of bytes a file or directory takes up on disk
+
+    :param path: path to a file or directory
+    :return: size in bytes
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            total += os.path.getsize(os.path.join(root, file))
+    return total
+
+
+class TileCache(object):
+    """
+    Keeps the Sentinel tiles in tilepath within a disk budget. Tiles that are pinned by a stage that is using them are
+    never removed. Tiles that this run has processed and have no pending subsets left are removed first, then the least
+    recently used tiles that can be downloaded again on demand. A tile that can not be downloaded again is never removed
+    before it has been processed. Other files in tilepath count towards the budget but are never removed.
+    """
+
+    def __init__(self, tilepath, budget, downloads):
+        """
+        :param tilepath: path where Sentinel tiles are stored
+        :param budget: number of bytes the tiles may take up
+        :param downloads: dictionary of supplierIds to functions that download the tile into tilepath
+        """
+        self.tilepath = tilepath
+        self.budget = budget
+        self.downloads = downloads
+        self.condition = threading.Condition()
+        self.sizes = OrderedDict()  # supplierId -> bytes on disk, least recently used first
+        self.pins = {}
+        self.pending = {}
+        # Tiles whose subsets have been counted with add_pending
+        self.processed = set()
+        self.loading = set()
+        self.reserved = 0
+
+        # Tiles downloaded before this run count towards the budget too
+        if os.path.isdir(tilepath):
+            for file in sorted(os.listdir(tilepath)):
+                supplierId = os.path.splitext(file)[0]
+                self.sizes[supplierId] = self.sizes.get(supplierId, 0) + path_size(os.path.join(tilepath, file))
+
+    def used(self):
+        return sum(self.sizes.values()) + self.reserved
+
+    def add_pending(self, supplierId, count):
+        """
+        Records that a tile has more subsets to be made from it
+
+        :param supplierId: supplier ID of the Sentinel tile
+        :param count: number of subsets
+        :return: none
+        """
+        with self.condition:
+            self.processed.add(supplierId)
+            self.pending[supplierId] = self.pending.get(supplierId, 0) + count
+
+    def complete(self, supplierId, count=1):
+        """
+        Records that subsets of a tile have been made
+
+        :param supplierId: supplier ID of the Sentinel tile
+        :param count: number of subsets
+        :return: none
+        """
+        with self.condition:
+            self.pending[supplierId] = max(self.pending.get(supplierId, 0) - count, 0)
+            self.condition.notify_all()
+
+    def acquire(self, supplierId):
+        """
+        Makes sure a tile is on disk, downloading it if needed, and pins it so it will not be removed until released.
+        Waits while the budget is full and the only tiles that could make room are pinned.
+
+        :param supplierId: supplier ID of the Sentinel tile
+        :return: none
+        """
+        with self.condition:
+            while supplierId in self.loading:
+                self.condition.wait()
+            self.pins[supplierId] = self.pins.get(supplierId, 0) + 1
+            if supplierId in self.sizes:
+                self.sizes.move_to_end(supplierId)
+                return
+
+            while True:
+                # The condition is let go while waiting or removing a tile, so another thread may have got it meanwhile
+                if supplierId in self.loading:
+                    self.condition.wait()
+                    continue
+                if supplierId in self.sizes:
+                    self.sizes.move_to_end(supplierId)
+                    return
+                estimate = self._estimate()
+                if self.used() + estimate <= self.budget:
+                    break
+                if self._evict_one():
+                    continue
+                if not any(self.pins.get(other) for other in self.sizes) and not self.loading:
+                    logging.warning("Tile %s does not fit in the disk budget. Downloading anyway" % supplierId)
+                    break
+                self.condition.wait()
+            self.loading.add(supplierId)
+            self.reserved += estimate
+
+        try:
+            if supplierId not in self.downloads:
+                raise FileNotFoundError("Tile %s is not on disk and can not be downloaded" % supplierId)
+            logging.debug("Downloading tile %s" % supplierId)
+            self.downloads[supplierId]()
+            size = sum([path_size(path) for path in self._paths(supplierId) if os.path.exists(path)])
+        except Exception:
+            with self.condition:
+                self.loading.discard(supplierId)
+                self.reserved -= estimate
+                self.pins[supplierId] -= 1
+                self.condition.notify_all()
+            raise
+
+        metrics.run.stage("download").add_bytes(bytes_written=size)
+
+        # Swap the reservation for the real size in one step so the tile is always counted
+        with self.condition:
+            self.loading.discard(supplierId)
+            self.reserved -= estimate
+            self.sizes[supplierId] = size
+            self.condition.notify_all()
+
+    def release(self, supplierId):
+        """
+        Unpins a tile so it can be removed once space is needed
+
+        :param supplierId: supplier ID of the Sentinel tile
+        :return: none
+        """
+        with self.condition:
+            self.pins[supplierId] = max(self.pins.get(supplierId, 0) - 1, 0)
+            self.condition.notify_all()
+
+    def _estimate(self):
+        if self.sizes:
+            return int(sum(self.sizes.values()) / len(self.sizes))
+        return DEFAULT_TILE_BYTES
+
+    def _paths(self, supplierId):
+        base = os.path.join(self.tilepath, supplierId)
+        return [base, base + '.zip', base + '.SAFE']
+
+    def _evict_one(self):
+        """
+        Removes one unpinned tile. Must be called with the condition held. The condition is let go while the files are
+        deleted, and the tile is marked as loading so nothing uses it until they are gone.
+
+        :return: True if a tile was removed
+        """
+        unpinned = [s for s in self.sizes if not self.pins.get(s)]
+        consumed = [s for s in unpinned if s in self.processed and not self.pending.get(s)]
+        # Tiles that are still needed are only removed if they can be downloaded again
+        reloadable = [s for s in unpinned if s in self.downloads]
+        candidates = consumed or reloadable
+        if not candidates:
+            return False
+
+        supplierId = candidates[0]
+        # Keep counting the tile until its files are deleted
+        size = self.sizes.pop(supplierId)
+        self.reserved += size
+        self.loading.add(supplierId)
+        self.condition.release()
+        try:
+            self._remove(supplierId)
+        finally:
+            self.condition.acquire()
+            self.loading.discard(supplierId)
+            self.reserved -= size
+            self.condition.notify_all()
+        return True
+
+    def _remove(self, supplierId):
+        logging.debug("Removing tile %s to stay within the disk budget" % supplierId)
+        for path in self._paths(supplierId):
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                elif os.path.exists(path):
+                    os.remove(path)
+            except OSError as e:
+                logging.warning("Could not remove %s: %s" % (path, e))
@@ -1,12 +1,15 @@
-import gzip
 import logging
 import os
 import platform
 import shutil
 import subprocess
-from asynchronousfilereader import AsynchronousFileReader
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
-from zipfile import ZipFile
+from zipfile import BadZipFile, ZipFile
+
+from .. import get_config
+from ..utils import compression, snap_utils
 
 """
 This contains the generic steps of a processing pipeline.
@@ -14,7 +17,6 @@ This contains the generic steps of a processing pipeline.
 How to run a snap graph, remove a file, etc.
 """
 
-
 class ProcessError(Exception):
     """
     An error type for problems with processing the data.
@@ -22,35 +24,122 @@ class ProcessError(Exception):
     pass
 
 
-def process_chain(process, name):
+class Step:
+    """
+    A processing step that only has to wait for some of the steps before it.
+
+    Plain callables in a chain wait for every step before them. Wrapping a callable in a Step with a list of keys lets
+    it start as soon as the earlier steps with those keys are done, so independent steps can run at the same time.
+    Several steps can share a key, in which case depending on the key waits for all of them.
+    """
+
+    def __init__(self, key, action, depends_on=None):
+        """
+        :param key: name other steps can use to depend on this one.
+        :param action: the callable that does the work.
+        :param depends_on: list of keys of earlier steps this step needs. None waits for every earlier step.
+        """
+        self.key = key
+        self.action = action
+        self.depends_on = depends_on
+
+    def __call__(self):
+        return self.action()
+
+
+def _dependencies(flattened):
+    """
+    Work out the indexes of the steps each step in a flattened chain has to wait for.
+
+    Steps can only depend on steps before them in the chain so the result is always free of cycles and running the
+    chain in order is always valid.
+
+    :param flattened: the flattened chain
+    :return: list of sets of step indexes
+    """
+    result = []
+    for i, step in enumerate(flattened):
+        depends_on = step.depends_on if isinstance(step, Step) else None
+        if depends_on is None:
+            result.append(set(range(i)))
+            continue
+
+        needs = set()
+        for key in depends_on:
+            matches = [j for j in range(i) if isinstance(flattened[j], Step) and flattened[j].key == key]
+            if not matches:
+                raise ProcessError(f"Step {i + 1} depends on {key} which is not an earlier step in the chain")
+            needs.update(matches)
+        result.append(needs)
+    return result
+
+
+def process_chain(process, name, parallelism=1):
     """
     Execute a series of processing steps.
 
+    Steps run as soon as the steps they depend on have completed, up to parallelism at a time. With the default of one
+    the steps run one after another in the order of the chain.
+
     :param process: The list of things to process. if any return False processing will stop.
     :param name: The name of this process. Used for making the logging clearer.
+    :param parallelism: The maximum number of steps to run at once.
     :return: Nothing.
     """
 
     # flatten the process list first. It is very easy to end up with lists in the process list when building it up.
     # To make things more user friendly we flatten the list out depth first.
     flattened = flatten_list(process)
+    dependencies = _dependencies(flattened)
 
     logging.warning(f"Processing {name} started.")
     start_time = datetime.now()
-    for i, step in enumerate(flattened):
+
+    def run_step(i):
         logging.warning(f"Processing step {i + 1} of {len(flattened)}")
         step_start_time = datetime.now()
         try:
-            step()
+            flattened[i]()
         except ProcessError as e:
             step_stop_time = datetime.now()
             logging.error(
                 f"Processing failed on step {i + 1} of {len(flattened)} after {step_stop_time - step_start_time} {e}"
             )
-            raise ProcessError(f"Could not process chain {name}", e)
+            raise
         step_stop_time = datetime.now()
         logging.warning(f"completed step {i + 1} in {step_stop_time - step_start_time}")
 
+    waiting = list(range(len(flattened)))
+    done = set()
+    running = {}
+    failure = None
+    with ThreadPoolExecutor(max_workers=max(1, parallelism)) as executor:
+        while waiting or running:
+            # start everything that is ready, in chain order, unless something has already failed
+            if failure is None:
+                for i in [i for i in waiting if dependencies[i] <= done]:
+                    if len(running) >= max(1, parallelism):
+                        break
+                    waiting.remove(i)
+                    running[executor.submit(run_step, i)] = i
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = running.pop(future)
+                if future.exception() is not None:
+                    # let the steps that are already running finish but do not start any more
+                    failure = failure or future.exception()
+                else:
+                    done.add(i)
+
+    if failure is not None:
+        if isinstance(failure, ProcessError):
+            raise ProcessError(f"Could not process chain {name}", failure)
+        raise failure
+
     logging.warning(f"Processing {name} ended. Duration: {datetime.now() - start_time}")
 
 
@@ -160,32 +249,95 @@ def delete_dim(name):
     return True
 
 
-def unzip_product(file, destination):
+def _needed_member(name, polarisations):
+    """
+    Decide if a file in a SAFE product zip is needed for processing.
+
+    The preview folder is only for people to look at. Measurement and annotation files are only needed for the
+    polarisations being processed. Everything else, such as the manifest, is always kept.
+
+    :param name: the name of the file in the zip
+    :param polarisations: list of polarisations to keep, or None for all of them
+    :return: True if the file should be extracted
+    """
+    parts = name.lower().split("/")
+    if "preview" in parts[:-1]:
+        return False
+    if polarisations is not None and ("measurement" in parts or "annotation" in parts):
+        # names are like s1a-iw1-slc-vh-20170502t231339-... and calibration-s1a-iw1-slc-vh-...
+        tokens = parts[-1].split("-")
+        file_polarisations = [t for t in tokens if t in ["vv", "vh", "hh", "hv"]]
+        if file_polarisations and not set(file_polarisations) & set(p.lower() for p in polarisations):
+            return False
+    return True
+
+
+def unzip_product(file, destination, polarisations=None, threads=None):
     """
-    Unzip the target file using the python unzip utility.
+    Unzip the files of a product that processing needs, several at a time.
 
-    If the expected target product already exists it will skip unzipping the file again.
+    Preview files and the files of polarisations that are not wanted are left in the zip. Files that have already been
+    unzipped are skipped, so an earlier unzip of some polarisations can be added to later.
 
     :param file: the target file to unzip
     :param destination: where the file should be unzipped
+    :param polarisations: list of polarisations to unzip, or None for all of them
+    :param threads: how many files to unzip at once. Defaults to the number of cores
     :return: None
     """
-    product_id = os.path.basename(file)
-    if product_id.endswith(".zip"):
-        product_id = product_id[:-4] + ".SAFE"
+    try:
+        with ZipFile(file, 'r') as zipObj:
+            needed = [m for m in zipObj.infolist() if _needed_member(m.filename, polarisations)]
+    except FileNotFoundError as e:
+        logging.critical(e)
+        raise ProcessError(f"File {file} could not be found")
+    members = [m for m in needed if not m.is_dir()]
 
-    expected = os.path.join(destination, product_id)
-    if os.path.exists(expected) and os.path.isdir(expected):
+    missing = [m for m in members if not _already_extracted(m, destination)]
+    if not missing:
         logging.warning(f"Skipping unzip of {file} as it already appears to be in {destination}.")
-        logging.warning(f"If this is incorrect manually remove directory {expected}")
-    else:
-        logging.info(f"Unzipping {file} to {destination}")
-        with ZipFile(file, 'r') as zipObj:
-            zipObj.extractall(path=destination)
+        logging.warning(f"If this is incorrect manually remove the product directory from {destination}")
+        return True
+
+    logging.info(f"Unzipping {len(missing)} of {len(members)} needed files from {file} to {destination}")
+
+    # ZipFile.extract makes the folders a file goes in without checking if another thread just has, so make them first
+    folders = set(os.path.dirname(os.path.join(destination, *m.filename.split("/"))) for m in missing)
+    folders.update(os.path.join(destination, *m.filename.split("/")) for m in needed if m.is_dir())
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
+
+    # a ZipFile can not be read from several threads at once so each thread opens its own
+    local = threading.local()
+    opened = []
+    opened_lock = threading.Lock()
+
+    def extract(member):
+        if not hasattr(local, "zip"):
+            local.zip = ZipFile(file, 'r')
+            with opened_lock:
+                opened.append(local.zip)
+        local.zip.extract(member, path=destination)
+
+    try:
+        with ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as executor:
+            # the biggest files first so they are not left running on their own at the end
+            list(executor.map(extract, sorted(missing, key=lambda m: -m.file_size)))
+    except (OSError, BadZipFile) as e:
+        logging.critical(e)
+        raise ProcessError(f"File {file} could not be unzipped to {destination}. {e}")
+    finally:
+        for zip_file in opened:
+            zip_file.close()
 
     return True
 
 
+def _already_extracted(member, destination):
+    target = os.path.join(destination, *member.filename.split("/"))
+    return os.path.isfile(target) and os.path.getsize(target) == member.file_size
+
+
 def convert_to_tif(source, target):
     """
     A common specialisation of the gpt call to convert an input to GeoTIFF.
@@ -198,41 +350,63 @@ def convert_to_tif(source, target):
     _run_snap_command(["Write", f"-Pfile={target}", "-PformatName=GeoTIFF", f"-Ssource={source}"])
 
 
-def gzip_file(source, target):
+def gzip_file(source, target, threads=None):
     """
-    Gzip a file
+    Gzip a file, compressing blocks of it on several threads at once.
 
     :param source: path to the file to gzip
     :param target: path to put the results
+    :param threads: number of threads to compress with. Defaults to the number of cores
     :return: None
     """
     try:
         logging.info(f"GZip compressing {source} to {target}")
-        with open(source, 'rb') as f_in:
-            with gzip.open(target, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
+        compression.gzip_file(source, target, threads)
     except FileNotFoundError as e:
         logging.critical(e)
         raise ProcessError(f"File {source} could not be found")
 
 
+def gpt_executable():
+    """
+    The gpt executable to run snap graphs with.
+
+    The one in the snap install given by path in the Snap section of the config, unless the SNAP_GPT environment
+    variable is set.
+
+    :return: path to the gpt executable
+    """
+    return os.environ.get("SNAP_GPT") or snap_utils.gpt_path()
+
+
+def _forward_output(stream, log, prefix=""):
+    """
+    Pass each line of a snap output stream on to a logger. Blocks on the stream until snap closes it.
+
+    :param stream: the stdout or stderr pipe of the snap process
+    :param log: the logger to write to
+    :param prefix: text to put on the front of each line
+    :return: None
+    """
+    with stream:
+        for line in iter(stream.readline, b''):
+            log.info(prefix + line.decode(errors="replace").rstrip('\r\n'))
+
+
 def _run_snap_command(command):
     """
     Run a snap command. Internal use.
 
+    The output of snap is read by threads that block until a line is available and the exit is waited for, so no
+    cores are used while snap is working.
+
     :param command: the list of arguments to pass to snap
     :return: None
     """
 
     # if we need to prepend the snap executable
-    full_command = [r"C:\Program Files\snap\bin\gpt.exe"] + command
-
-    '''
-    if command[0] != snap_utils.gpt_path():
-        full_command = [str(snap_utils.gpt_path())] + command
-    else:
-        full_command = command
-    '''
+    full_command = [gpt_executable()] + command
+
     # on linux there is a warning message printed by snap if this environment variable is not set.
     base_env = os.environ.copy()
     if "LD_LIBRARY_PATH" not in base_env and platform.system() != "Windows":
@@ -240,26 +414,22 @@ def _run_snap_command(command):
 
     logging.debug(f"running {full_command}")
 
-    process = subprocess.Popen(full_command, env=base_env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-    snap_logger_out = logging.getLogger("snap_stdout")
-    snap_logger_err = logging.getLogger("snap_stderr")
-    std_out_reader = AsynchronousFileReader(process.stdout)
-    std_err_reader = AsynchronousFileReader(process.stderr)
-
-    def pass_logging():
-        while not std_out_reader.queue.empty():
-            line = std_out_reader.queue.get().decode()
-            snap_logger_out.info(line.rstrip('\n'))
-        while not std_err_reader.queue.empty():
-            line = std_err_reader.queue.get().decode()
-            snap_logger_err.info("stderr:" + line.rstrip('\n'))
-
-    while process.poll() is None:
-        pass_logging()
-
-    std_out_reader.join()
-    std_err_reader.join()
+    try:
+        process = subprocess.Popen(full_command, env=base_env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise ProcessError(f"Could not start snap {full_command[0]}", e)
+
+    readers = [
+        threading.Thread(target=_forward_output, args=(process.stdout, logging.getLogger("snap_stdout"))),
+        threading.Thread(target=_forward_output, args=(process.stderr, logging.getLogger("snap_stderr"), "stderr:")),
+    ]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    process.wait()
+    for reader in readers:
+        reader.join()
 
     if process.returncode != 0:
         raise ProcessError("Snap returned non zero exit status")
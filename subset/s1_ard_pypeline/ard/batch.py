@@ -0,0 +1,261 @@
+import logging
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as et
+from concurrent.futures import Future, ThreadPoolExecutor
+from xml.sax.saxutils import escape
+
+from . import ard
+
+"""
+Run many snap graphs with a single gpt process.
+
+Starting gpt means starting a JVM and loading the snap operators, which can take longer than the work in a small
+graph. The jobs submitted here are merged into one graph with a copy of the nodes of each job, so the start up is only
+paid once per batch.
+"""
+
+# gpt fills in ${name} in a graph with the -Pname=value arguments
+VARIABLE = re.compile(r"\$\{(\w+)\}")
+
+# Put on the job queue to stop the pool
+_CLOSE = object()
+
+
+def _substitute(text, args):
+    """
+    Fill in the variables in a graph the same way gpt does with its -P arguments.
+
+    Variables that are not in args are left alone.
+
+    :param text: the text of the graph
+    :param args: a dictionary of arguments
+    :return: the graph text with the variables replaced
+    """
+    return VARIABLE.sub(lambda m: escape(str(args[m.group(1)])) if m.group(1) in args else m.group(0), text)
+
+
+def _in_source_order(nodes):
+    """
+    Order the nodes of a graph so every node comes after the nodes it reads from.
+
+    :param nodes: list of node elements
+    :return: list of node elements
+    """
+    by_id = dict((node.get("id"), node) for node in nodes)
+    ordered = []
+    seen = set()
+
+    def visit(node):
+        if node.get("id") in seen:
+            return
+        seen.add(node.get("id"))
+        for source in _sources(node):
+            if _source_id(source) in by_id:
+                visit(by_id[_source_id(source)])
+        ordered.append(node)
+
+    for node in nodes:
+        visit(node)
+    return ordered
+
+
+def _sources(node):
+    sources = node.find("sources")
+    return [] if sources is None else list(sources)
+
+
+def _source_id(source):
+    return source.get("refid") or (source.text or "").strip()
+
+
+def _set_source_id(source, node_id):
+    if source.get("refid"):
+        source.set("refid", node_id)
+    else:
+        source.text = node_id
+
+
+def merge_graphs(jobs, share_nodes=True):
+    """
+    Merge several graphs into one that does the work of all of them.
+
+    Each node is given a prefix of the index of its job so the node ids of the jobs do not clash. With share_nodes,
+    nodes that would do exactly the same work as a node of an earlier job, such as reading the same product, are left
+    out and their readers use the earlier node instead. Write nodes are never shared.
+
+    :param jobs: list of (graph path, dictionary of arguments) tuples
+    :param share_nodes: use one node for identical work in different jobs
+    :return: the text of the merged graph
+    """
+    merged = et.Element("graph", id="Graph")
+    et.SubElement(merged, "version").text = "1.0"
+    # (operator, parameters, sources) of each node in the merged graph -> its id
+    shared = {}
+
+    for index, (graph_path, args) in enumerate(jobs):
+        with open(graph_path) as f:
+            graph = et.fromstring(_substitute(f.read(), args))
+
+        prefix = f"job{index}_"
+        renamed = {}
+        for node in _in_source_order(graph.findall("node")):
+            for source in _sources(node):
+                source_id = _source_id(source)
+                _set_source_id(source, renamed.get(source_id, prefix + source_id))
+
+            operator = node.findtext("operator", "").strip()
+            parameters = node.find("parameters")
+            key = (
+                operator,
+                "" if parameters is None else et.tostring(parameters, encoding="unicode"),
+                tuple(_source_id(source) for source in _sources(node)),
+            )
+            if share_nodes and operator != "Write" and key in shared:
+                renamed[node.get("id")] = shared[key]
+                continue
+
+            renamed[node.get("id")] = prefix + node.get("id")
+            node.set("id", prefix + node.get("id"))
+            shared[key] = node.get("id")
+            merged.append(node)
+
+    return et.tostring(merged, encoding="unicode")
+
+
+def run_batch(jobs):
+    """
+    Run a list of graphs with one gpt process.
+
+    If the merged graph fails each job is run again on its own so one bad job does not fail the others.
+
+    :param jobs: list of (graph path, dictionary of arguments) tuples
+    :return: list with None for each job that worked and the error for each job that failed
+    """
+    if len(jobs) == 1:
+        try:
+            ard.gpt(*jobs[0])
+            return [None]
+        except ard.ProcessError as e:
+            return [e]
+
+    handle, merged_path = tempfile.mkstemp(suffix=".xml", prefix="gpt_batch_")
+    try:
+        with os.fdopen(handle, "w") as f:
+            f.write(merge_graphs(jobs))
+        logging.info(f"running {len(jobs)} graphs with one gpt process")
+        ard.gpt(merged_path, {})
+        return [None] * len(jobs)
+    except (ard.ProcessError, et.ParseError) as e:
+        logging.warning(f"Batch of {len(jobs)} graphs failed, running them one at a time. {e}")
+        return [errors[0] for errors in [run_batch([job]) for job in jobs]]
+    finally:
+        os.remove(merged_path)
+
+
+class GptPool:
+    """
+    Collects graph jobs into batches and runs each batch with a single gpt process.
+
+    A batch is sent off once it has batch_size jobs or no new job has arrived for linger seconds. Up to workers gpt
+    processes run at once.
+
+    Use it as a context manager so any remaining jobs are run before it is closed:
+
+        with GptPool(batch_size=16) as pool:
+            futures = [pool.submit(graph, args) for args in arg_list]
+        errors = [f.exception() for f in futures]
+    """
+
+    def __init__(self, batch_size=16, workers=1, linger=0.5):
+        """
+        :param batch_size: the most jobs to put in one gpt process
+        :param workers: how many gpt processes can run at once
+        :param linger: seconds to wait for more jobs before running a batch that is not full
+        """
+        self.batch_size = batch_size
+        self.linger = linger
+        self.jobs = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.dispatcher = threading.Thread(target=self._dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def submit(self, graph_path, args):
+        """
+        Queue up a graph to be run.
+
+        :param graph_path: path to the snap graph to process.
+        :param args: a dictionary of arguments to pass to snap.
+        :return: a Future that completes when the graph has run. Its exception is the ProcessError if it failed.
+        """
+        future = Future()
+        self.jobs.put((graph_path, args, future))
+        return future
+
+    def submit_batch(self, jobs):
+        """
+        Run a list of graphs together in one gpt process, whatever the batch size.
+
+        Use this for jobs that share work, such as subsets of the same product, so they are not split across batches.
+
+        :param jobs: list of (graph path, dictionary of arguments) tuples
+        :return: a list of Futures, one for each job
+        """
+        batch = [(graph_path, args, Future()) for graph_path, args in jobs]
+        if batch:
+            self.executor.submit(self._run, batch)
+        return [future for _, _, future in batch]
+
+    def close(self):
+        """
+        Run all the queued jobs and wait for them to finish.
+
+        :return: None
+        """
+        self.jobs.put(_CLOSE)
+        self.dispatcher.join()
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _dispatch(self):
+        closing = False
+        while not closing:
+            job = self.jobs.get()
+            if job is _CLOSE:
+                break
+
+            batch = [job]
+            deadline = time.monotonic() + self.linger
+            while len(batch) < self.batch_size:
+                try:
+                    job = self.jobs.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if job is _CLOSE:
+                    closing = True
+                    break
+                batch.append(job)
+
+            self.executor.submit(self._run, batch)
+
+    def _run(self, batch):
+        try:
+            errors = run_batch([(graph_path, args) for graph_path, args, _ in batch])
+        except Exception as e:
+            errors = [e] * len(batch)
+
+        for (_, _, future), error in zip(batch, errors):
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
@@ -0,0 +1,135 @@
+import logging
+import os
+import threading
+
+from . import ard
+
+"""
+Share intermediate products, such as the orbit corrected swaths of a product, between the chains of several pairs.
+
+A list of consecutive pairs has every product but the first and last in two pairs. The chains of both pairs ask the
+cache for the same work and only the first one does it. Each entry counts the pending users that still need it and its
+dim files are removed when the last one releases it.
+"""
+
+
+def cache_key(graph_path, args):
+    """
+    Identify a piece of snap work by its graph and arguments.
+
+    :param graph_path: path to the snap graph
+    :param args: a dictionary of arguments passed to snap, which name the products read and written
+    :return: a hashable key
+    """
+    return graph_path, tuple(sorted((k, str(v)) for k, v in args.items()))
+
+
+class _Entry:
+
+    def __init__(self, outputs):
+        self.outputs = list(outputs)
+        self.refs = 0
+        self.done = False
+        self.lock = threading.Lock()
+
+
+class ProductCache:
+    """
+    Reference counted cache of intermediate products.
+
+    Call retain once for each pending user of a piece of work before any of them run, produce when the work is needed
+    and release when a user is done with it:
+
+        cache = ProductCache()
+        for chain in chains:
+            cache.retain_all(chain.cache_keys())
+        ...
+        cache.produce(key, outputs, lambda: ard.gpt(graph, args))
+        ...
+        cache.release(key)
+    """
+
+    def __init__(self, clean=True):
+        """
+        :param clean: should the outputs of an entry be deleted once no user needs them
+        """
+        self.clean = clean
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def _entry(self, key, outputs=()):
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = _Entry(outputs)
+            elif outputs and not self.entries[key].outputs:
+                self.entries[key].outputs = list(outputs)
+            return self.entries[key]
+
+    def retain(self, key):
+        """
+        Add a pending user of a piece of work.
+
+        :param key: the cache_key of the work
+        :return: None
+        """
+        entry = self._entry(key)
+        with self.lock:
+            entry.refs += 1
+
+    def retain_all(self, keys):
+        for key in keys:
+            self.retain(key)
+
+    def produce(self, key, outputs, create):
+        """
+        Make sure the outputs of a piece of work exist, doing the work only if no earlier user has done it.
+
+        :param key: the cache_key of the work
+        :param outputs: list of the paths the work writes
+        :param create: function that does the work
+        :return: True if the work was done, False if the cached outputs were used
+        """
+        entry = self._entry(key, outputs)
+        with entry.lock:
+            if entry.done and all(os.path.exists(o) for o in entry.outputs):
+                logging.info(f"using cached {', '.join(entry.outputs)}")
+                return False
+            create()
+            entry.done = True
+            return True
+
+    def release(self, key):
+        """
+        Say a user is done with a piece of work. Its outputs are removed once no pending user needs them.
+
+        :param key: the cache_key of the work
+        :return: None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry.refs -= 1
+            if entry.refs > 0:
+                return
+            del self.entries[key]
+
+        with entry.lock:
+            if not self.clean:
+                return
+            for output in entry.outputs:
+                if os.path.exists(output):
+                    ard.delete_dim(output)
+
+    def release_all(self, keys):
+        for key in keys:
+            self.release(key)
+
+    def refs(self, key):
+        """
+        :param key: the cache_key of the work
+        :return: how many pending users the work has
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            return 0 if entry is None else entry.refs
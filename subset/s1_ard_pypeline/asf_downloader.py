@@ -16,6 +16,13 @@
 #
 #    If downloading from a trusted source with invalid SSL Certs, use --insecure to ignore
 #
+#    To download several files at once, streaming each straight into S3, use --threads=N
+#
+#    Downloads that are cut off are picked up again from where they stopped. One at a time they are kept as .part files
+#    in the current directory, so the next run can resume them too. With --threads=N they are resumed into the same
+#    upload by the same run, and start again from the beginning next run.
+#    Files listed in a Metalink are checked against its md5 before they are uploaded.
+#
 #    For more information on bulk downloads, navigate to:
 #        https://www.asf.alaska.edu/data-tools/bulk-download/
 #
@@ -29,13 +36,16 @@
 import base64
 import csv
 import getpass
+import hashlib
+import json
 import os
 import os.path
 import re
 import signal
+import socket
 import ssl
 import sys
-import tempfile
+import threading
 import time
 import xml.etree.ElementTree as ET
 
@@ -60,11 +70,25 @@ except ImportError as e:
     from http.cookiejar import MozillaCookieJar
     from io import StringIO
 
+    from concurrent.futures import ThreadPoolExecutor
+    from http.client import HTTPException
+
     from s1_ard_pypeline.utils import s3_utils
 ##
 # Global variables intended for cross-thread modification
 abort = False
 
+# Bytes read from the archive at a time when downloading several files at once
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Errors that mean the connection to the archive broke part way through a download, rather than the url being bad
+INTERRUPTIONS = (URLError, HTTPException, ConnectionError, socket.timeout)
+
+# Part size and number of parts uploaded at once when a download is streamed into S3. Together they bound the memory
+# used by each download to roughly (2 * UPLOAD_CONCURRENCY + 1) * UPLOAD_PART_SIZE
+UPLOAD_PART_SIZE = 16 * 1024 * 1024
+UPLOAD_CONCURRENCY = 2
+
 
 ###
 # A routine that handles trapped signals
@@ -80,9 +104,13 @@ class bulk_downloader(object):
         # List of files to download
         self.files = []
         self.existing_s3_files = []
+        # md5 of each url, from the metalink files
+        self.checksums = {}
 
         self.s3client = s3_utils.S3Utils()
         self.s3prefix = "iipcom/download"
+        # what is already in S3, listed once rather than once for each file when there are many of them
+        self.s3manifest = self.s3client.manifest(self.s3prefix)
 
         # Local stash of cookies so we don't always have to ask
         self.cookie_jar_path = os.path.join(os.path.expanduser('~'), ".bulk_download_cookiejar.txt")
@@ -100,6 +128,13 @@ class bulk_downloader(object):
         # For SSL
         self.context = {}
 
+        # How many files to download at once
+        self.threads = 1
+
+        # Unfinished downloads are kept here so they can be resumed, by this run or the next one
+        self.partial_dir = os.getcwd()
+        self.resumes = 3
+
         # Check if user handed in a Metalink or CSV:
         download_files = []
         input_files = []
@@ -114,6 +149,12 @@ class bulk_downloader(object):
                     # Python 2.6 won't complain about SSL Validation
                     pass
 
+            elif arg.startswith('--threads='):
+                try:
+                    self.threads = max(1, int(arg.split('=', 1)[1]))
+                except ValueError:
+                    print(" > Could not read the number of threads from '{0}', ignoring.".format(arg))
+
             elif arg.endswith('.metalink') or arg.endswith('.csv'):
                 if os.path.isfile(arg):
                     input_files.append(arg)
@@ -144,9 +185,15 @@ class bulk_downloader(object):
         # Make sure cookie_jar is good to go!
         self.get_cookie()
 
+        # One opener for every download, so new cookies picked up by one thread are used by all of them
+        self.opener = build_opener(HTTPCookieProcessor(self.cookie_jar), HTTPHandler(), HTTPSHandler(**self.context))
+        self.cookie_lock = threading.Lock()
+
         # summary
+        self.lock = threading.Lock()
         self.total_bytes = 0
         self.total_time = 0
+        self.wall_time = 0
         self.cnt = 0
         self.success = []
         self.failed = []
@@ -300,84 +347,209 @@ class bulk_downloader(object):
 
         return False
 
+    # Is a key already in S3? A few files are checked with a HEAD request each, many against one listing of the prefix
+    def in_s3(self, key):
+        if len(self.files) <= s3_utils.HEAD_CHECK_LIMIT:
+            return self.s3client.exists(key)
+        return key in self.s3manifest
+
     # Download the file
-    def download_file_with_cookiejar(self, url, file_count, total, recursion=False):
+    def download_file_with_cookiejar(self, url, file_count, total, recursion=False, resumes=0):
         # see if we've already download this file and if it is that it is the correct size
 
         download_file = os.path.basename(url).split('?')[0]
 
         #  Is the file already in S3?
-        if self.s3client.list_files(f"{self.s3prefix}/{download_file}"):
+        if self.in_s3(f"{self.s3prefix}/{download_file}"):
             print(f"{self.s3prefix}/{download_file} already in S3, skipping.")
             return None, None
 
+        # pick up whatever an earlier, interrupted attempt left behind
+        part_path, state_path = self.partial_paths(url)
+        received, file_size = self.load_partial(url, part_path, state_path)
+
         # attempt https connection
         try:
-            request = Request(url)
-            response = urlopen(request, timeout=30)
+            if file_size is not None and received == file_size:
+                print(" > {0} was downloaded by an earlier run, it just needs uploading".format(download_file))
+            else:
+                request = Request(url)
+                if received > 0:
+                    request.add_header("Range", "bytes={0}-".format(received))
+                response = self.opener.open(request, timeout=30)
+
+                # Watch for redirect
+                if response.geturl() != url:
+
+                    # See if we were redirect BACK to URS for re-auth.
+                    if 'https://urs.earthdata.nasa.gov/oauth/authorize' in response.geturl():
+
+                        if recursion:
+                            print(" > Entering seemingly endless auth loop. Aborting. ")
+                            return False, None
+
+                        if not self.renew_cookie(url, response.geturl()):
+                            return False, None
+
+                        # Okay, now we have more cookies! Lets try again, recursively!
+                        print(" > Attempting download again with new cookies!")
+                        return self.download_file_with_cookiejar(url, file_count, total, recursion=True,
+                                                                 resumes=resumes)
+
+                    print(" > 'Temporary' Redirect download @ Remote archive:\n > {0}".format(response.geturl()))
+
+                total_size = self.get_range_total(response)
+                if received > 0 and response.getcode() == 206 and file_size not in (None, total_size):
+                    # The file has changed since the earlier attempt, so what we have of it is no use
+                    print(" > {0} has changed since it was partly downloaded, starting again".format(download_file))
+                    response.close()
+                    self.remove_partial(part_path, state_path)
+                    return self.download_file_with_cookiejar(url, file_count, total, recursion=recursion,
+                                                             resumes=resumes)
+                elif received > 0 and response.getcode() != 206:
+                    print(" > Remote archive can not resume {0}, starting again".format(download_file))
+                    received = 0
+                elif received > 0:
+                    print(" > Resuming {0} from byte {1}".format(download_file, received))
+                file_size = total_size
+                self.save_partial(url, state_path, file_size)
+
+                # seems to be working
+                print("({0}/{1}) Downloading {2}".format(file_count, total, url))
+
+                # Open our local file for writing and build status bar
+                with open(part_path, 'ab' if received > 0 else 'wb') as local_file:
+                    self.chunk_read(response, local_file, report_hook=self.chunk_report, start=received)
+
+                # Reset download status
+                sys.stdout.write('\n')
+
+                # The connection dropped part way through, carry on from where it stopped
+                actual_size = os.path.getsize(part_path)
+                if file_size is not None and actual_size < file_size:
+                    if actual_size > received and resumes < self.resumes:
+                        return self.download_file_with_cookiejar(url, file_count, total, recursion=recursion,
+                                                                 resumes=resumes + 1)
+                    print(" > Only got {0} of {1} bytes of {2}, it will be resumed next time".format(
+                        actual_size, file_size, download_file))
+                    return False, None
+
+            if not self.verify_checksum(url, part_path):
+                self.remove_partial(part_path, state_path)
+                return False, None
+
+            # Upload the finished file to S3 here
+            self.s3client.put_file(part_path, f"{self.s3prefix}/{download_file}")
 
-            # Watch for redirect
-            if response.geturl() != url:
+        # handle errors
+        except (URLError, ssl.CertificateError) as e:
+            self.print_download_error(e, url)
+            return False, None
 
-                # See if we were redirect BACK to URS for re-auth.
-                if 'https://urs.earthdata.nasa.gov/oauth/authorize' in response.geturl():
+        # Return the file size
+        actual_size = os.path.getsize(part_path)
+        if file_size is None:
+            # We were unable to calculate file size.
+            file_size = actual_size
 
-                    if recursion:
-                        print(" > Entering seemingly endless auth loop. Aborting. ")
-                        return False, None
+        self.remove_partial(part_path, state_path)
+        return actual_size, file_size
 
-                    # make this easier. If there is no app_type=401, add it
-                    new_auth_url = response.geturl()
-                    if "app_type" not in new_auth_url:
-                        new_auth_url += "&app_type=401"
-
-                    print(" > While attempting to download {0}....".format(url))
-                    print(" > Need to obtain new cookie from {0}".format(new_auth_url))
-                    old_cookies = [cookie.name for cookie in self.cookie_jar]
-                    opener = build_opener(HTTPCookieProcessor(self.cookie_jar), HTTPHandler(),
-                                          HTTPSHandler(**self.context))
-                    request = Request(new_auth_url)
-                    try:
-                        response = opener.open(request)
-                        for cookie in self.cookie_jar:
-                            if cookie.name not in old_cookies:
-                                print(" > Saved new cookie: {0}".format(cookie.name))
-
-                                # A little hack to save session cookies
-                                if cookie.discard:
-                                    cookie.expires = int(time.time()) + 60 * 60 * 24 * 30
-                                    print(" > Saving session Cookie that should have been discarded! ")
-
-                        self.cookie_jar.save(self.cookie_jar_path, ignore_discard=True, ignore_expires=True)
-                    except HTTPError as e:
-                        print("HTTP Error: {0}, {1}".format(e.code, url))
-                        return False, None
+    # Where a download is kept until it is complete, along with the state needed to resume it. Named after the url
+    # so a later run picks up the same file
+    def partial_paths(self, url):
+        download_file = os.path.basename(url).split('?')[0]
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+        part_path = os.path.join(self.partial_dir, "{0}.{1}.part".format(download_file, key))
+        return part_path, part_path + ".json"
 
-                    # Okay, now we have more cookies! Lets try again, recursively!
-                    print(" > Attempting download again with new cookies!")
-                    return self.download_file_with_cookiejar(url, file_count, total, recursion=True)
+    # How much of a download an earlier attempt got and how big the whole file is. Anything that does not add up is
+    # thrown away
+    def load_partial(self, url, part_path, state_path):
+        if not os.path.isfile(part_path) or not os.path.isfile(state_path):
+            self.remove_partial(part_path, state_path)
+            return 0, None
 
-                print(" > 'Temporary' Redirect download @ Remote archive:\n > {0}".format(response.geturl()))
+        try:
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+        except ValueError:
+            state = {}
+
+        received = os.path.getsize(part_path)
+        if state.get('url') != url or (state.get('size') is not None and received > state['size']):
+            self.remove_partial(part_path, state_path)
+            return 0, None
+
+        return received, state.get('size')
+
+    def save_partial(self, url, state_path, file_size):
+        with open(state_path, 'w') as f:
+            json.dump({'url': url, 'size': file_size}, f)
+
+    def remove_partial(self, part_path, state_path):
+        for path in (part_path, state_path):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    # The size of the whole file, from Content-Range when only part of it was asked for
+    def get_range_total(self, response):
+        if response.getcode() != 206:
+            return self.get_total_size(response)
+
+        content_range = response.headers.get('Content-Range') or ''
+        match = re.match(r"bytes \d+-\d+/(\d+)", content_range)
+        return int(match.group(1)) if match else None
+
+    # Check a download against the md5 listed in the metalink, if there was one
+    def verify_checksum(self, url, path):
+        expected = self.checksums.get(url)
+        if expected is None:
+            return True
 
-            # seems to be working
-            print("({0}/{1}) Downloading {2}".format(file_count, total, url))
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                md5.update(chunk)
 
-            # Open our local file for writing and build status bar
-            tf = tempfile.NamedTemporaryFile(mode='w+b', delete=False, dir='')
-            self.chunk_read(response, tf, report_hook=self.chunk_report)
+        if md5.hexdigest() != expected:
+            print(" > Checksum of {0} is {1}, expected {2}. Discarding it".format(url, md5.hexdigest(), expected))
+            return False
+        return True
 
-            # Reset download status
-            sys.stdout.write('\n')
+    # Follow a redirect back to URS to pick up new cookies for the url being downloaded
+    def renew_cookie(self, url, auth_url):
+        # make this easier. If there is no app_type=401, add it
+        new_auth_url = auth_url
+        if "app_type" not in new_auth_url:
+            new_auth_url += "&app_type=401"
 
-            tempfile_name = tf.name
-            tf.close()
+        print(" > While attempting to download {0}....".format(url))
+        print(" > Need to obtain new cookie from {0}".format(new_auth_url))
+        old_cookies = [cookie.name for cookie in self.cookie_jar]
+        opener = build_opener(HTTPCookieProcessor(self.cookie_jar), HTTPHandler(), HTTPSHandler(**self.context))
+        request = Request(new_auth_url)
+        try:
+            opener.open(request)
+            for cookie in self.cookie_jar:
+                if cookie.name not in old_cookies:
+                    print(" > Saved new cookie: {0}".format(cookie.name))
 
-            # Upload tf to S3 here
-            self.s3client.put_file(tf.name, f"{self.s3prefix}/{download_file}")
+                    # A little hack to save session cookies
+                    if cookie.discard:
+                        cookie.expires = int(time.time()) + 60 * 60 * 24 * 30
+                        print(" > Saving session Cookie that should have been discarded! ")
 
-        # handle errors
+            self.cookie_jar.save(self.cookie_jar_path, ignore_discard=True, ignore_expires=True)
         except HTTPError as e:
             print("HTTP Error: {0}, {1}".format(e.code, url))
+            return False
+
+        return True
+
+    def print_download_error(self, e, url):
+        if isinstance(e, HTTPError):
+            print("HTTP Error: {0}, {1}".format(e.code, url))
 
             if e.code == 401:
                 print(" > IMPORTANT: Your user does not have permission to download this type of data!")
@@ -386,29 +558,96 @@ class bulk_downloader(object):
                 print(" > Got a 403 Error trying to download this file.  ")
                 print(" > You MAY need to log in this app and agree to a EULA. ")
 
-            return False, None
-
-        except URLError as e:
+        elif isinstance(e, URLError):
             print("URL Error (from GET): {0}, {1}, {2}".format(e, e.reason, url))
             if "ssl.c" in "{0}".format(e.reason):
                 print(
                     "IMPORTANT: Remote location may not be accepting your SSL configuration. This is a terminal error.")
-            return False, None
 
-        except ssl.CertificateError as e:
+        else:
             print(" > ERROR: {0}".format(e))
             print(" > Could not validate SSL Cert. You may be able to overcome this using the --insecure flag")
+
+    # Stream a file straight into S3 through the shared opener, a few MB at a time. Used when downloading several
+    # files at once, so nothing is written to the local disk and the progress bar is left out.
+    def stream_file_to_s3(self, url, file_count, total, recursion=False):
+        download_file = os.path.basename(url).split('?')[0]
+        s3_key = f"{self.s3prefix}/{download_file}"
+
+        #  Is the file already in S3?
+        if self.in_s3(s3_key):
+            print(f"{s3_key} already in S3, skipping.")
+            return None, None
+
+        try:
+            response = self.opener.open(Request(url), timeout=30)
+
+            # See if we were redirect BACK to URS for re-auth.
+            if response.geturl() != url and 'https://urs.earthdata.nasa.gov/oauth/authorize' in response.geturl():
+                response.close()
+                if recursion:
+                    print(" > Entering seemingly endless auth loop. Aborting. ")
+                    return False, None
+
+                # only one thread fetches new cookies, the shared opener then uses them for every download
+                with self.cookie_lock:
+                    if not self.renew_cookie(url, response.geturl()):
+                        return False, None
+                return self.stream_file_to_s3(url, file_count, total, recursion=True)
+
+            print("({0}/{1}) Downloading {2}".format(file_count, total, url))
+            file_size = self.get_total_size(response)
+            size = 0
+            resumes = 0
+            md5 = hashlib.md5()
+            with self.s3client.open_upload(s3_key, UPLOAD_PART_SIZE, UPLOAD_CONCURRENCY) as upload:
+                while True:
+                    try:
+                        if response is None:
+                            response = self.open_range(url, size, file_size)
+                        with response:
+                            while True:
+                                chunk = response.read(CHUNK_SIZE)
+                                if not chunk:
+                                    break
+                                upload.write(chunk)
+                                md5.update(chunk)
+                                size += len(chunk)
+                    except INTERRUPTIONS as e:
+                        # the archive is there but will not give us the file, so asking again will not help
+                        if isinstance(e, HTTPError) and e.code < 500:
+                            raise
+                        print(" > Download of {0} interrupted at byte {1}: {2}".format(download_file, size, e))
+                    response = None
+
+                    # The connection dropped part way through, carry on from where it stopped into the same upload
+                    if file_size is None or size >= file_size or resumes >= self.resumes:
+                        break
+                    resumes += 1
+                    print(" > Resuming {0} from byte {1}".format(download_file, size))
+
+                # raising here aborts the upload, so a truncated or corrupt file is never left in S3
+                if file_size is not None and size != file_size:
+                    raise IOError("received {0} of {1} bytes from {2}".format(size, file_size, url))
+                if self.checksums.get(url, md5.hexdigest()) != md5.hexdigest():
+                    raise IOError("checksum of {0} is {1}, expected {2}".format(url, md5.hexdigest(),
+                                                                               self.checksums[url]))
+
+        except (URLError, ssl.CertificateError) as e:
+            self.print_download_error(e, url)
             return False, None
 
-        # Return the file size
-        file_size = self.get_total_size(response)
-        actual_size = os.path.getsize(tempfile_name)
-        if file_size is None:
-            # We were unable to calculate file size.
-            file_size = actual_size
+        return size, size if file_size is None else file_size
 
-        os.remove(tempfile_name)
-        return actual_size, file_size
+    # Open the rest of a file from byte start, making sure it is still the file of file_size bytes we started on
+    def open_range(self, url, start, file_size):
+        request = Request(url)
+        request.add_header("Range", "bytes={0}-".format(start))
+        response = self.opener.open(request, timeout=30)
+        if response.getcode() != 206 or self.get_range_total(response) != file_size:
+            response.close()
+            raise IOError("remote archive can not resume {0} from byte {1}".format(url, start))
+        return response
 
     def get_redirect_url_from_error(self, error):
         find_redirect = re.compile(r"id=\"redir_link\"\s+href=\"(\S+)\"")
@@ -432,9 +671,11 @@ class bulk_downloader(object):
             sys.stdout.write(" > Downloaded %d of unknown Size\r" % (bytes_so_far))
 
     #  chunk_read modified from http://stackoverflow.com/questions/2028517/python-urllib2-progress-hook
-    def chunk_read(self, response, local_file, chunk_size=8192, report_hook=None):
+    def chunk_read(self, response, local_file, chunk_size=8192, report_hook=None, start=0):
         file_size = self.get_total_size(response)
-        bytes_so_far = 0
+        if file_size is not None:
+            file_size += start
+        bytes_so_far = start
 
         while 1:
             try:
@@ -485,7 +726,15 @@ class bulk_downloader(object):
         dl_urls = []
         ml_files = root.find('files')
         for dl in ml_files:
-            dl_urls.append(dl.find('resources').find('url').text)
+            dl_url = dl.find('resources').find('url').text
+            dl_urls.append(dl_url)
+
+            # keep the md5 so the download can be checked
+            verification = dl.find('verification')
+            if verification is not None:
+                for dl_hash in verification.findall('hash'):
+                    if dl_hash.get('type') == 'md5' and dl_hash.text:
+                        self.checksums[dl_url] = dl_hash.text.strip().lower()
 
         if len(dl_urls) > 0:
             return dl_urls
@@ -515,35 +764,65 @@ class bulk_downloader(object):
 
     # Download all the files in the list
     def download_files(self):
-        for file_name in self.files:
+        wall_start = time.time()
+        if self.threads > 1:
+            self.download_files_concurrently()
+        else:
+            for file_name in self.files:
+
+                # make sure we haven't ctrl+c'd or some other abort trap
+                if abort == True:
+                    raise SystemExit
+
+                # download counter
+                self.cnt += 1
 
-            # make sure we haven't ctrl+c'd or some other abort trap
-            if abort == True:
-                raise SystemExit
+                # set a timer
+                start = time.time()
 
-            # download counter
-            self.cnt += 1
+                # run download
+                size, total_size = self.download_file_with_cookiejar(file_name, self.cnt, len(self.files))
 
-            # set a timer
-            start = time.time()
+                # calculte rate
+                end = time.time()
 
-            # run download
-            size, total_size = self.download_file_with_cookiejar(file_name, self.cnt, len(self.files))
+                self.record(file_name, size, total_size, end - start)
+        self.wall_time = time.time() - wall_start
+
+    # Download up to self.threads files at once, streaming each into S3
+    def download_files_concurrently(self):
+        print(" > Downloading {0} files, {1} at a time".format(len(self.files), self.threads))
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            for file_count, file_name in enumerate(self.files, 1):
+                pool.submit(self.download_in_pool, file_name, file_count, len(self.files))
+
+    def download_in_pool(self, file_name, file_count, total):
+        # files still waiting for a thread are dropped once we have been asked to stop
+        if abort == True:
+            return
+
+        start = time.time()
+        try:
+            size, total_size = self.stream_file_to_s3(file_name, file_count, total)
+        except Exception as e:
+            print(" > ERROR: {0} while downloading {1}".format(e, file_name))
+            size, total_size = False, None
 
-            # calculte rate
-            end = time.time()
+        self.record(file_name, size, total_size, time.time() - start)
 
-            # stats:
+    # Add the outcome of one download to the summary
+    def record(self, file_name, size, total_size, elapsed):
+        with self.lock:
             if size is None:
                 self.skipped.append(file_name)
             # Check to see that the download didn't error and is the correct size
             elif size is not False and (total_size < (size + (size * .01)) and total_size > (size - (size * .01))):
                 # Download was good!
-                elapsed = end - start
                 elapsed = 1.0 if elapsed < 1 else elapsed
                 rate = (size / 1024 ** 2) / elapsed
 
-                print("Downloaded {0}b in {1:.2f}secs, Average Rate: {2:.2f}MB/sec".format(size, elapsed, rate))
+                print("Downloaded {0} {1}b in {2:.2f}secs, Average Rate: {3:.2f}MB/sec".format(
+                    os.path.basename(file_name).split('?')[0], size, elapsed, rate))
 
                 # add up metrics
                 self.total_bytes += size
@@ -571,6 +850,10 @@ class bulk_downloader(object):
                 print("          - {0}".format(skipped_file))
         if len(self.success) > 0:
             print("  Average Rate: {0:.2f}MB/sec".format((self.total_bytes / 1024.0 ** 2) / self.total_time))
+            if self.wall_time > 0:
+                # with several threads the files overlap, so this is higher than the rate of any one file
+                print("  Aggregate Rate: {0:.2f}MB/sec over {1:.2f}secs".format(
+                    (self.total_bytes / 1024.0 ** 2) / self.wall_time, self.wall_time))
         print("--------------------------------------------------------------------------------")
 
 
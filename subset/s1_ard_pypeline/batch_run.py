@@ -9,12 +9,17 @@ import botocore
 import logging
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor, wait
 from os import path
-from s1_ard_pypeline import validate_coherence_input, get_config
+from s1_ard_pypeline import validate_coherence_input, validate_result, get_config
 from s1_ard_pypeline.ard import ard
+from s1_ard_pypeline.ard.cache import ProductCache
 from s1_ard_pypeline.run_coherence import CoherenceChain
 from s1_ard_pypeline.run_intensity import IntensityChain
-from s1_ard_pypeline.utils import product_name, s3_utils
+from s1_ard_pypeline.utils import compression, product_name, s3_utils
+from s1_ard_pypeline.utils.catalogue import Catalogue
+from s1_ard_pypeline.utils.job_queue import S3JobQueue
+from s1_ard_pypeline.utils.prefetch import Prefetcher, SkippedPair
 from urljoin import urljoin
 
 
@@ -22,14 +27,33 @@ def parse_args():
     parser = argparse.ArgumentParser(description='Run a S1 ARD process for a list of images')
     parser.add_argument("-input", help="path to input files in s3", required=True)
     parser.add_argument("-output", help="path to output files in s3", required=True)
-    parser.add_argument("-targets", help="csv file of products, one pair per line", required=True)
+    parser.add_argument("-targets", help="csv file of products, one pair per line")
+    parser.add_argument("-queue", help="name of a job queue in the bucket to claim pairs from instead of -targets")
 
     parser.add_argument("-clean", type=bool, default=False,
                         help="should intermediate files be cleaned up as we process")
     parser.add_argument("-gzip", type=bool, default=True, help="should the result file be gzip compressed")
+    parser.add_argument("-parallel", type=int, default=1,
+                        help="how many processing steps of a chain can run at the same time")
+    parser.add_argument("-stream", type=bool, default=False,
+                        help="gzip the results straight into the s3 upload instead of writing the .gz file to disk")
+    parser.add_argument("-prefetch", type=int, default=1,
+                        help="how many pairs to download ahead of the pair being processed")
+    parser.add_argument("-diskbudget", type=float, default=None,
+                        help="how many GB the downloaded products can take up. Limits how far ahead they are fetched")
+    parser.add_argument("-lease", type=int, default=600,
+                        help="seconds a claimed pair is held without a heartbeat before another worker takes it over")
+    parser.add_argument("-attempts", type=int, default=3, help="how many times a pair from the queue is tried")
+    parser.add_argument("-validators", type=int, default=1,
+                        help="how many processes check the downloaded products in the background")
+    parser.add_argument("-validate", type=bool, default=False,
+                        help="check the results are sensible images before they are uploaded")
 
     _args = parser.parse_args()
 
+    if not _args.targets and not _args.queue:
+        parser.error("one of -targets or -queue is required")
+
     return _args
 
 
@@ -59,17 +83,208 @@ def map_result_path_to_upload(_result_path, _args):
     return urljoin.url_path_join(_args.output, path.basename(_result_path))
 
 
+def validate_outputs(_outputs):
+    """
+    Check the results of a chain before they are uploaded. Runs on the upload thread, so the next chain is not held up.
+    A chain only has a couple of results and each is usually passed after a few blocks, so they are checked in this
+    process rather than starting new ones.
+
+    :param _outputs: paths of the results
+    :raises ard.ProcessError: if any of them is not a sensible image
+    """
+    results = validate_result.validate_images(_outputs)
+    invalid = [o for o, ok in zip(_outputs, results) if not ok]
+    if invalid:
+        raise ard.ProcessError(f"results {', '.join(invalid)} did not pass validation")
+
+
 def upload_to_s3(_chain_factory, _args, _s3_client):
-    for i in _chain_factory.final_outputs():
-        logging.info(f"uploading {i} to s3")
-        _s3_client.put_file(i, map_result_path_to_upload(i, _args))
-        logging.info(f"Done uploading {i} to s3")
+    if _args.validate:
+        validate_outputs(_chain_factory.final_outputs())
+
+    if _args.stream and _args.gzip:
+        for i in _chain_factory.final_outputs():
+            stream_gzip_to_s3(i, _args, _s3_client)
+        return
+
+    outputs = _chain_factory.final_outputs()
+    logging.info(f"uploading {', '.join(outputs)} to s3")
+    errors = _s3_client.put_files([(i, map_result_path_to_upload(i, _args)) for i in outputs])
+    for error in errors:
+        if error is not None:
+            raise error
+    logging.info(f"Done uploading {', '.join(outputs)} to s3")
+
+
+def stream_gzip_to_s3(_result_path, _args, _s3_client):
+    """
+    Gzip a result while uploading it, so the compressed copy never touches the disk.
 
+    The chains are built without their gzip step in stream mode so _result_path is the uncompressed tif.
+    """
+    destination = map_result_path_to_upload(_result_path + ".gz", _args)
+    logging.info(f"compressing {_result_path} into s3 at {destination}")
+    with open(_result_path, "rb") as source, _s3_client.open_upload(destination) as upload:
+        compression.gzip_stream(source, upload)
+    logging.info(f"Done uploading {_result_path} to s3")
+    if _args.clean:
+        ard.delete_file(_result_path)
+
+
+def process_section(_chain_factory, _args, _s3_client, _uploads, _pending):
+    """
+    Run a chain and queue up the upload of its results.
+
+    :param _pending: dictionary of result path to the Future of its upload, updated with the results of this chain
+    :return: a Future that completes when the results have been uploaded
+    """
+    outputs = _chain_factory.final_outputs()
+    # a pair listed twice writes the same files again, so let their upload finish first
+    wait([_pending[i] for i in outputs if i in _pending])
 
-def process_section(_chain_factory, _args, _s3_client):
     chain = _chain_factory.build_chain()
-    ard.process_chain(chain, _chain_factory.name())
-    upload_to_s3(_chain_factory, _args, _s3_client)
+    ard.process_chain(chain, _chain_factory.name(), _args.parallel)
+    future = _uploads.submit(upload_to_s3, _chain_factory, _args, _s3_client)
+    for i in outputs:
+        _pending[i] = future
+    return future
+
+
+def read_targets(_targets):
+    """
+    Read the pairs of products to process from the targets csv file.
+
+    Each product is parsed once into a Catalogue, and pairs sharing a product share the same S1Product.
+
+    :return: list of (first product, last product) tuples
+    """
+    names = []
+    with open(_targets) as f:
+        for line in f:
+            first, last = split_product_line(line)
+            if not first or not last:
+                continue
+
+            if not product_name.validate(first) or not product_name.validate(last):
+                logging.error(f"Could not validate {first} or {last} as a product name. Skipping")
+                continue
+
+            names.append((first, last))
+
+    unique = list(dict.fromkeys(name for pair in names for name in pair))
+    catalogue = Catalogue(unique)
+    index = dict((name, i) for i, name in enumerate(unique))
+    pairs = []
+    for first, last in names:
+        pair = (catalogue.product(index[first]), catalogue.product(index[last]))
+        # pairs that can never be valid are dropped before anything is downloaded for them
+        if not validate_coherence_input.validate_metadata(*pair):
+            logging.info(f"inputs {first} {last} did not pass validation. Skipping")
+            continue
+        pairs.append(pair)
+    return pairs
+
+
+def claim_pairs(_queue, _jobs, _on_claim):
+    """
+    Claim pairs from a job queue one at a time, for as long as there are any left.
+
+    :param _queue: the S3JobQueue to claim from
+    :param _jobs: dictionary filled in with the id of each pair returned to its Job
+    :param _on_claim: function called with each pair as it is claimed
+    :return: generator of (first product, last product) tuples
+    """
+    for job in _queue.jobs():
+        first, last = split_product_line(job.line)
+        if not product_name.validate(first) or not product_name.validate(last):
+            logging.error(f"Could not validate {first} or {last} as a product name. Skipping")
+            _queue.complete(job)
+            continue
+
+        pair = (product_name.S1Product(first), product_name.S1Product(last))
+        if not validate_coherence_input.validate_metadata(*pair):
+            logging.info(f"inputs {first} {last} did not pass validation. Skipping")
+            _queue.complete(job)
+            continue
+
+        _jobs[id(pair)] = job
+        _on_claim(pair)
+        yield pair
+
+
+def invalid_products(_validator, _pair):
+    """
+    Check whether any product of a pair has already failed validation, for example as part of an earlier pair, so the
+    rest of the pair is not downloaded for nothing.
+
+    :param _validator: the ProductValidator checking the downloaded products
+    :param _pair: tuple of products
+    :return: the reason not to download the pair, or None
+    """
+    invalid = [p.product_name for p in _pair if _validator.invalid(p)]
+    if invalid:
+        return f"{', '.join(invalid)} did not pass validation"
+    return None
+
+
+def finish_job(_queue, _jobs, _pair, _worked, _uploads=()):
+    """
+    Mark the job of a pair from the queue as done, or failed so it is tried again.
+
+    :param _uploads: Futures of the uploads of the pair. The job has only worked if they all succeed
+    """
+    if _queue is None:
+        return
+    job = _jobs.pop(id(_pair))
+    wait(_uploads)
+    if _worked and all(f.exception() is None for f in _uploads):
+        _queue.complete(job)
+    else:
+        _queue.fail(job)
+
+
+def remove_product(_args, _working_dir, _download_dir, _product):
+    """
+    Clean up the decompressed input files and the downloaded file of a product no pair needs any more.
+    """
+    if not _args.clean:
+        return
+    if path.exists(product_name.unzipped_path(_working_dir, _product)):
+        ard.delete_dir(product_name.unzipped_path(_working_dir, _product))
+    if path.exists(product_name.zip_path(_download_dir, _product)):
+        ard.delete_file(product_name.zip_path(_download_dir, _product))
+
+
+def build_chains(_args, _download_dir, _output_dir, _cache, _first_product, _last_product, _intensity_done):
+    """
+    Create the chains for a pair. The intensity chain of a product that was in an earlier pair is left out.
+    """
+    # in stream mode the results are compressed as they are uploaded rather than by the chains
+    chain_gzip = _args.gzip and not _args.stream
+    chains = [
+        # Process the coherence work flow
+        CoherenceChain(_download_dir, _output_dir, _first_product, _last_product, chain_gzip, _args.clean, _cache),
+    ]
+    for p in [_first_product, _last_product]:
+        # Process the intensity work flow for the first and last file
+        if p.product_name not in _intensity_done:
+            chains.append(IntensityChain(_download_dir, _output_dir, p, chain_gzip, _args.clean))
+    return chains
+
+
+def wait_for_uploads(_uploads, _futures):
+    """
+    Wait for the queued uploads to finish.
+
+    :return: the number of uploads that failed
+    """
+    _uploads.shutdown(wait=True)
+    failed = 0
+    for future in _futures:
+        if future.exception() is not None:
+            logging.error(f"Upload failed. {future.exception()}")
+            failed = failed + 1
+    return failed
 
 
 if __name__ == '__main__':
@@ -85,58 +300,115 @@ if __name__ == '__main__':
 
     s3_client = s3_utils.S3Utils()
 
-    with open(args.targets) as f:
-        count = 0
-        for line in f:
-            first, last = split_product_line(line)
-            if not first or not last:
-                continue
+    # Consecutive pairs share a product. The stage 1 swaths of that product are kept for the next pair rather than made
+    # again, so count how many pairs need each of them. For a targets file this is done up front, for a queue as each
+    # pair is claimed.
+    cache = ProductCache(args.clean)
 
-            if not product_name.validate(first) or not product_name.validate(last):
-                logging.error(f"Could not validate {first} or {last} as a product name. Skipping")
-                continue
+    def retain(pair):
+        cache.retain_all(CoherenceChain(download_dir, output_dir, pair[0], pair[1], args.gzip, args.clean).cache_keys())
+
+    if args.queue:
+        # claim pairs from a queue shared with the other workers, so the work balances itself across them
+        job_queue = S3JobQueue(s3_client.client, s3_client.bucket.name, args.queue, args.lease, args.attempts)
+        job_queue.start()
+        jobs = {}
+        pairs = claim_pairs(job_queue, jobs, retain)
+    else:
+        job_queue = None
+        jobs = {}
+        pairs = read_targets(args.targets)
+        for pair in pairs:
+            retain(pair)
+    intensity_done = set()
+
+    # While a pair is processed the products of the next pairs are downloaded and the results of the previous pair are
+    # uploaded, so the network is kept busy during snap and the cpu during the transfers. Each product is validated in
+    # the background as soon as it is downloaded, and a pair using a product that has failed is not downloaded at all.
+    validator = validate_coherence_input.ProductValidator(download_dir, args.validators)
+    budget = int(args.diskbudget * 1024 ** 3) if args.diskbudget else None
+    prefetcher = Prefetcher(
+        pairs,
+        lambda p: download_product(s3_client, args, download_dir, p),
+        lambda p: product_name.zip_path(download_dir, p),
+        depth=args.prefetch,
+        budget=budget,
+        on_release=lambda p: remove_product(args, working_dir, download_dir, p),
+        on_fetched=validator.submit,
+        skip=lambda p: invalid_products(validator, p),
+    )
+    uploads = ThreadPoolExecutor(max_workers=1)
+    upload_futures = []
+    pending_uploads = {}
 
-            count = count + 1
-            logging.info(f"Processing {first}, {last}")
-            first_product = product_name.S1Product(first)
-            last_product = product_name.S1Product(last)
+    count = 0
+    for pair, error in prefetcher:
+        first_product, last_product = pair
+        first = first_product.product_name
+        last = last_product.product_name
+        count = count + 1
+        logging.info(f"Processing {first}, {last}")
 
-            # TODO: make this sort its self out so if first and last are backwards it flips them round.
+        # TODO: make this sort its self out so if first and last are backwards it flips them round.
+        chains = build_chains(args, download_dir, output_dir, cache, first_product, last_product, intensity_done)
+
+        if isinstance(error, botocore.exceptions.ClientError):
+            logging.error(f"could not fetch products from s3 {error}")
+            cache.release_all(chains[0].cache_keys())
+            prefetcher.release(pair)
+            finish_job(job_queue, jobs, pair, False)
+            continue
+        elif isinstance(error, SkippedPair):
+            logging.info(f"inputs {first} {last} were not downloaded. {error}")
+            cache.release_all(chains[0].cache_keys())
+            prefetcher.release(pair)
+            finish_job(job_queue, jobs, pair, True)
+            continue
+        elif error is not None:
+            raise error
+
+        # the products were checked while the previous pair was processed, so this rarely has to wait
+        if not validator.validate(first_product, last_product):
+            logging.info(f"inputs {first} {last} did not pass validation. Skipping")
+            cache.release_all(chains[0].cache_keys())
+            prefetcher.release(pair)
+            finish_job(job_queue, jobs, pair, True)
+            continue
+
+        pair_uploads = []
+        for c in chains:
             try:
-                download_product(s3_client, args, download_dir, first_product)
-                download_product(s3_client, args, download_dir, last_product)
-            except botocore.exceptions.ClientError as e:
-                logging.error(f"could not fetch products from s3 {e}")
-                continue
+                pair_uploads.append(process_section(c, args, s3_client, uploads, pending_uploads))
+            except ard.ProcessError as e:
+                logging.info(f"Processing failed. Aborting. {e}")
+                upload_futures.extend(pair_uploads)
+                prefetcher.stop()
+                if job_queue is not None:
+                    finish_job(job_queue, jobs, pair, False)
+                wait_for_uploads(uploads, upload_futures)
+                validator.shutdown()
+                if job_queue is not None:
+                    # let the other workers have the pairs that were claimed ahead
+                    job_queue.abandon_all()
+                    job_queue.stop()
+                sys.exit(2)
+            if isinstance(c, IntensityChain):
+                intensity_done.add(c.product.product_name)
 
-            if not validate_coherence_input.validate_input(download_dir, first, last):
-                logging.info(f"inputs {first} {last} did not pass validation. Skipping")
-                continue
+        upload_futures.extend(pair_uploads)
+        prefetcher.release(pair)
+        if job_queue is not None:
+            # the job is only done once its results are in s3
+            upload_futures.append(uploads.submit(finish_job, job_queue, jobs, pair, True, pair_uploads))
+        logging.info(f"Completed {first}, {last}")
+
+    failed_uploads = wait_for_uploads(uploads, upload_futures)
+    validator.shutdown()
+    s3_client.stats.log_summary()
+    if job_queue is not None:
+        job_queue.stop()
+
+    if failed_uploads:
+        sys.exit(2)
 
-            chains = [
-                # Process the coherence work flow
-                CoherenceChain(download_dir, output_dir, first_product, last_product, args.gzip, args.clean),
-                # Process the intensity work flow for the first file
-                IntensityChain(download_dir, output_dir, first_product, args.gzip, args.clean),
-                # process the intensity work flow for the last file
-                IntensityChain(download_dir, output_dir, last_product, args.gzip, args.clean),
-            ]
-
-            for c in chains:
-                try:
-                    process_section(c, args, s3_client)
-                except ard.ProcessError as e:
-                    logging.info(f"Processing failed. Aborting. {e}")
-                    sys.exit(2)
-
-            # Clean up the decompressed input files and the downloaded files
-            if args.clean:
-                ard.delete_dir(product_name.unzipped_path(working_dir, first_product))
-                ard.delete_dir(product_name.unzipped_path(working_dir, last_product))
-
-                ard.delete_file(product_name.zip_path(working_dir, first_product))
-                ard.delete_file(product_name.zip_path(working_dir, last_product))
-
-            logging.info(f"Completed {first}, {last}")
-
-    logging.info(f"Completed {count} entries in {args.targets}")
+    logging.info(f"Completed {count} entries in {args.queue or args.targets}")
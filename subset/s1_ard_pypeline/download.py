@@ -1,13 +1,33 @@
 import argparse
+import http.client
 import json
 import logging
 import posixpath
-import urllib
+import socket
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
 from queue import Queue
-from s1_ard_pypeline import get_config
 from s1_ard_pypeline.utils import s3_utils
 from threading import Thread
 
+# Bytes read from the url at a time
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Part size and number of parts uploaded at once when streaming a download into S3. Together they bound the memory used
+# by each worker to roughly (2 * UPLOAD_CONCURRENCY + 1) * UPLOAD_PART_SIZE
+UPLOAD_PART_SIZE = 16 * 1024 * 1024
+UPLOAD_CONCURRENCY = 2
+
+# How many times an interrupted download is picked up again from where it stopped, and the seconds waited before the
+# first retry. The wait doubles for each retry after that
+RETRIES = 5
+RETRY_DELAY = 1
+
+# Errors that mean the connection broke part way through, rather than the url being bad
+INTERRUPTIONS = (urllib.error.URLError, http.client.HTTPException, ConnectionError, socket.timeout)
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='download a list of un-authenticated urls and put them in s3')
@@ -31,23 +51,89 @@ def create_destination_url(target_path, in_url):
     return posixpath.join(target_path, filename)
 
 
-def download_file(source_url, destination_url, _client):
-    response = urllib.request.urlopen(source_url)
-    _client.s3_client.put_object(Body=response.read(), Bucket=get_config("S3", "bucket"), Key=destination_url)
-
-
-def worker():
+def open_url(source_url, start=0):
+    """
+    Open a url, starting part way through if start is not 0.
+
+    :param source_url: the url to open
+    :param start: the byte to start from
+    :return: the response
+    """
+    request = urllib.request.Request(source_url)
+    if start:
+        request.add_header("Range", f"bytes={start}-")
+    response = urllib.request.urlopen(request, timeout=60)
+    if start and response.status != 206:
+        response.close()
+        raise IOError(f"{source_url} can not be resumed from byte {start}, the server ignored the range")
+    return response
+
+
+def download_file(source_url, destination_url, _client, _manifest=None, chunk_size=CHUNK_SIZE, retries=RETRIES):
+    """
+    Stream a url into S3 a chunk at a time, so the whole file is never held in memory.
+
+    If the connection drops the download is picked up again from the last byte received with a range request and
+    carries on into the same upload.
+
+    :param source_url: the url to download
+    :param destination_url: where in S3 to put it
+    :param _client: S3Utils
+    :param _manifest: a Manifest of the destination to record the new file in
+    :param chunk_size: bytes read from the url at a time
+    :param retries: how many times to resume an interrupted download
+    :return: the number of bytes downloaded
+    """
+    received = 0
+    attempt = 0
+    with _client.open_upload(destination_url, UPLOAD_PART_SIZE, UPLOAD_CONCURRENCY) as upload:
+        while True:
+            try:
+                with open_url(source_url, received) as response:
+                    length = response.getheader("Content-Length")
+                    expected = received + int(length) if length is not None else None
+                    while True:
+                        chunk = response.read(chunk_size)
+                        if not chunk:
+                            break
+                        upload.write(chunk)
+                        received += len(chunk)
+                if expected is not None and received < expected:
+                    raise http.client.IncompleteRead(b"", expected - received)
+                break
+            except INTERRUPTIONS as e:
+                # the server is there but will not give us the file, so trying again will not help
+                if isinstance(e, urllib.error.HTTPError) and e.code < 500:
+                    raise
+                attempt = attempt + 1
+                if attempt > retries:
+                    raise
+                logging.warning(f"download of {source_url} interrupted at byte {received}, resuming. {e}")
+                time.sleep(min(RETRY_DELAY * 2 ** (attempt - 1), 30))
+
+    if _manifest is not None:
+        _manifest.add(destination_url, received)
+    return received
+
+
+def worker(manifest):
     client = s3_utils.S3Utils()
     while True:
         item = q.get()
         dest = create_destination_url(args.output, item)
 
-        if not client.list_files(dest):
-            logging.info(f"~{q.qsize()} remaining. downloading {item} to {dest}")
-            download_file(item, dest, client)
-        else:
-            logging.info(f"~{q.qsize()} remaining. Skipping due to existence {item} at {dest}")
-        q.task_done()
+        try:
+            exists = dest in manifest if manifest is not None else client.exists(dest)
+            if not exists:
+                logging.info(f"~{q.qsize()} remaining. downloading {item} to {dest}")
+                download_file(item, dest, client, manifest)
+            else:
+                logging.info(f"~{q.qsize()} remaining. Skipping due to existence {item} at {dest}")
+        except Exception as e:
+            # the multipart upload has been aborted so nothing partial is left in s3
+            logging.error(f"could not download {item} to {dest} {e}")
+        finally:
+            q.task_done()
 
 
 if __name__ == '__main__':
@@ -56,9 +142,12 @@ if __name__ == '__main__':
     entries = read_url_list(args.input)
     logging.info(f"found {len(entries)} to download...")
 
+    # list what is already in s3 once, rather than once for every url. A few urls are checked with a HEAD each instead
+    manifest = s3_utils.S3Utils().manifest(args.output) if len(entries) > s3_utils.HEAD_CHECK_LIMIT else None
+
     q = Queue()
     for i in range(int(args.threads)):
-        t = Thread(target=worker)
+        t = Thread(target=worker, args=(manifest,))
         t.daemon = True
         t.start()
 
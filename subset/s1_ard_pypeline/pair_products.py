@@ -1,10 +1,16 @@
 #!python
 import argparse
 import logging
+from bisect import bisect_left, bisect_right
 from datetime import timedelta
 from os import path
 
-from s1_ard_pypeline.utils import product_name
+import numpy as np
+
+from s1_ard_pypeline.utils import product_name, s3_utils
+from s1_ard_pypeline.utils.catalogue import Catalogue
+from s1_ard_pypeline.utils.footprint import FootprintIndex, read_footprints
+from s1_ard_pypeline.utils.job_queue import S3JobQueue
 
 """
 This script pairs up a list of S1 products to make a set of inputs for the batch_run tool
@@ -12,8 +18,14 @@ This script pairs up a list of S1 products to make a set of inputs for the batch
 This script can also create a split output which will round-robbin output to a set of files.
 This can either be a number, or a list of names. Helpful for routing to the correct user. 
 
-usage: pair_products.py [-h] -input INPUT -output OUTPUT [-splits SPLITS]
-                        [-splitlist SPLITLIST]
+Or the pairs can be put on a job queue in S3 that any number of batch_run workers claim them from.
+
+Given the footprints of the products, from a catalogue csv or a directory of products, pairs are chosen by how much of
+their footprints overlap rather than by the time of day they were taken.
+
+usage: pair_products.py [-h] -input INPUT [-output OUTPUT] [-splits SPLITS]
+                        [-splitlist SPLITLIST] [-queue QUEUE]
+                        [-footprints FOOTPRINTS] [-overlap OVERLAP]
 
 Pair up a list of S1 products ready for processing by batch_run.py
 
@@ -23,18 +35,39 @@ optional arguments:
   -output OUTPUT        path to output file
   -splits SPLITS        number of parts to split the output file into
   -splitlist SPLITLIST  path to a file of split extensions to use
+  -queue QUEUE          name of a job queue in the bucket to put the pairs on
+  -footprints FOOTPRINTS
+                        path to a catalogue csv or directory of products to
+                        read footprints from
+  -overlap OVERLAP      minimum percentage of the smaller footprint two
+                        products must share to be paired
 
 """
 
+# Products of the same relative orbit are paired with one taken 12 to 24 days later. Due to orbital mechanics images in
+# the same orbit cant be in between but they might be outside by a few seconds, the 30 seconds gives us a buffer.
+MIN_GAP = timedelta(days=12, seconds=-30)
+MAX_GAP = timedelta(days=24)
+
+# Percentage of the smaller footprint a pair must share, when the footprints are known
+MIN_OVERLAP = 50.0
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Pair up a list of S1 products ready for processing by batch_run.py')
     parser.add_argument("-input", help="path to input file", required=True)
-    parser.add_argument("-output", help="path to output file", required=True)
+    parser.add_argument("-output", help="path to output file")
     parser.add_argument("-splits", help="number of parts to split the output file into", required=False, default=1)
     parser.add_argument("-splitlist", help="path to a file of split extensions to use", required=False, default="")
+    parser.add_argument("-queue", help="name of a job queue in the bucket to put the pairs on", required=False)
+    parser.add_argument("-footprints", help="path to a catalogue csv or directory of products to read footprints from",
+                        required=False)
+    parser.add_argument("-overlap", type=float, default=MIN_OVERLAP,
+                        help="minimum percentage of the smaller footprint two products must share to be paired")
 
     _args = parser.parse_args()
+    if not _args.output and not _args.queue:
+        parser.error("one of -output or -queue is required")
     return _args
 
 
@@ -48,40 +81,144 @@ def read_product_list(_file):
     return _result
 
 
-def pair_products(_products):
+def _overlaps(pa, pb):
+    """
+    :return: True if the two products cover some of the same time of day, and so some of the same ground
+    """
+    return pa.start_time <= pb.start_time < pa.stop_time or pb.start_time < pa.stop_time <= pb.stop_time or \
+        pb.start_time <= pa.start_time < pb.stop_time or pa.start_time < pb.stop_time <= pa.stop_time
+
+
+def _footprints_overlap(pa, pb, _footprints, _overlap, _nearby):
+    """
+    :return: True or False if both footprints are known, otherwise None
+    """
+    if _footprints is None or pa.product_name not in _footprints or pb.product_name not in _footprints:
+        return None
+    if _nearby is not None and pb.product_name not in _nearby:
+        return False
+    return _footprints.overlap(pa.product_name, pb.product_name) >= _overlap
+
+
+def pair_orbit(_products, _footprints=None, _overlap=MIN_OVERLAP):
+    """
+    Pair up the products of a single relative orbit.
+
+    The products are sorted by start time once, so the products 12 to 24 days after each one can be found with a binary
+    search rather than by looking at every later product. Each product is paired with the first of those it overlaps.
+
+    :param _products: list of products that share a relative orbit
+    :param _footprints: a FootprintIndex. Products with known footprints must share at least _overlap percent of them,
+        the rest fall back to overlapping times of day
+    :param _overlap: minimum percentage of the smaller footprint a pair must share
+    :return: list of (first, last) product tuples
+    """
+    # parse each timestamp once, not once per comparison
+    timestamps = [p.start_timestamp() for p in _products]
+    order = sorted(range(len(_products)), key=timestamps.__getitem__)
+    sorted_products = [_products[i] for i in order]
+    sorted_timestamps = [timestamps[i] for i in order]
+
+    _result = []
+    for pa, start in zip(sorted_products, sorted_timestamps):
+        # the window only holds products after this one, as the minimum gap is more than zero
+        low = bisect_left(sorted_timestamps, start + MIN_GAP)
+        high = bisect_right(sorted_timestamps, start + MAX_GAP)
+        nearby = _footprints.query(pa) if _footprints is not None and low < high else None
+        for pb in sorted_products[low:high]:
+            spatial = _footprints_overlap(pa, pb, _footprints, _overlap, nearby)
+            if spatial or (spatial is None and _overlaps(pa, pb)):
+                _result.append((pa, pb))
+                break
+
+    # if we have some how created a loop remove the last entry to break it.
+    if len(_result) >= 2 and _result[0][0].product_name == _result[-1][1].product_name:
+        _result = _result[:-1]
+
+    return _result
+
+
+def pair_catalogue(_catalogue, _footprints=None, _overlap=MIN_OVERLAP):
+    """
+    Pair up the products of a Catalogue, a column at a time. Gives the same pairs as pair_orbit does for each orbit.
+
+    Rather than looking through the window of each product in turn, the first candidate in every window is checked at
+    once, then the second for the products still without a pair, and so on.
+
+    :param _catalogue: a Catalogue
+    :param _footprints: a FootprintIndex, used as in pair_orbit
+    :param _overlap: minimum percentage of the smaller footprint a pair must share
+    :return: list of (first, last) index tuples, grouped by orbit
+    """
+    min_gap = np.timedelta64(int(MIN_GAP.total_seconds()), "s")
+    max_gap = np.timedelta64(int(MAX_GAP.total_seconds()), "s")
+
+    _result = []
+    for _, indices in _catalogue.group_by_relative_orbit():
+        starts = _catalogue.start[indices]
+        start_time = _catalogue.start_time[indices]
+        stop_time = _catalogue.stop_time[indices]
+
+        candidate = np.searchsorted(starts, starts + min_gap, side="left")
+        high = np.searchsorted(starts, starts + max_gap, side="right")
+        match = np.full(len(indices), -1)
+        searching = candidate < high
+        if _footprints is not None:
+            known = np.array([_catalogue.name(i) in _footprints for i in indices], dtype=bool)
+            # the products whose footprint touches each product, looked up once when it is first needed
+            nearby = {}
+        while searching.any():
+            rows = np.flatnonzero(searching)
+            columns = candidate[rows]
+            a_start, a_stop = start_time[rows], stop_time[rows]
+            b_start, b_stop = start_time[columns], stop_time[columns]
+            overlaps = ((a_start <= b_start) & (b_start < a_stop)) | ((b_start < a_stop) & (a_stop <= b_stop)) | \
+                       ((b_start <= a_start) & (a_start < b_stop)) | ((a_start < b_stop) & (b_stop <= a_stop))
+            if _footprints is not None:
+                for k in np.flatnonzero(known[rows] & known[columns]):
+                    pa = _catalogue.product(indices[rows[k]])
+                    if rows[k] not in nearby:
+                        nearby[rows[k]] = _footprints.query(pa)
+                    pb = _catalogue.product(indices[columns[k]])
+                    overlaps[k] = _footprints_overlap(pa, pb, _footprints, _overlap, nearby[rows[k]])
+            match[rows[overlaps]] = columns[overlaps]
+            candidate[rows] += 1
+            searching[rows] = ~overlaps & (candidate[rows] < high[rows])
+
+        paired = np.flatnonzero(match >= 0)
+        pairs = list(zip(indices[paired].tolist(), indices[match[paired]].tolist()))
+
+        # if we have some how created a loop remove the last entry to break it.
+        if len(pairs) >= 2 and _catalogue.names[pairs[0][0]] == _catalogue.names[pairs[-1][1]]:
+            pairs = pairs[:-1]
+        _result.extend(pairs)
+
+    return _result
+
+
+def pair_products(_products, _footprints=None, _overlap=MIN_OVERLAP):
+    """
+    Pair up products taken 12 to 24 days apart from the same relative orbit that overlap. Runs in O(n log n) so
+    archive lists of hundreds of thousands of products are paired in seconds.
+
+    :param _products: list of S1Products, or a Catalogue
+    :param _footprints: a FootprintIndex. Where both footprints of a pair are known they must overlap by at least
+        _overlap percent, otherwise the times of day the products were taken must overlap
+    :param _overlap: minimum percentage of the smaller footprint a pair must share
+    :return: list of (first, last) product tuples, grouped by orbit
+    """
+    if isinstance(_products, Catalogue):
+        pairs = pair_catalogue(_products, _footprints, _overlap)
+        return [(_products.product(a), _products.product(b)) for a, b in pairs]
+
     # group up by orbit.
     _by_orbit = {}
     for p in _products:
         _by_orbit.setdefault(p.relative_orbit(), []).append(p)
 
     _result = []
-
-    # for each orbit
-    for k, v in _by_orbit.items():
-        sorted_products = sorted(v, key=lambda _p: _p.start_timestamp())
-
-        orbit_start = len(_result)
-        for i, pa in enumerate(sorted_products):
-            # because the products are sorted the one that overlaps should be soon after
-            for pb in sorted_products[i + 1:]:
-                # if the images are not between 12 and 24 days apart then we should not process it.
-                # Due to orbital mechanics images in the same orbit cant be in between but they might be outside by a
-                # few seconds, this gives us a buffer.
-                duration = (pb.start_timestamp() - pa.start_timestamp())
-                if timedelta(days=12, seconds=-30) > duration or duration > timedelta(days=24):
-                    continue
-
-                # the two products overlap
-                if pa.start_time <= pb.start_time < pa.stop_time or pb.start_time < pa.stop_time <= pb.stop_time or \
-                    pb.start_time <= pa.start_time < pb.stop_time or pa.start_time < pb.stop_time <= pa.stop_time:
-                    _result.append((pa, pb))
-                    break
-
-        # if we have some how created a loop remove the last entry to break it.
-        if len(_result) >= 2 and \
-            orbit_start < len(_result) - 1 and \
-            _result[orbit_start][0].product_name == _result[-1][1].product_name:
-            _result = _result[:-1]
+    for v in _by_orbit.values():
+        _result.extend(pair_orbit(v, _footprints, _overlap))
 
     return _result
 
@@ -117,6 +254,17 @@ def write_results(_pairs, _output, _parts, _split_list):
         f.close()
 
 
+def write_queue(_pairs, _queue):
+    """
+    Put the pairs on a job queue for batch_run workers to claim.
+
+    :param _pairs: list of pairs to write out
+    :param _queue: an S3JobQueue
+    :return: the number of pairs added
+    """
+    return _queue.put_all(f"{p[0].product_name}, {p[1].product_name}" for p in _pairs)
+
+
 def load_split_list(_split_list):
     _result = []
     with open(_split_list, 'r') as f:
@@ -132,9 +280,14 @@ def create_output_name(_output, _number):
 
 if __name__ == '__main__':
     args = parse_args()
-    products = read_product_list(args.input)
+    products = Catalogue.read(args.input)
+    footprints = FootprintIndex(read_footprints(args.footprints)) if args.footprints else None
 
-    result = pair_products(products)
+    result = pair_products(products, footprints, args.overlap)
 
-    write_results(result, args.output, int(args.splits), args.splitlist)
+    if args.queue:
+        s3_client = s3_utils.S3Utils()
+        write_queue(result, S3JobQueue(s3_client.client, s3_client.bucket.name, args.queue))
+    else:
+        write_results(result, args.output, int(args.splits), args.splitlist)
     logging.info(f"paired {len(products)} entries into {len(result)} pairs")
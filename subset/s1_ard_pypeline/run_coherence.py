@@ -5,6 +5,7 @@ import sys
 
 from s1_ard_pypeline import get_config
 from s1_ard_pypeline.ard import ard
+from s1_ard_pypeline.ard.cache import cache_key
 from s1_ard_pypeline.utils import product_name
 from s1_ard_pypeline.utils.product_name import create_result_name
 
@@ -12,7 +13,7 @@ from s1_ard_pypeline.utils.product_name import create_result_name
 A script to ard the ard coherence process. 
 
 usage: run_coherence.py [-h] -input INPUT -output OUTPUT -first FIRST -last
-                        LAST [-clean CLEAN]
+                        LAST [-clean CLEAN] [-gzip GZIP] [-parallel PARALLEL]
 
 Run a S1 ARD process for two images
 
@@ -25,6 +26,9 @@ optional arguments:
   -last LAST      the last image name to process (should not include the file
                   extension)
   -clean CLEAN    should intermediate files be cleaned up as we process
+  -gzip GZIP      should the result file be gzip compressed
+  -parallel PARALLEL
+                  how many processing steps can run at the same time
 
 """
 
@@ -45,6 +49,7 @@ def parse_args():
     )
     parser.add_argument("-clean", type=bool, default=True, help="should intermediate files be cleaned up as we process")
     parser.add_argument("-gzip", type=bool, default=True, help="should the result file be gzip compressed")
+    parser.add_argument("-parallel", type=int, default=1, help="how many processing steps can run at the same time")
 
     _args = parser.parse_args()
 
@@ -63,7 +68,7 @@ def parse_args():
 
 class CoherenceChain:
 
-    def __init__(self, _input_dir, _output_dir, _first_product, _last_product, _gzip, _clean):
+    def __init__(self, _input_dir, _output_dir, _first_product, _last_product, _gzip, _clean, _cache=None):
         self.input_dir = _input_dir
         self.working_dir = get_config("Dirs", "working")
         self.output_dir = _output_dir
@@ -72,6 +77,8 @@ class CoherenceChain:
         self.product_first = _first_product
         self.product_last = _last_product
         self.products = [self.product_first, self.product_last]
+        # a ProductCache to share the stage 1 swaths of each product with the chains of other pairs
+        self.cache = _cache
 
     def name(self):
         return f"Coherence for {self.product_first.product_name} and {self.product_last.product_name}"
@@ -90,6 +97,8 @@ class CoherenceChain:
 
     def build_chain(self):
         # create the chain of processing steps.
+        # Each step declares the earlier steps it needs, so with process_chain parallelism above one the products,
+        # polarisations and sub swaths are processed at the same time.
 
         # Get the ones in both of them as we can only generate coherence for polarisations that are in both images.
         common_polarisations = product_name.common_polarisations(self.products)
@@ -116,6 +125,15 @@ class CoherenceChain:
                     for polarisation in common_polarisations
                 ]
             )),
+            # let the cache remove the swaths once no other pair needs them
+            list(map(
+                lambda p: self.release_stage1(p[0], p[1]),
+                [
+                    (p, polarisation)
+                    for p in self.products
+                    for polarisation in common_polarisations
+                ]
+            )) if self.cache is not None else [],
             # Join up the three swaths into a single image for each polarisation
             list(map(lambda polarisation: self.stage3(polarisation), common_polarisations)),
             # Terrain correction, filtering and finalisation of each polarisation
@@ -130,10 +148,33 @@ class CoherenceChain:
         return create_result_name(self.working_dir, _products, _polarisation, _prefix, ".dim")
 
     def unzip(self, product):
-        return lambda: ard.unzip_product(
+        return ard.Step(f"unzip_{product.product_name}", lambda: ard.unzip_product(
             product_name.zip_path(self.input_dir, product),
             self.working_dir,
-        )
+            product_name.common_polarisations(self.products),
+        ), [])
+
+    def cache_keys(self):
+        """
+        The work of this chain that can be shared through a ProductCache with the chains of other pairs.
+
+        :return: list of cache keys
+        """
+        return [
+            cache_key(*self._stage1_graph(p, polarisation))
+            for p in self.products
+            for polarisation in product_name.common_polarisations(self.products)
+        ]
+
+    def _stage1_graph(self, product, polarisation):
+        return ard.graph("S1_coherence_stage1"), {
+            **product_name.create_s1_swath_dict(
+                "target", 1, 1,
+                self.working_dir, product, polarisation, "Orb", "dim"
+            ),
+            "input": product_name.manifest_path(self.working_dir, product),
+            "polarisation": polarisation.upper(),
+        }
 
     def stage1(self, product, polarisation):
         """
@@ -142,23 +183,38 @@ class CoherenceChain:
         For dual polarisation (VV+VH) this stage should be called twice for the same image. Once for each polarisation
         :param product: the product to split into swathes
         :param polarisation:  the polarisation to select.
-        :return: a lambda that will do the work.
+        :return: a step that will do the work.
         """
-        return lambda: ard.gpt(
-            ard.graph("S1_coherence_stage1"),
-            {
-                **product_name.create_s1_swath_dict(
-                    "target", 1, 1,
-                    self.working_dir, product, polarisation, "Orb", "dim"
-                ),
-                "input": product_name.manifest_path(self.working_dir, product),
-                "polarisation": polarisation.upper(),
-            }
+        graph_path, args = self._stage1_graph(product, polarisation)
+        if self.cache is not None:
+            # the swaths only depend on the one product so another pair may have made them already
+            outputs = list(product_name.create_s1_swath_dict(
+                "target", 1, 1,
+                self.working_dir, product, polarisation, "Orb", "dim"
+            ).values())
+            action = lambda: self.cache.produce(cache_key(graph_path, args), outputs, lambda: ard.gpt(graph_path, args))
+        else:
+            action = lambda: ard.gpt(graph_path, args)
+        return ard.Step(f"stage1_{product.product_name}_{polarisation}", action, [f"unzip_{product.product_name}"])
+
+    def release_stage1(self, product, polarisation):
+        """
+        Tell the cache this chain is done with the swaths of a product. They are deleted once no other pair needs them.
+
+        :param product: the product that was split into swathes
+        :param polarisation: the polarisation of the swathes
+        :return: a step that will do the work.
+        """
+        return ard.Step(
+            f"stage1_{product.product_name}_{polarisation}_release",
+            lambda: self.cache.release(cache_key(*self._stage1_graph(product, polarisation))),
+            [f"stage2_{sub_swath}_{polarisation}" for sub_swath in ['iw1', 'iw2', 'iw3']]
         )
 
     def stage2(self, _sub_swath, _polarisation):
+        key = f"stage2_{_sub_swath}_{_polarisation}"
         result = [
-            lambda: ard.gpt(
+            ard.Step(key, lambda: ard.gpt(
                 ard.graph("S1_coherence_stage2"),
                 {
                     "input1": self._create_dim_name(
@@ -176,21 +232,23 @@ class CoherenceChain:
                         f"Orb_stack_Ifg_Deb_{_sub_swath}",
                     )
                 }
-            )
+            ), [f"stage1_{p.product_name}_{_polarisation}" for p in self.products])
         ]
 
-        if self.clean:
-            result.append(lambda: ard.delete_dim(
+        # with a cache the swaths are removed by release_stage1 instead
+        if self.clean and self.cache is None:
+            result.append(ard.Step(f"{key}_clean", lambda: ard.delete_dim(
                 self._create_dim_name(_polarisation, f"Orb_{_sub_swath}", self.products[0])
-            ))
-            result.append(lambda: ard.delete_dim(
+            ), [key]))
+            result.append(ard.Step(f"{key}_clean", lambda: ard.delete_dim(
                 self._create_dim_name(_polarisation, f"Orb_{_sub_swath}", self.products[1])
-            ))
+            ), [key]))
 
         return result
 
     def stage3(self, _polarisation):
-        result = [lambda: ard.gpt(
+        key = f"stage3_{_polarisation}"
+        result = [ard.Step(key, lambda: ard.gpt(
             ard.graph("S1_coherence_stage3"),
             {
                 **product_name.create_s1_swath_dict(
@@ -199,21 +257,23 @@ class CoherenceChain:
                 ),
                 "target": self._create_dim_name(_polarisation, "Orb_stack_Ifg_Deb_mrg"),
             }
-        )]
+        ), [f"stage2_{sub_swath}_{_polarisation}" for sub_swath in ['iw1', 'iw2', 'iw3']])]
         if self.clean:
-            result.append(lambda: ard.delete_dim(
+            result.append(ard.Step(f"{key}_clean", lambda: ard.delete_dim(
                 self._create_dim_name(_polarisation, "Orb_stack_Ifg_Deb_iw1")
-            ))
-            result.append(lambda: ard.delete_dim(
+            ), [key]))
+            result.append(ard.Step(f"{key}_clean", lambda: ard.delete_dim(
                 self._create_dim_name(_polarisation, "Orb_stack_Ifg_Deb_iw2")
-            ))
-            result.append(lambda: ard.delete_dim(
+            ), [key]))
+            result.append(ard.Step(f"{key}_clean", lambda: ard.delete_dim(
                 self._create_dim_name(_polarisation, "Orb_stack_Ifg_Deb_iw3")
-            ))
+            ), [key]))
         return result
 
     def stage4(self, _polarisation):
-        result = [lambda: ard.gpt(
+        # the steps after the terrain correction depend on each other in turn, but not on the other polarisation
+        key = f"stage4_{_polarisation}"
+        result = [ard.Step(key, lambda: ard.gpt(
             ard.graph("S1_coherence_stage4"),
             {
                 "input": self._create_dim_name(
@@ -225,14 +285,14 @@ class CoherenceChain:
                     "Orb_stack_Ifg_Deb_mrg_DInSAR_Flt_TC"
                 ),
             }
-        )]
+        ), [f"stage3_{_polarisation}"])]
         if self.clean:
-            result.append(lambda: ard.delete_dim(
+            result.append(ard.Step(f"{key}_clean", lambda: ard.delete_dim(
                 self._create_dim_name(_polarisation, "Orb_stack_Ifg_Deb_mrg")
-            ))
+            ), [key]))
 
         # convert the final results to geotif, compress and then we are finally done!
-        result.append(lambda: ard.convert_to_tif(
+        result.append(ard.Step(f"{key}_tif", lambda: ard.convert_to_tif(
             self._create_dim_name(
                 _polarisation,
                 "Orb_stack_Ifg_Deb_mrg_DInSAR_Flt_TC",
@@ -244,15 +304,15 @@ class CoherenceChain:
                 "Orb_stack_Ifg_Deb_mrg_DInSAR_Flt_TC",
                 ".tif"
             )
-        ))
+        ), [key]))
 
         if self.clean:
-            result.append(lambda: ard.delete_dim(self._create_dim_name(
+            result.append(ard.Step(f"{key}_clean", lambda: ard.delete_dim(self._create_dim_name(
                 _polarisation,
                 "Orb_stack_Ifg_Deb_mrg_DInSAR_Flt_TC",
-            )))
+            )), [f"{key}_tif"]))
         if self.gzip:
-            result.append(lambda: ard.gzip_file(
+            result.append(ard.Step(f"{key}_gzip", lambda: ard.gzip_file(
                 create_result_name(
                     self.output_dir,
                     self.products,
@@ -267,16 +327,16 @@ class CoherenceChain:
                     "Orb_stack_Ifg_Deb_mrg_DInSAR_Flt_TC",
                     ".tif.gz"
                 ),
-            ))
+            ), [f"{key}_tif"]))
 
             if self.clean:
-                result.append(lambda: ard.delete_file(create_result_name(
+                result.append(ard.Step(f"{key}_clean", lambda: ard.delete_file(create_result_name(
                     self.output_dir,
                     self.products,
                     _polarisation,
                     "Orb_stack_Ifg_Deb_mrg_DInSAR_Flt_TC",
                     ".tif"
-                )))
+                )), [f"{key}_gzip"]))
         return result
 
 
@@ -285,4 +345,4 @@ if __name__ == "__main__":
     first_product = product_name.S1Product(args.first)
     last_product = product_name.S1Product(args.last)
     coherence = CoherenceChain(args.input, args.output, args.gzip, args.clean, first_product, last_product)
-    ard.process_chain(coherence.build_chain(), coherence.name())
+    ard.process_chain(coherence.build_chain(), coherence.name(), args.parallel)
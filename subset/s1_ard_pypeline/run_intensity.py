@@ -60,7 +60,11 @@ class IntensityChain:
         # initial chain set up and the first step of the intensity process
         chain = [
             # Unzip the product
-            lambda: ard.unzip_product(product_name.zip_path(self.input_dir, self.product), self.working_dir),
+            lambda: ard.unzip_product(
+                product_name.zip_path(self.input_dir, self.product),
+                self.working_dir,
+                self.product.polarisations(),
+            ),
             # Run orbit corrections and debursting
             lambda: ard.gpt(
                 ard.graph("S1_intensity_stage1"),
@@ -0,0 +1,185 @@
+import numpy as np
+
+from s1_ard_pypeline.utils import product_name
+
+"""
+A catalogue of S1 product names held as columns of numpy arrays, for archive listings too large to keep as one S1Product
+per name. Every name is parsed in a handful of vectorised operations, and filtering and grouping work on whole columns.
+S1Products are only created for the entries that are asked for.
+"""
+
+# Length of a valid S1 product name
+NAME_LENGTH = 67
+
+
+def _digits(characters, start, stop):
+    """
+    :param characters: (n, NAME_LENGTH) array of the bytes of each name
+    :return: the decimal number in columns start to stop of each name
+    """
+    result = np.zeros(len(characters), dtype=np.int64)
+    for column in range(start, stop):
+        result = result * 10 + (characters[:, column] - ord("0"))
+    return result
+
+
+def _seconds_of_day(characters, start):
+    return _digits(characters, start, start + 2) * 3600 + _digits(characters, start + 2, start + 4) * 60 + \
+        _digits(characters, start + 4, start + 6)
+
+
+def _timestamps(characters, date_start, time_start):
+    """
+    :return: datetime64[s] array of the date and time starting at the given columns of each name
+    """
+    years = _digits(characters, date_start, date_start + 4)
+    months = _digits(characters, date_start + 4, date_start + 6)
+    days = _digits(characters, date_start + 6, date_start + 8)
+    dates = (years - 1970).astype("datetime64[Y]").astype("datetime64[M]") + (months - 1).astype("timedelta64[M]")
+    dates = dates.astype("datetime64[D]") + (days - 1).astype("timedelta64[D]")
+    return dates.astype("datetime64[s]") + _seconds_of_day(characters, time_start).astype("timedelta64[s]")
+
+
+class Catalogue:
+    """
+    Columns of the parts of S1 product names:
+
+        names           the full product names
+        satellite       e.g. S1A
+        mode            e.g. IW
+        product_type    e.g. SLC__1SDV
+        start, stop     datetime64[s] start and stop times
+        start_time, stop_time   seconds since midnight of the start and stop times
+        orbit           absolute orbit number
+        relative_orbit  relative orbit number
+
+    Entries are referred to by their index, so numpy masks and index arrays can be used to select them.
+    """
+
+    def __init__(self, names):
+        """
+        :param names: numpy array of valid product names
+        """
+        self.names = np.asarray(names, dtype=f"S{NAME_LENGTH}")
+        characters = self.names.view(np.uint8).reshape(len(self.names), NAME_LENGTH)
+
+        self.satellite = self.names.astype("S3")
+        self.mode = np.array(characters[:, 4:6]).view("S2").ravel()
+        self.product_type = np.array(characters[:, 7:16]).view("S9").ravel()
+        self.start = _timestamps(characters, 17, 26)
+        self.stop = _timestamps(characters, 33, 42)
+        self.start_time = _seconds_of_day(characters, 26).astype(np.int32)
+        self.stop_time = _seconds_of_day(characters, 42).astype(np.int32)
+        self.orbit = _digits(characters, 49, 55).astype(np.int32)
+        self.relative_orbit = (self.orbit % 175).astype(np.int16)
+
+        self._products = {}
+
+    @classmethod
+    def from_names(cls, names):
+        """
+        Build a catalogue from product names, leaving out any that are not valid.
+
+        :param names: iterable of product names
+        :return: a Catalogue
+        """
+        return cls([name for name in names if product_name.validate(name)])
+
+    @classmethod
+    def read(cls, path):
+        """
+        Build a catalogue from a file with one product name on each line.
+
+        :param path: path to the product list
+        :return: a Catalogue
+        """
+        with open(path, 'r') as f:
+            return cls.from_names(line.strip() for line in f)
+
+    def __len__(self):
+        return len(self.names)
+
+    def name(self, index):
+        return self.names[index].decode("ascii")
+
+    def product(self, index):
+        """
+        Get the S1Product of an entry. The same object is returned each time it is asked for.
+
+        :param index: index of the entry
+        :return: an S1Product
+        """
+        index = int(index)
+        if index not in self._products:
+            self._products[index] = product_name.S1Product(self.name(index))
+        return self._products[index]
+
+    def products(self, indices=None):
+        """
+        :param indices: indices of the entries to get, or None for all of them
+        :return: list of S1Products
+        """
+        if indices is None:
+            indices = range(len(self))
+        return [self.product(i) for i in indices]
+
+    def index(self, name):
+        """
+        :param name: a product name
+        :return: the index of the first entry with that name, or None if there isn't one
+        """
+        found = np.flatnonzero(self.names == name.encode("ascii"))
+        return int(found[0]) if len(found) else None
+
+    def where(self, satellite=None, mode=None, product_type=None, relative_orbit=None, start=None, stop=None):
+        """
+        Find the entries matching every condition given.
+
+        :param satellite: e.g. "S1A"
+        :param mode: e.g. "IW"
+        :param product_type: e.g. "SLC__1SDV"
+        :param relative_orbit: a relative orbit number, or a collection of them
+        :param start: only entries starting at or after this datetime
+        :param stop: only entries starting before this datetime
+        :return: boolean mask over the entries
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if satellite is not None:
+            mask &= self.satellite == satellite.encode("ascii")
+        if mode is not None:
+            mask &= self.mode == mode.encode("ascii")
+        if product_type is not None:
+            mask &= self.product_type == product_type.encode("ascii")
+        if relative_orbit is not None:
+            mask &= np.isin(self.relative_orbit, np.atleast_1d(relative_orbit))
+        if start is not None:
+            mask &= self.start >= np.datetime64(start, "s")
+        if stop is not None:
+            mask &= self.start < np.datetime64(stop, "s")
+        return mask
+
+    def subset(self, selection):
+        """
+        :param selection: boolean mask or index array of the entries to keep
+        :return: a new Catalogue of just those entries
+        """
+        return Catalogue(self.names[selection])
+
+    def group_by_relative_orbit(self):
+        """
+        Group the entries by relative orbit, sorted by start time within each group. Groups are in the order their
+        relative orbit first appears, and entries starting at the same time keep their order.
+
+        :return: list of (relative orbit, index array) tuples
+        """
+        if len(self) == 0:
+            return []
+        orbits, first, inverse = np.unique(self.relative_orbit, return_index=True, return_inverse=True)
+        # rank each orbit by where it first appears, so the groups come out in the order of the input
+        rank = np.empty(len(orbits), dtype=np.int64)
+        rank[np.argsort(first, kind="stable")] = np.arange(len(orbits))
+        group = rank[inverse.ravel()]
+
+        order = np.lexsort((self.start, group))
+        boundaries = np.flatnonzero(np.diff(group[order])) + 1
+        return [(int(self.relative_orbit[indices[0]]), indices) for indices in np.split(order, boundaries)]
@@ -0,0 +1,101 @@
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Block parallel gzip compression, in the style of pigz.
+
+The input is split into blocks which are deflated at the same time on several threads. Each block is primed with the
+last 32K of the block before it, so the compression ratio is close to that of a single stream, and ends on a byte
+boundary so the blocks can be joined into one deflate stream. The result is a single ordinary gzip member that gunzip,
+python's gzip module and anything else that reads gzip can decompress.
+"""
+
+# Size of the blocks compressed by each thread
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Deflate can refer back at most this far, so this much of the previous block is used as the dictionary of the next
+WINDOW_SIZE = 32 * 1024
+
+
+def _compress_block(block, dictionary, last, level):
+    """
+    Deflate one block into a raw deflate stream that can be joined to the streams of the blocks either side of it.
+
+    :param block: the bytes to compress
+    :param dictionary: the end of the previous block, or None for the first block
+    :param last: True for the final block, which closes the deflate stream
+    :param level: zlib compression level
+    :return: the compressed bytes
+    """
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY,
+                                      dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def gzip_stream(source, target, threads=None, block_size=DEFAULT_BLOCK_SIZE, level=6):
+    """
+    Gzip compress everything read from one file object into another, using several threads.
+
+    Only write is called on the target so it can be anything file like, such as an upload to S3.
+
+    :param source: binary file object to read from
+    :param target: object with a write method that takes bytes
+    :param threads: number of compression threads. Defaults to the number of cores
+    :param block_size: number of bytes compressed by a thread at a time
+    :param level: zlib compression level
+    :return: the number of bytes read from the source
+    """
+    threads = threads or os.cpu_count() or 1
+
+    # gzip header: magic, deflate, no flags, modification time, no extra flags, unknown os
+    target.write(b"\x1f\x8b\x08\x00" + struct.pack("<I", int(time.time())) + b"\x00\xff")
+
+    crc = 0
+    size = 0
+    dictionary = None
+    pending = deque()
+    block = source.read(block_size)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while True:
+            # read one block ahead so we know which block is the last
+            next_block = source.read(block_size) if block else b""
+            last = not next_block
+
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            pending.append(executor.submit(_compress_block, block, dictionary, last, level))
+            dictionary = block[-WINDOW_SIZE:]
+
+            # keep a couple of blocks per thread in flight so memory use stays bounded
+            while pending and (len(pending) >= 2 * threads or last):
+                target.write(pending.popleft().result())
+
+            if last:
+                break
+            block = next_block
+
+    target.write(struct.pack("<II", crc & 0xffffffff, size & 0xffffffff))
+    return size
+
+
+def gzip_file(source, target, threads=None, block_size=DEFAULT_BLOCK_SIZE, level=6):
+    """
+    Gzip compress a file using several threads.
+
+    :param source: path to the file to compress
+    :param target: path to write the compressed file to
+    :param threads: number of compression threads. Defaults to the number of cores
+    :param block_size: number of bytes compressed by a thread at a time
+    :param level: zlib compression level
+    :return: the number of bytes read from the source
+    """
+    with open(source, "rb") as f_in:
+        with open(target, "wb") as f_out:
+            return gzip_stream(f_in, f_out, threads, block_size, level)
@@ -1,8 +1,17 @@
 import logging
+import math
 
+import numpy as np
 import rasterio
+from rasterio.windows import Window
 from shapely.geometry import Polygon
 
+# Blocks read from each band by check_data_sampled, spread evenly across it
+SAMPLE_BLOCKS = 16
+
+# Longest side of the reduced resolution read used to confirm that a band which looks constant really is
+DECIMATED_SIZE = 1024
+
 
 def combine_bounds(existing, newer):
     """
@@ -29,17 +38,161 @@ def check_data(src):
     :param src: rasterio image
     :return: True if the data pointed to is not a single value.
     """
-    for i in range(1, src.count):
+    for i in range(1, src.count + 1):
         band = src.read(i)
-        if band.size() == 0:
+        if band.size == 0:
             logging.error(f"Band {i} does not contain any data.")
             return False
-        elif np.all(band == band[0]):
-            logging.error(f"Band {i} only has a single value {band[0]}.")
+        elif np.all(band == band.flat[0]):
+            logging.error(f"Band {i} only has a single value {band.flat[0]}.")
             return False
     return True
 
 
+def sample_windows(src, band, samples=SAMPLE_BLOCKS):
+    """
+    Pick blocks spread evenly across a band of an image.
+
+    :param src: rasterio image
+    :param band: index of the band, starting at 1
+    :param samples: how many blocks to pick
+    :return: list of rasterio windows
+    """
+    block_height, block_width = src.block_shapes[band - 1]
+    rows = math.ceil(src.height / block_height)
+    columns = math.ceil(src.width / block_width)
+    count = rows * columns
+    result = []
+    for index in sorted(set(int(i * count / samples) for i in range(min(samples, count)))):
+        row, column = divmod(index, columns)
+        result.append(Window(column * block_width, row * block_height,
+                             min(block_width, src.width - column * block_width),
+                             min(block_height, src.height - row * block_height)))
+    return result
+
+
+def read_decimated(src, band, size=DECIMATED_SIZE):
+    """
+    Read a band at a reduced resolution, from its overviews if it has any.
+
+    :param src: rasterio image
+    :param band: index of the band, starting at 1
+    :param size: longest side of the array read
+    :return: numpy array
+    """
+    scale = max(1, math.ceil(max(src.width, src.height) / size))
+    return src.read(band, out_shape=(math.ceil(src.height / scale), math.ceil(src.width / scale)))
+
+
+def check_data_sampled(src, samples=SAMPLE_BLOCKS):
+    """
+    A faster check_data that only reads a sample of the blocks of each band, rather than every pixel.
+
+    A band is passed as soon as two different values are found in it. If every sampled block holds the same value the
+    whole band is read at a reduced resolution to confirm it before it is failed.
+
+    :param src: rasterio image
+    :param samples: how many blocks to read from each band
+    :return: True if the data pointed to is not a single value.
+    """
+    if src.width == 0 or src.height == 0:
+        logging.error("The image does not contain any data.")
+        return False
+
+    for i in range(1, src.count + 1):
+        first = None
+        varied = False
+        for window in sample_windows(src, i, samples):
+            block = src.read(i, window=window)
+            if first is None:
+                first = block.flat[0]
+            if not np.all(block == first):
+                varied = True
+                break
+
+        if not varied:
+            band = read_decimated(src, i)
+            if np.all(band == band.flat[0]):
+                logging.error(f"Band {i} only has a single value {band.flat[0]}.")
+                return False
+    return True
+
+
+class BandStats:
+    """
+    Statistics of a band built up a block at a time, so a band never has to be held in memory whole.
+
+        pixels      how many pixels have been seen
+        nodata      how many of them were nodata (or NaN)
+        minimum, maximum    the range of the valid pixels, None until one has been seen
+    """
+
+    def __init__(self, nodata=None):
+        """
+        :param nodata: the nodata value of the band, or None if it does not have one
+        """
+        self.nodata_value = nodata
+        self.pixels = 0
+        self.nodata = 0
+        self.minimum = None
+        self.maximum = None
+
+    def update(self, block):
+        """
+        Add a block of the band to the statistics.
+
+        :param block: numpy array
+        """
+        if np.issubdtype(block.dtype, np.floating):
+            valid = ~np.isnan(block)
+        else:
+            valid = np.ones(block.shape, dtype=bool)
+        if self.nodata_value is not None and not np.isnan(self.nodata_value):
+            valid &= block != self.nodata_value
+
+        values = block[valid]
+        self.pixels += block.size
+        self.nodata += block.size - values.size
+        if values.size == 0:
+            return
+        low = values.min()
+        high = values.max()
+        self.minimum = low if self.minimum is None else min(self.minimum, low)
+        self.maximum = high if self.maximum is None else max(self.maximum, high)
+
+    def has_data(self):
+        return self.minimum is not None
+
+    def varied(self):
+        """
+        :return: True once two different valid values have been seen
+        """
+        return self.has_data() and self.minimum != self.maximum
+
+    def nodata_fraction(self):
+        return self.nodata / self.pixels if self.pixels else 0.0
+
+
+def band_stats(src, band, complete=False):
+    """
+    Work out the statistics of a band block by block.
+
+    Unless complete is set the blocks stop being read as soon as two different values have been found, as by then the
+    band is known to hold data that is not a single value. The statistics then only cover the blocks read.
+
+    :param src: rasterio image
+    :param band: index of the band, starting at 1
+    :param complete: read every block, so the statistics cover the whole band
+    :return: tuple of BandStats and True if every block was read
+    """
+    stats = BandStats(src.nodatavals[band - 1])
+    for _, window in src.block_windows(band):
+        stats.update(src.read(band, window=window))
+        if not complete and stats.varied():
+            return stats, False
+    return stats, True
+
+
 def bounding_box_to_wkt(bbox):
     """
     Create a WKT polygon
@@ -0,0 +1,194 @@
+import csv
+import logging
+import os
+import xml.etree.ElementTree as ET
+import zipfile
+from bisect import bisect_left, bisect_right
+
+from shapely import wkt
+from shapely.geometry import Polygon
+
+from s1_ard_pypeline.utils import product_name
+
+"""
+Footprints of S1 products, so pairs can be chosen by how much ground they share before anything is downloaded.
+
+Footprints are read from the manifest.safe of each product, or from a catalogue csv such as the one exported by ASF
+Vertex. They are kept in a FootprintIndex, which holds a spatial index for each relative orbit.
+"""
+
+# Columns of an ASF Vertex csv holding the corners of each footprint, in order around the polygon
+ASF_CORNERS = [
+    ("Near Start Lon", "Near Start Lat"),
+    ("Far Start Lon", "Far Start Lat"),
+    ("Far End Lon", "Far End Lat"),
+    ("Near End Lon", "Near End Lat"),
+]
+
+# Columns that may hold the product name and a WKT footprint in a catalogue csv
+NAME_COLUMNS = ["Granule Name", "name", "product"]
+WKT_COLUMNS = ["footprint", "wkt", "stringFootprint"]
+
+
+def manifest_footprint(manifest):
+    """
+    Read the footprint of a product from its manifest.safe.
+
+    :param manifest: path to, or open file of, a manifest.safe
+    :return: shapely Polygon in longitude and latitude, or None if the manifest does not have a footprint
+    """
+    for element in ET.parse(manifest).iter():
+        if element.tag.endswith("}coordinates") or element.tag == "coordinates":
+            # gml coordinates are "lat,lon lat,lon ..."
+            points = []
+            for pair in element.text.split():
+                lat, lon = pair.split(",")
+                points.append((float(lon), float(lat)))
+            return Polygon(points)
+    return None
+
+
+def _zip_footprint(path, name):
+    with zipfile.ZipFile(path) as zipped:
+        with zipped.open(f"{name}.SAFE/manifest.safe") as manifest:
+            return manifest_footprint(manifest)
+
+
+def read_catalogue(path):
+    """
+    Read footprints from a csv with a product name column and either a WKT footprint column or the ASF corner columns.
+
+    :param path: path to the csv
+    :return: dictionary of product name to Polygon
+    """
+    result = {}
+    with open(path, 'r') as f:
+        reader = csv.DictReader(f)
+        name_column = next((c for c in NAME_COLUMNS if c in reader.fieldnames), None)
+        wkt_column = next((c for c in WKT_COLUMNS if c in reader.fieldnames), None)
+        corners = all(lon in reader.fieldnames and lat in reader.fieldnames for lon, lat in ASF_CORNERS)
+        if name_column is None or (wkt_column is None and not corners):
+            raise ValueError(f"{path} needs a product name column and a footprint column or the ASF corner columns")
+
+        for row in reader:
+            name = row[name_column].strip()
+            if not product_name.validate(name):
+                continue
+            if wkt_column is not None and row[wkt_column]:
+                result[name] = wkt.loads(row[wkt_column])
+            elif corners:
+                result[name] = Polygon([(float(row[lon]), float(row[lat])) for lon, lat in ASF_CORNERS])
+    return result
+
+
+def read_manifests(directory):
+    """
+    Read the footprints from the products in a directory, either unzipped .SAFE folders or product zips.
+
+    :param directory: the directory to look in
+    :return: dictionary of product name to Polygon
+    """
+    result = {}
+    for root, folders, files in os.walk(directory):
+        for file in files:
+            name, extension = os.path.splitext(file)
+            if file == "manifest.safe" and root.endswith(".SAFE"):
+                name = os.path.splitext(os.path.basename(root))[0]
+                found = manifest_footprint(os.path.join(root, file))
+            elif extension == ".zip" and product_name.validate(name):
+                try:
+                    found = _zip_footprint(os.path.join(root, file), name)
+                except (KeyError, zipfile.BadZipFile) as e:
+                    logging.warning(f"could not read the manifest from {file} {e}")
+                    continue
+            else:
+                continue
+            if found is not None:
+                result[name] = found
+    return result
+
+
+def read_footprints(path):
+    """
+    Read footprints from a catalogue csv or a directory of products.
+
+    :param path: path to a csv file or a directory
+    :return: dictionary of product name to Polygon
+    """
+    if os.path.isdir(path):
+        result = read_manifests(path)
+    else:
+        result = read_catalogue(path)
+    logging.info(f"read {len(result)} footprints from {path}")
+    return result
+
+
+class FootprintIndex:
+    """
+    The footprints of a set of products, with a spatial index for each relative orbit.
+
+    Each index keeps the bounding boxes of the footprints sorted by their southern edge. Products along a track mostly
+    differ by latitude, so a binary search narrows a query down to the few footprints that can touch it, and only
+    those are compared properly.
+    """
+
+    def __init__(self, footprints):
+        """
+        :param footprints: dictionary of product name to Polygon
+        """
+        self.footprints = footprints
+        self.orbits = {}
+        for name, footprint in footprints.items():
+            relative_orbit = product_name.S1Product(name).relative_orbit()
+            self.orbits.setdefault(relative_orbit, []).append((footprint.bounds, name))
+
+        # southern edges, entries and tallest footprint of each orbit
+        self.indexes = {}
+        for relative_orbit, entries in self.orbits.items():
+            entries.sort(key=lambda entry: entry[0][1])
+            tallest = max(bounds[3] - bounds[1] for bounds, _ in entries)
+            self.indexes[relative_orbit] = ([bounds[1] for bounds, _ in entries], entries, tallest)
+
+    def __len__(self):
+        return len(self.footprints)
+
+    def __contains__(self, name):
+        return name in self.footprints
+
+    def query(self, product):
+        """
+        Find the products in the same relative orbit whose footprint intersects the footprint of a product.
+
+        :param product: an S1Product
+        :return: set of product names, not including the product itself
+        """
+        footprint = self.footprints.get(product.product_name)
+        if footprint is None or product.relative_orbit() not in self.indexes:
+            return set()
+
+        south, entries, tallest = self.indexes[product.relative_orbit()]
+        left, bottom, right, top = footprint.bounds
+        low = bisect_left(south, bottom - tallest)
+        high = bisect_right(south, top)
+        return set(
+            name for bounds, name in entries[low:high]
+            if name != product.product_name and bounds[0] <= right and left <= bounds[2] and bottom <= bounds[3] and
+            self.footprints[name].intersects(footprint)
+        )
+
+    def overlap(self, first, last):
+        """
+        How much of the smaller of two footprints is covered by the other.
+
+        :param first: name of a product
+        :param last: name of a product
+        :return: percentage between 0 and 100, or None if either footprint is not known
+        """
+        a = self.footprints.get(first)
+        b = self.footprints.get(last)
+        if a is None or b is None:
+            return None
+        smaller = min(a.area, b.area)
+        if smaller == 0 or not a.intersects(b):
+            return 0.0
+        return 100.0 * a.intersection(b).area / smaller
@@ -0,0 +1,365 @@
+import json
+import logging
+import os
+import socket
+import threading
+from datetime import datetime, timedelta, timezone
+
+import botocore
+
+"""
+A queue of work shared between several machines through S3, so each worker takes the next pair when it is ready rather
+than working through a fixed list. A slow or broken machine then only holds up the pairs it is working on.
+
+The queue is a folder of objects in a bucket:
+
+    <name>/pairs/<index>        one line of work, e.g. "first product, last product"
+    <name>/claims/<index>       held by the worker processing the line. Kept fresh by a heartbeat
+    <name>/attempts/<index>-<n> one for each attempt that failed or whose worker stopped heart beating
+    <name>/done/<index>         the line has been processed
+
+Claims are made with conditional puts, so two workers can not claim the same line. A claim that has not been renewed
+for longer than the lease is taken over by another worker, and is only deleted by the worker holding it. A line that
+has failed too many times is left alone. This works with S3 and S3 compatible stores, such as MinIO, that support
+If-None-Match and If-Match on PutObject and If-Match on DeleteObject.
+"""
+
+# S3 returns these when the condition of a conditional put does not hold
+CONFLICT_CODES = ["PreconditionFailed", "ConditionalRequestConflict", "412", "409"]
+
+
+def default_worker():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _index_key(index):
+    return f"{index:08d}"
+
+
+class Job:
+    """
+    A line of work claimed from the queue.
+    """
+
+    def __init__(self, index, line, etag, attempt):
+        self.index = index
+        self.line = line
+        self.etag = etag
+        self.attempt = attempt
+
+    def __repr__(self):
+        return f"Job({self.index}, {self.line!r}, attempt {self.attempt})"
+
+
+class S3JobQueue:
+    """
+    Workers claim lines of work from a folder in S3, heart beating while they work and marking them done or failed.
+
+        with S3JobQueue(client, bucket, "batch-1") as queue:
+            for job in queue.jobs():
+                try:
+                    process(job.line)
+                    queue.complete(job)
+                except ProcessError:
+                    queue.fail(job)
+    """
+
+    def __init__(self, client, bucket, name, lease=600, attempts=3, worker=None):
+        """
+        :param client: boto3 s3 client
+        :param bucket: name of the bucket holding the queue
+        :param name: the folder in the bucket holding the queue
+        :param lease: seconds a claim lasts without a heartbeat before another worker can take the line over
+        :param attempts: how many times a line is tried before it is given up on
+        :param worker: name of this worker, recorded in its claims. Defaults to the host name and process id
+        """
+        self.client = client
+        self.bucket = bucket
+        self.name = name.strip("/")
+        self.lease = lease
+        self.attempts = attempts
+        self.worker = worker or default_worker()
+
+        self.lock = threading.Lock()
+        self.held = {}
+        self.stopping = threading.Event()
+        self.heart = None
+
+    def _key(self, folder, index=None):
+        if index is None:
+            return f"{self.name}/{folder}/"
+        return f"{self.name}/{folder}/{_index_key(index)}"
+
+    def _list(self, folder):
+        """
+        :return: dictionary of the index part of each key in a folder of the queue to its listing entry
+        """
+        prefix = self._key(folder)
+        result = {}
+        kwargs = {"Bucket": self.bucket, "Prefix": prefix}
+        while True:
+            response = self.client.list_objects_v2(**kwargs)
+            for entry in response.get("Contents", []):
+                result[entry["Key"][len(prefix):]] = entry
+            if not response.get("IsTruncated"):
+                return result
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+    def _claim_body(self, attempt):
+        return json.dumps({
+            "worker": self.worker,
+            "attempt": attempt,
+            "renewed": datetime.now(timezone.utc).isoformat(),
+        }).encode("utf-8")
+
+    def put_all(self, lines):
+        """
+        Add lines of work to the queue after any that are already in it.
+
+        :param lines: iterable of strings
+        :return: the number of lines added
+        """
+        existing = self._list("pairs")
+        start = max([int(k) for k in existing] + [-1]) + 1
+        count = 0
+        for count, line in enumerate(lines, 1):
+            self.client.put_object(Bucket=self.bucket, Key=self._key("pairs", start + count - 1),
+                                   Body=line.encode("utf-8"))
+        logging.info(f"added {count} lines to queue {self.name}")
+        return count
+
+    def status(self):
+        """
+        :return: dictionary of the number of lines that are pending, claimed, done and failed
+        """
+        pairs = self._list("pairs")
+        claims = self._list("claims")
+        done = self._list("done")
+        failed = self._failed(self._list("attempts"))
+        result = {"pending": 0, "claimed": 0, "done": 0, "failed": 0}
+        for key in pairs:
+            if key in done:
+                result["done"] += 1
+            elif key in failed:
+                result["failed"] += 1
+            elif key in claims:
+                result["claimed"] += 1
+            else:
+                result["pending"] += 1
+        return result
+
+    def _attempt_counts(self, attempts):
+        counts = {}
+        for key in attempts:
+            index = key.split("-")[0]
+            counts[index] = counts.get(index, 0) + 1
+        return counts
+
+    def _failed(self, attempts):
+        return set(k for k, v in self._attempt_counts(attempts).items() if v >= self.attempts)
+
+    def _expired(self, entry):
+        return entry["LastModified"] + timedelta(seconds=self.lease) < datetime.now(timezone.utc)
+
+    def claim(self):
+        """
+        Claim the first line of work that is not done, failed or held by a live worker.
+
+        :return: a Job, or None if there is nothing left to claim
+        """
+        pairs = self._list("pairs")
+        done = self._list("done")
+        claims = self._list("claims")
+        counts = self._attempt_counts(self._list("attempts"))
+
+        for key in sorted(pairs):
+            if key in done or counts.get(key, 0) >= self.attempts:
+                continue
+            if key in claims and not self._expired(claims[key]):
+                continue
+
+            job = self._take(int(key), key in claims, counts.get(key, 0))
+            if job is not None:
+                with self.lock:
+                    self.held[job.index] = job
+                logging.info(f"{self.worker} claimed {job} from queue {self.name}")
+                return job
+        return None
+
+    def _take(self, index, claimed, attempts):
+        """
+        Try to claim a line. Another worker may get there first, in which case None is returned.
+        """
+        key = self._key("claims", index)
+        try:
+            if claimed:
+                # the worker holding it has stopped heart beating, so take it over and count its attempt
+                response = self.client.get_object(Bucket=self.bucket, Key=key)
+                if not self._expired(response):
+                    return None
+                previous = json.loads(response["Body"].read().decode("utf-8"))
+                etag = self.client.put_object(Bucket=self.bucket, Key=key, Body=self._claim_body(attempts + 2),
+                                              IfMatch=response["ETag"])["ETag"]
+                logging.warning(f"took over line {index} of queue {self.name} from {previous.get('worker')}")
+                self._record_attempt(index, attempts + 1)
+                attempts = attempts + 1
+                if attempts >= self.attempts:
+                    logging.error(f"line {index} of queue {self.name} has failed {attempts} times. Giving up on it")
+                    self.client.delete_object(Bucket=self.bucket, Key=key, IfMatch=etag)
+                    return None
+            else:
+                etag = self.client.put_object(Bucket=self.bucket, Key=key, Body=self._claim_body(attempts + 1),
+                                              IfNoneMatch="*")["ETag"]
+        except botocore.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in CONFLICT_CODES + ["NoSuchKey"]:
+                return None
+            raise
+
+        line = self.client.get_object(Bucket=self.bucket, Key=self._key("pairs", index))["Body"].read()
+        return Job(index, line.decode("utf-8").strip(), etag, attempts + 1)
+
+    def _record_attempt(self, index, attempt):
+        self.client.put_object(Bucket=self.bucket, Key=f"{self._key('attempts', index)}-{attempt}", Body=b"")
+
+    def heartbeat(self, job):
+        """
+        Renew the claim on a job so other workers do not take it over.
+
+        :param job: a claimed Job
+        :return: True if the claim is still held, False if another worker has taken it over
+        """
+        try:
+            response = self.client.put_object(Bucket=self.bucket, Key=self._key("claims", job.index),
+                                              Body=self._claim_body(job.attempt), IfMatch=job.etag)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in CONFLICT_CODES + ["NoSuchKey"]:
+                logging.error(f"lost the claim on {job} in queue {self.name}")
+                with self.lock:
+                    self.held.pop(job.index, None)
+                return False
+            raise
+        job.etag = response["ETag"]
+        return True
+
+    def complete(self, job):
+        """
+        Mark a job as done.
+
+        :param job: a claimed Job
+        :return: None
+        """
+        self.client.put_object(Bucket=self.bucket, Key=self._key("done", job.index), Body=self.worker.encode("utf-8"))
+        self._release(job)
+
+    def fail(self, job):
+        """
+        Give a job back so it can be tried again, unless it has been tried too many times already.
+
+        :param job: a claimed Job
+        :return: None
+        """
+        self._record_attempt(job.index, job.attempt)
+        if job.attempt >= self.attempts:
+            logging.error(f"{job} has failed {job.attempt} times. Giving up on it")
+        self._release(job)
+
+    def abandon(self, job):
+        """
+        Give a job back without counting it as an attempt, e.g. one claimed ahead of time when the worker stops.
+
+        :param job: a claimed Job
+        :return: None
+        """
+        logging.info(f"{self.worker} giving back {job}")
+        self._release(job)
+
+    def abandon_all(self):
+        """
+        Give back every job this worker holds.
+
+        :return: None
+        """
+        with self.lock:
+            jobs = list(self.held.values())
+        for job in jobs:
+            self.abandon(job)
+
+    def _release(self, job):
+        """
+        Delete the claim on a job, as long as it is still this worker's. A worker that has stalled for longer than the
+        lease must not delete the claim of the worker that took the job over.
+        """
+        with self.lock:
+            self.held.pop(job.index, None)
+        key = self._key("claims", job.index)
+        etag = job.etag
+        while True:
+            try:
+                self.client.delete_object(Bucket=self.bucket, Key=key, IfMatch=etag)
+                return
+            except botocore.exceptions.ClientError as e:
+                code = e.response.get("Error", {}).get("Code")
+                if code in ["NoSuchKey", "404"]:
+                    return
+                if code not in CONFLICT_CODES:
+                    raise
+
+            # a heartbeat may have renewed the claim since, so check who holds it now
+            try:
+                response = self.client.get_object(Bucket=self.bucket, Key=key)
+            except botocore.exceptions.ClientError as e:
+                if e.response.get("Error", {}).get("Code") in ["NoSuchKey", "404"]:
+                    return
+                raise
+            holder = json.loads(response["Body"].read().decode("utf-8"))
+            if response["ETag"] == etag or holder.get("worker") != self.worker or \
+                    holder.get("attempt") != job.attempt:
+                logging.warning(f"claim on {job} in queue {self.name} is held by {holder.get('worker')}, leaving it")
+                return
+            etag = response["ETag"]
+
+    def jobs(self):
+        """
+        Claim jobs one at a time until there are none left.
+
+        :return: generator of Jobs
+        """
+        while True:
+            job = self.claim()
+            if job is None:
+                return
+            yield job
+
+    def start(self):
+        """
+        Start heart beating the claimed jobs in the background, a few times per lease.
+
+        :return: None
+        """
+        self.stopping.clear()
+        self.heart = threading.Thread(target=self._beat)
+        self.heart.daemon = True
+        self.heart.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.heart is not None:
+            self.heart.join()
+            self.heart = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _beat(self):
+        while not self.stopping.wait(self.lease / 3):
+            with self.lock:
+                jobs = list(self.held.values())
+            for job in jobs:
+                try:
+                    self.heartbeat(job)
+                except Exception as e:
+                    logging.error(f"heartbeat for {job} failed {e}")
@@ -0,0 +1,235 @@
+import logging
+import os
+import threading
+
+"""
+Fetch the products of upcoming pairs in the background while the current pair is processed.
+"""
+
+# Size assumed for a product before any has been downloaded and measured. IW SLC products are usually 4 to 8GB
+DEFAULT_PRODUCT_SIZE = 8 * 1024 ** 3
+
+
+class SkippedPair(Exception):
+    """
+    Given with a pair that was not downloaded because skip said it should not be.
+    """
+
+
+def _unique(pair):
+    """
+    :param pair: tuple of products
+    :return: the products of the pair with any repeats removed
+    """
+    return list(dict((product.product_name, product) for product in pair).values())
+
+
+class Prefetcher:
+    """
+    Downloads the products of a list of pairs in order on a background thread, staying up to depth pairs ahead of the
+    pair being processed and keeping the downloaded products within a disk budget.
+
+    A product used by several pairs is only downloaded once. It is released, and on_release is called for it, once every
+    pair that uses it has been released.
+
+    Iterate over it to get each pair once its products are on disk:
+
+        prefetcher = Prefetcher(pairs, download, path_of, depth=1)
+        for (first, last), error in prefetcher:
+            ...
+            prefetcher.release((first, last))
+    """
+
+    def __init__(self, pairs, fetch, path_of, depth=1, budget=None, on_release=None, on_fetched=None, skip=None):
+        """
+        :param pairs: list or iterable of (first product, last product) tuples
+        :param fetch: function that downloads a product to path_of(product)
+        :param path_of: function giving the local path of a product
+        :param depth: how many pairs after the one being processed can be downloaded
+        :param budget: how many bytes the downloaded products can take up. None for no limit
+        :param on_release: function called with each product once no pair needs it any more
+        :param on_fetched: function called with each product once it is on disk, e.g. to start checking it
+        :param skip: function given a pair, returning a reason not to download it or None. It is asked again before
+            each product of the pair, so a pair is dropped as soon as one of its products turns out to be unusable. A
+            skipped pair is given with a SkippedPair error
+        """
+        self.pairs = pairs
+        self.fetch = fetch
+        self.path_of = path_of
+        self.depth = depth
+        self.budget = budget
+        self.on_release = on_release
+        self.on_fetched = on_fetched
+        self.skip = skip
+
+        self.condition = threading.Condition()
+        # product name -> number of pairs using it that have not been released
+        self.refs = {}
+        # product name -> index of the last pair using it
+        self.last_use = {}
+        # a list is counted up front. Pairs from any other iterable, such as a job queue, are counted as they are taken
+        self.counted = isinstance(pairs, list)
+        if self.counted:
+            for index, pair in enumerate(pairs):
+                self._count(index, pair)
+        self.sizes = {}
+        self.released = 0
+        self.ready = {}
+        # number of pairs, once they have all been taken
+        self.total = None
+        self.failure = None
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __iter__(self):
+        index = 0
+        while True:
+            with self.condition:
+                while index not in self.ready and (self.total is None or index < self.total):
+                    self.condition.wait()
+                if index not in self.ready:
+                    break
+                pair, error = self.ready.pop(index)
+            yield pair, error
+            index = index + 1
+
+        if self.failure is not None:
+            raise self.failure
+
+    def _count(self, index, pair):
+        for product in _unique(pair):
+            self.refs[product.product_name] = self.refs.get(product.product_name, 0) + 1
+            self.last_use[product.product_name] = index
+
+    def release(self, pair):
+        """
+        Say that a pair has been processed, so its products can be removed once no other pair needs them.
+
+        :param pair: the (first product, last product) tuple
+        :return: None
+        """
+        finished = []
+        with self.condition:
+            self.released += 1
+            for product in _unique(pair):
+                self.refs[product.product_name] -= 1
+                if self.refs[product.product_name] == 0:
+                    finished.append(product)
+            self.condition.notify_all()
+
+        for product in finished:
+            if self.on_release is not None:
+                self.on_release(product)
+            with self.condition:
+                self.sizes.pop(product.product_name, None)
+                self.condition.notify_all()
+
+    def stop(self):
+        """
+        Stop downloading any more pairs.
+
+        :return: None
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def used(self):
+        return sum(self.sizes.values())
+
+    def _estimate(self):
+        if self.sizes:
+            return max(self.sizes.values())
+        return DEFAULT_PRODUCT_SIZE
+
+    def _run(self):
+        pairs = iter(self.pairs)
+        index = 0
+        try:
+            while True:
+                with self.condition:
+                    # the pair being processed plus depth more
+                    while not self.stopped and index > self.released + self.depth:
+                        self.condition.wait()
+                    if self.stopped:
+                        return
+
+                try:
+                    pair = next(pairs)
+                except StopIteration:
+                    return
+                except Exception as e:
+                    logging.error(f"Could not get the next pair to download {e}")
+                    self.failure = e
+                    return
+
+                if not self.counted:
+                    with self.condition:
+                        self._count(index, pair)
+
+                error = None
+                try:
+                    for product in pair:
+                        reason = self.skip(pair) if self.skip is not None else None
+                        if reason:
+                            raise SkippedPair(reason)
+                        self._fetch(index, product)
+                        if self.on_fetched is not None:
+                            self.on_fetched(product)
+                except Exception as e:
+                    error = e
+
+                with self.condition:
+                    self.ready[index] = (pair, error)
+                    self.condition.notify_all()
+                index = index + 1
+        finally:
+            with self.condition:
+                self.total = index
+                self.condition.notify_all()
+
+    def _fetch(self, index, product):
+        name = product.product_name
+        path = self.path_of(product)
+        with self.condition:
+            if name in self.sizes:
+                return
+            if os.path.exists(path):
+                self.sizes[name] = os.path.getsize(path)
+                return
+
+            while not self.stopped and not self._fits():
+                if not self._will_free(index):
+                    logging.warning(f"{name} does not fit in the disk budget. Downloading anyway")
+                    break
+                self.condition.wait()
+            # reserve the space while downloading
+            self.sizes[name] = self._estimate()
+
+        try:
+            self.fetch(product)
+        except Exception:
+            with self.condition:
+                self.sizes.pop(name, None)
+                self.condition.notify_all()
+            raise
+
+        with self.condition:
+            self.sizes[name] = os.path.getsize(path) if os.path.exists(path) else 0
+            self.condition.notify_all()
+
+    def _fits(self):
+        return self.budget is None or self.used() + self._estimate() <= self.budget
+
+    def _will_free(self, index):
+        """
+        Must be called with the condition held.
+
+        :param index: the index of the pair being downloaded
+        :return: True if a product on disk is only used by pairs before index, so it will be released once they have
+        been processed
+        """
+        return any(self.last_use[name] < index for name in self.sizes)
@@ -8,8 +8,13 @@ from os import path
 class S1Product(object):
     """
     S1Product contains details and helper functions for handling S1 product names.
+
+    Large product lists are better held in a catalogue.Catalogue, which makes S1Products only for the entries needed.
     """
 
+    __slots__ = ("product_name", "satellite", "SAR_mode", "product_type", "start_date", "start_time", "stop_date",
+                 "stop_time", "orbit", "image", "_start_timestamp", "_stop_timestamp")
+
     def __init__(self, name):
         self.product_name = name
         self.satellite = name[0:3]
@@ -21,6 +26,9 @@ class S1Product(object):
         self.stop_time = name[42:48]
         self.orbit = name[49:55]
         self.image = name[56:62]
+        # parsed the first time they are asked for
+        self._start_timestamp = None
+        self._stop_timestamp = None
 
     def relative_orbit(self):
         """
@@ -46,10 +54,14 @@ class S1Product(object):
             return ["hh", "hv"]
 
     def start_timestamp(self):
-        return datetime.strptime(f"{self.start_date}T{self.start_time}", "%Y%m%dT%H%M%S")
+        if self._start_timestamp is None:
+            self._start_timestamp = datetime.strptime(f"{self.start_date}T{self.start_time}", "%Y%m%dT%H%M%S")
+        return self._start_timestamp
 
     def stop_timestamp(self):
-        return datetime.strptime(f"{self.stop_date}T{self.stop_time}", "%Y%m%dT%H%M%S")
+        if self._stop_timestamp is None:
+            self._stop_timestamp = datetime.strptime(f"{self.stop_date}T{self.stop_time}", "%Y%m%dT%H%M%S")
+        return self._stop_timestamp
 
     def __eq__(self, o: object) -> bool:
         if not isinstance(o, S1Product):
@@ -1,7 +1,314 @@
 import boto3
+import botocore
+import botocore.config
+import logging
+import math
+import os
+import threading
+import time
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
 
 from s1_ard_pypeline import get_config
 
+# S3 will not accept a part smaller than this unless it is the last one
+MIN_PART_SIZE = 5 * 1024 ** 2
+
+# S3 will not accept more parts than this in one object
+MAX_PARTS = 10000
+
+# Files bigger than this are moved in parts over several connections
+MULTIPART_THRESHOLD = 64 * 1024 ** 2
+
+# Part size for multipart transfers. Files too big to move in 64 parts of the smaller size use the larger one
+MIN_CHUNK_SIZE = 64 * 1024 ** 2
+MAX_CHUNK_SIZE = 128 * 1024 ** 2
+
+# Rough throughput of a single connection to S3, used to work out how many connections to open
+STREAM_THROUGHPUT = 16 * 1024 ** 2
+
+# Connections used for a file when nothing has been measured yet, and the range they are kept in once it has
+DEFAULT_CONCURRENCY = 10
+MIN_CONCURRENCY = 4
+MAX_CONCURRENCY = 32
+
+# Up to this many keys are checked with a HEAD request each rather than by listing a prefix that may hold many thousands
+HEAD_CHECK_LIMIT = 100
+
+
+def transfer_config(size, throughput=None):
+    """
+    Choose how to move a file of a given size to or from S3.
+
+    Files over 64MB are split into 64MB parts, or 128MB parts for files over 4GB, keeping under the S3 part limit.
+    With a measured throughput enough connections are opened to carry twice that, so the number can keep growing while
+    the network has room for it.
+
+    :param size: size of the file in bytes
+    :param throughput: bytes per second measured on earlier transfers, or None
+    :return: a boto3 TransferConfig
+    """
+    chunk_size = MIN_CHUNK_SIZE if size <= 64 * MIN_CHUNK_SIZE else MAX_CHUNK_SIZE
+    chunk_size = max(chunk_size, math.ceil(size / MAX_PARTS))
+    parts = max(1, math.ceil(size / chunk_size))
+
+    if throughput:
+        concurrency = min(MAX_CONCURRENCY, max(MIN_CONCURRENCY, math.ceil(2 * throughput / STREAM_THROUGHPUT)))
+    else:
+        concurrency = DEFAULT_CONCURRENCY
+
+    return TransferConfig(
+        multipart_threshold=MULTIPART_THRESHOLD,
+        multipart_chunksize=chunk_size,
+        max_concurrency=min(concurrency, parts),
+        use_threads=True,
+    )
+
+
+class TransferStats:
+    """
+    Keeps track of how fast files are moving to and from S3.
+    """
+
+    def __init__(self, smoothing=0.3):
+        """
+        :param smoothing: weight given to the newest transfer in the running throughput
+        """
+        self.smoothing = smoothing
+        self.bytes = 0
+        self.seconds = 0.0
+        self.transfers = 0
+        self.rate = None
+        self.lock = threading.Lock()
+
+    def record(self, size, seconds):
+        """
+        :param size: bytes moved
+        :param seconds: how long it took
+        :return: None
+        """
+        with self.lock:
+            self.bytes += size
+            self.seconds += seconds
+            self.transfers += 1
+            # small files are all request overhead, so only larger ones say anything about the bandwidth
+            if size >= MULTIPART_THRESHOLD and seconds > 0:
+                rate = size / seconds
+                self.rate = rate if self.rate is None else self.smoothing * rate + (1 - self.smoothing) * self.rate
+
+    def throughput(self):
+        """
+        :return: the running throughput of large transfers in bytes per second, or None if there have not been any
+        """
+        with self.lock:
+            return self.rate
+
+    def log_summary(self):
+        with self.lock:
+            if self.seconds:
+                logging.info(f"moved {self.bytes} bytes in {self.transfers} transfers, "
+                             f"{self.bytes / self.seconds / 1024 ** 2:.1f}MB/s")
+
+
+class MultipartUpload:
+    """
+    A write only file like object that uploads everything written to it into a single S3 object using a multipart
+    upload, so data can be streamed to S3 without being written to disk first.
+
+    Parts are uploaded in the background while more data is written. Use it as a context manager so the upload is
+    completed when the block finishes, or aborted if the block raises.
+    """
+
+    def __init__(self, client, bucket, key, part_size=64 * 1024 ** 2, concurrency=4, on_complete=None):
+        """
+        :param client: boto3 s3 client
+        :param bucket: name of the bucket to upload to
+        :param key: where in S3 to put the object
+        :param part_size: bytes in each uploaded part. At least 5MB
+        :param concurrency: how many parts to upload at once
+        :param on_complete: function called with the key and size once the upload is complete
+        """
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.buffer = bytearray()
+        self.parts = []
+        self.futures = []
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        # bounds the number of parts held in memory waiting to be uploaded
+        self.slots = threading.Semaphore(2 * concurrency)
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+        self.bytes_written = 0
+        self.on_complete = on_complete
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._send(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def close(self):
+        """
+        Upload whatever is left and complete the upload.
+
+        :return: None
+        """
+        if self.buffer or not self.futures:
+            self._send(bytes(self.buffer))
+            self.buffer = bytearray()
+        try:
+            parts = [future.result() for future in self.futures]
+        except Exception:
+            self.abort()
+            raise
+        self.executor.shutdown(wait=True)
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": sorted(parts, key=lambda part: part["PartNumber"])},
+        )
+        logging.info(f"uploaded {self.bytes_written} bytes in {len(parts)} parts to {self.key}")
+        if self.on_complete is not None:
+            self.on_complete(self.key, self.bytes_written)
+
+    def abort(self):
+        """
+        Abandon the upload so S3 does not keep the parts uploaded so far.
+
+        :return: None
+        """
+        self.executor.shutdown(wait=True)
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _send(self, data):
+        self.slots.acquire()
+        number = len(self.futures) + 1
+        self.futures.append(self.executor.submit(self._upload_part, number, data))
+
+    def _upload_part(self, number, data):
+        try:
+            response = self.client.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                PartNumber=number,
+                Body=data,
+            )
+            return {"PartNumber": number, "ETag": response["ETag"]}
+        finally:
+            self.slots.release()
+
+
+class Manifest:
+    """
+    The keys under a prefix of a bucket, listed once and kept in memory, so checking whether many files are already in
+    S3 costs one paginated listing instead of a request per file.
+
+    Keys written through S3Utils are added as they are uploaded. The listing is redone once it is older than ttl
+    seconds, to pick up changes made by anything else.
+    """
+
+    def __init__(self, client, bucket, prefix, ttl=300):
+        """
+        :param client: boto3 s3 client
+        :param bucket: name of the bucket to list
+        :param prefix: only keys starting with this are listed
+        :param ttl: seconds before the listing is redone
+        """
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.ttl = ttl
+        self.keys = {}
+        self.listed_at = None
+        self.lock = threading.Lock()
+        self.refreshing = threading.Lock()
+        # keys added while a listing is being made, which it may have missed
+        self.added = None
+
+    def refresh(self):
+        """
+        List every key under the prefix again.
+
+        :return: None
+        """
+        with self.lock:
+            self.added = {}
+        keys = {}
+        try:
+            paginator = self.client.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+                for entry in page.get("Contents", []):
+                    keys[entry["Key"]] = entry["Size"]
+        except Exception:
+            with self.lock:
+                self.added = None
+            raise
+        with self.lock:
+            keys.update(self.added)
+            self.added = None
+            self.keys = keys
+            self.listed_at = time.monotonic()
+        logging.info(f"listed {len(keys)} keys under {self.prefix}")
+
+    def _stale(self):
+        with self.lock:
+            return self.listed_at is None or time.monotonic() - self.listed_at >= self.ttl
+
+    def _fresh(self):
+        if not self._stale():
+            return
+        # only one thread lists the bucket, the others wait for its result
+        with self.refreshing:
+            if self._stale():
+                self.refresh()
+
+    def add(self, key, size=0):
+        """
+        Record a key that has just been written.
+
+        :param key: the key in the bucket
+        :param size: the size of the object in bytes
+        :return: None
+        """
+        if key.startswith(self.prefix):
+            with self.lock:
+                self.keys[key] = size
+                if self.added is not None:
+                    self.added[key] = size
+
+    def __contains__(self, key):
+        self._fresh()
+        with self.lock:
+            return key in self.keys
+
+    def __len__(self):
+        self._fresh()
+        with self.lock:
+            return len(self.keys)
+
+    def size(self, key):
+        """
+        :param key: the key in the bucket
+        :return: the size of the object in bytes, or None if it is not in the bucket
+        """
+        self._fresh()
+        with self.lock:
+            return self.keys.get(key)
+
 
 class S3Utils:
     """
@@ -23,24 +330,64 @@ class S3Utils:
         self.client = session.client('s3', endpoint_url=endpoint_url)
         self.bucket = self.s3.Bucket(get_config("S3", "bucket"))
         self.gb = 1024 ** 3
+        # enough connections for several files to be moved at once, each over many connections
         self.s3_client = boto3.client(
             's3',
             aws_access_key_id=access,
             aws_secret_access_key=secret,
-            endpoint_url=endpoint_url
+            endpoint_url=endpoint_url,
+            config=botocore.config.Config(max_pool_connections=2 * MAX_CONCURRENCY),
         )
-        # Ensure that multipart uploads only happen if the size of a transfer is larger than S3's size limit for
-        # non multipart uploads, which is 5 GB. we copy using multipart at anything over 4gb
-        self.transfer_config = boto3.s3.transfer.TransferConfig(multipart_threshold=2 * self.gb, max_concurrency=10,
-                                                                multipart_chunksize=2 * self.gb, use_threads=True)
+        self.stats = TransferStats()
+        # cached listings, by prefix
+        self.manifests = {}
+        self.manifest_lock = threading.Lock()
 
-    def count(self):
+    def count(self, prefix=""):
         """
         Count the number of objects in the bucket.
 
+        Uses the key count of each page of the listing rather than making an object for every key.
+
+        :param prefix: only count keys starting with this
         :return: The number of objects in the bucket
         """
-        return sum(1 for _ in self.bucket.objects.all())
+        paginator = self.client.get_paginator("list_objects_v2")
+        return sum(page.get("KeyCount", 0) for page in paginator.paginate(Bucket=self.bucket.name, Prefix=prefix))
+
+    def exists(self, key):
+        """
+        Check a single key is in the bucket with a HEAD request.
+
+        :param key: the key to look for
+        :return: True if there is an object with that key
+        """
+        try:
+            self.client.head_object(Bucket=self.bucket.name, Key=key)
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ["404", "NoSuchKey", "NotFound"]:
+                return False
+            raise
+
+    def manifest(self, prefix, ttl=300):
+        """
+        Get the cached listing of the keys under a prefix. Use it to check many keys for existence.
+
+        :param prefix: only keys starting with this are listed
+        :param ttl: seconds before the listing is redone
+        :return: a Manifest shared by every caller asking for the same prefix
+        """
+        with self.manifest_lock:
+            if prefix not in self.manifests:
+                self.manifests[prefix] = Manifest(self.client, self.bucket.name, prefix, ttl)
+            return self.manifests[prefix]
+
+    def _written(self, key, size=0):
+        with self.manifest_lock:
+            manifests = list(self.manifests.values())
+        for manifest in manifests:
+            manifest.add(key, size)
 
     def list_files(self, prefix):
         """
@@ -56,6 +403,13 @@ class S3Utils:
 
         return filenames
 
+    def transfer_config(self, size):
+        """
+        :param size: size of the file to move in bytes
+        :return: the TransferConfig for the file, based on its size and the throughput measured so far
+        """
+        return transfer_config(size, self.stats.throughput())
+
     def fetch_file(self, path, destination):
         """
         Download a file from S3 and put it in the destination
@@ -64,7 +418,10 @@ class S3Utils:
         :param destination: where on the local file system to put the file
         :return: None
         """
-        self.bucket.download_file(path, destination)
+        size = self.s3_client.head_object(Bucket=self.bucket.name, Key=path)["ContentLength"]
+        start = time.monotonic()
+        self.s3_client.download_file(self.bucket.name, path, destination, Config=self.transfer_config(size))
+        self.stats.record(size, time.monotonic() - start)
 
     def put_file(self, source, destination):
         """
@@ -74,5 +431,54 @@ class S3Utils:
         :param destination: where in S3 to put the file.
         :return: None
         """
-        transfer = boto3.s3.transfer.S3Transfer(client=self.s3_client, config=self.transfer_config)
-        transfer.upload_file(source, self.bucket.name, destination)
+        size = os.path.getsize(source)
+        start = time.monotonic()
+        self.s3_client.upload_file(source, self.bucket.name, destination, Config=self.transfer_config(size))
+        self.stats.record(size, time.monotonic() - start)
+        self._written(destination, size)
+
+    def _move_all(self, move, transfers, concurrency):
+        def run(transfer):
+            try:
+                move(*transfer)
+            except Exception as e:
+                logging.error(f"could not move {transfer[0]} to {transfer[1]} {e}")
+                return e
+            return None
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            return list(executor.map(run, transfers))
+
+    def fetch_files(self, transfers, concurrency=4):
+        """
+        Download many files at once through the one client.
+
+        :param transfers: list of (location in S3, local destination) tuples
+        :param concurrency: how many files to move at the same time
+        :return: list with None for each file that was downloaded and the error for each one that was not
+        """
+        return self._move_all(self.fetch_file, transfers, concurrency)
+
+    def put_files(self, transfers, concurrency=4):
+        """
+        Upload many files at once through the one client.
+
+        :param transfers: list of (local source, location in S3) tuples
+        :param concurrency: how many files to move at the same time
+        :return: list with None for each file that was uploaded and the error for each one that was not
+        """
+        return self._move_all(self.put_file, transfers, concurrency)
+
+    def open_upload(self, destination, part_size=64 * 1024 ** 2, concurrency=4):
+        """
+        Start an upload that can be written to like a file, for data that is not on the local file system.
+
+        At most about (2 * concurrency + 1) * part_size bytes are held in memory.
+
+        :param destination: where in S3 to put the file.
+        :param part_size: bytes in each uploaded part.
+        :param concurrency: how many parts to upload at once
+        :return: a MultipartUpload
+        """
+        return MultipartUpload(self.s3_client, self.bucket.name, destination, part_size, concurrency,
+                               on_complete=self._written)
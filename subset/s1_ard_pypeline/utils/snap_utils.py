@@ -5,7 +5,7 @@ from os import path
 
 from packaging import version
 
-from subset.s1_ard_pypeline import get_config
+from s1_ard_pypeline import get_config
 
 
 def gpt_path():
@@ -1,14 +1,20 @@
 #!python
 import argparse
 import logging
+import multiprocessing
 import rasterio
 import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from s1_ard_pypeline.utils import product_name, data_validation
 
 """
 This script checks that the products to be fed into a coherence ard run are valid.
 
-usage: validate_coherence_input.py [-h] -input INPUT -first FIRST -last LAST
+By default only a sample of the blocks of each image is read, so a product is checked in seconds. Use -full to read
+every pixel.
+
+usage: validate_coherence_input.py [-h] -input INPUT -first FIRST -last LAST [-full FULL]
 
 Validate a geographic image
 
@@ -19,6 +25,7 @@ arguments:
                 extension)
   -last LAST    the last image name to process (should not include the file
                 extension)
+  -full FULL    read every pixel of the images rather than a sample
 """
 
 
@@ -36,6 +43,7 @@ def parse_args():
         help="the last image name to process (should not include the file extension)",
         required=True
     )
+    parser.add_argument("-full", type=bool, default=False, help="read every pixel of the images rather than a sample")
 
     _args = parser.parse_args()
 
@@ -54,24 +62,23 @@ def parse_args():
 
 def ground_control_points_to_bounds(ground_control_points):
     """
-    Work out the bounding box of an set of ground control points.
+    Work out the bounding box of an set of ground control points. Only the metadata is needed, no pixels are read.
 
     :param ground_control_points: list of ground control points
     :return: bounding box of the area covered by the
     """
-    min_x = ground_control_points[0].x
-    min_y = ground_control_points[0].y
-    max_x = ground_control_points[-1].x
-    max_y = ground_control_points[-1].y
+    xs = [gcp.x for gcp in ground_control_points]
+    ys = [gcp.y for gcp in ground_control_points]
 
-    return rasterio.coords.BoundingBox(min_x, min_y, max_x, max_y)
+    return rasterio.coords.BoundingBox(min(xs), min(ys), max(xs), max(ys))
 
 
-def validate_single_file(src, _product):
+def validate_single_file(src, _product, full=False):
     """
     Check a single S1 input file
     :param src: rasterio readable file
     :param _product: a product dictionary
+    :param full: read every pixel rather than a sample of blocks
     :return: True if the data is ok. False otherwise.
     """
 
@@ -89,11 +96,12 @@ def validate_single_file(src, _product):
     for sub_data in src.subdatasets:
         if sub_data.lower()[-2:] in polarisations:
             count = count + 1
-            src = rasterio.open(sub_data)
-            if not data_validation.check_data(src):
-                ok = False
+            with rasterio.open(sub_data) as sub_src:
+                check = data_validation.check_data if full else data_validation.check_data_sampled
+                if not check(sub_src):
+                    ok = False
 
-            bounds = ground_control_points_to_bounds(src.gcps[0])
+                bounds = ground_control_points_to_bounds(sub_src.gcps[0])
             total_bounds = data_validation.combine_bounds(total_bounds, bounds)
     if count != (3 * len(polarisations)):
         logging.error(
@@ -104,23 +112,14 @@ def validate_single_file(src, _product):
     return ok, total_bounds
 
 
-def validate_input(path, first, last):
+def validate_metadata(product_first, product_last):
     """
-    This checks that an input image is in the expected format and contains some data.
+    The checks that only need the product names, so they can be made before anything is downloaded.
 
-    This will perform all the checks even if the first check fails. This is so the user is told all the things that
-    are wrong with the images.
-
-    :param path: path to the folder containing the input zip files
-    :param first: name of the first product
-    :param last: name of the last product
-    :return: True if the products points to valid input products.
+    :param product_first: the first S1Product
+    :param product_last: the last S1Product
+    :return: True if the products can make a pair
     """
-    product_first = product_name.S1Product(first)
-    product_last = product_name.S1Product(last)
-
-    path_first = product_name.zip_manifest_path(path, product_first)
-    path_last = product_name.zip_manifest_path(path, product_last)
     ok = True
 
     # Check they are the same satellite
@@ -138,38 +137,165 @@ def validate_input(path, first, last):
         logging.error("The two images are from different relative orbits.")
         ok = False
 
+    return ok
+
+
+def validate_product(path, name, full=False):
+    """
+    Check a single downloaded product on its own, so each product only has to be checked once however many pairs it is
+    in. Takes and returns plain values so it can be run in another process.
+
+    :param path: path to the folder containing the input zip files
+    :param name: name of the product
+    :param full: read every pixel rather than a sample of blocks
+    :return: tuple of True if the product is valid, and the bounding box it covers
+    """
+    product = product_name.S1Product(name)
     # set custom logging here to info because gdal and rasterio are very chatty at debug level
     with rasterio.Env():
-        src_first = rasterio.open(path_first)
-        src_last = rasterio.open(path_last)
-        ok_first, bounds_first = validate_single_file(src_first, product_first)
-        if not ok_first:
-            logging.error("First image was invalid.")
-            ok = False
-
-        ok_last, bounds_last = validate_single_file(src_last, product_last)
-        if not ok_last:
-            logging.error("Last image was invalid.")
-            ok = False
-
-        # Now check that the images overlap.
-        # Sum up the bounds from the sub images to get the actual bounds.
-        if not data_validation.overlap(bounds_first, bounds_last):
-            logging.error(f"Images do not overlap.")
-            logging.error(f"first wkt: {data_validation.bounding_box_to_wkt(bounds_first)}")
-            logging.error(f"last wkt: {data_validation.bounding_box_to_wkt(bounds_last)}")
-            ok = False
-        else:
-            # TODO: validate that they overlap by at least 50%
-            pass
+        with rasterio.open(product_name.zip_manifest_path(path, product)) as src:
+            return validate_single_file(src, product, full)
+
+
+def validate_pair(product_first, product_last, result_first, result_last):
+    """
+    Check a pair of products from the results of validate_product for each of them.
+
+    :param product_first: the first S1Product
+    :param product_last: the last S1Product
+    :param result_first: what validate_product gave for the first product
+    :param result_last: what validate_product gave for the last product
+    :return: True if the products are valid and can make a pair
+    """
+    ok = validate_metadata(product_first, product_last)
+
+    ok_first, bounds_first = result_first
+    if not ok_first:
+        logging.error("First image was invalid.")
+        ok = False
+
+    ok_last, bounds_last = result_last
+    if not ok_last:
+        logging.error("Last image was invalid.")
+        ok = False
+
+    # Now check that the images overlap.
+    # Sum up the bounds from the sub images to get the actual bounds.
+    if bounds_first is None or bounds_last is None:
+        logging.error("The area covered by the images is not known.")
+        ok = False
+    elif not data_validation.overlap(bounds_first, bounds_last):
+        logging.error(f"Images do not overlap.")
+        logging.error(f"first wkt: {data_validation.bounding_box_to_wkt(bounds_first)}")
+        logging.error(f"last wkt: {data_validation.bounding_box_to_wkt(bounds_last)}")
+        ok = False
+    else:
+        # TODO: validate that they overlap by at least 50%
+        pass
     return ok
 
 
+def validate_input(path, first, last, full=False):
+    """
+    This checks that an input image is in the expected format and contains some data.
+
+    This will perform all the checks even if the first check fails. This is so the user is told all the things that
+    are wrong with the images.
+
+    :param path: path to the folder containing the input zip files
+    :param first: name of the first product
+    :param last: name of the last product
+    :param full: read every pixel rather than a sample of blocks
+    :return: True if the products points to valid input products.
+    """
+    return validate_pair(
+        product_name.S1Product(first),
+        product_name.S1Product(last),
+        validate_product(path, first, full),
+        validate_product(path, last, full),
+    )
+
+
+class ProductValidator:
+    """
+    Validates downloaded products in a pool of processes while other work carries on, checking each product once
+    however many pairs it is in.
+
+        validator = ProductValidator(download_dir)
+        validator.submit(product)   # as soon as it is downloaded
+        ...
+        if validator.validate(first, last):
+            process(first, last)
+    """
+
+    def __init__(self, path, processes=1, full=False, check=validate_product):
+        """
+        :param path: path to the folder containing the input zip files
+        :param processes: how many products to check at the same time
+        :param full: read every pixel rather than a sample of blocks
+        :param check: function run in the pool to check a product, taking the path, product name and full
+        """
+        self.path = path
+        self.full = full
+        self.check = check
+        # gdal is not safe to fork from a process that has other threads running, so start the workers fresh
+        self.executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+        self.lock = threading.Lock()
+        self.futures = {}
+
+    def submit(self, product):
+        """
+        Start checking a product, unless it has been already.
+
+        :param product: a downloaded S1Product
+        :return: the Future of its validate_product result
+        """
+        with self.lock:
+            if product.product_name not in self.futures:
+                self.futures[product.product_name] = self.executor.submit(self.check, self.path,
+                                                                          product.product_name, self.full)
+            return self.futures[product.product_name]
+
+    def result(self, product):
+        """
+        Wait for the check of a product, starting it if need be.
+
+        :param product: a downloaded S1Product
+        :return: what validate_product gave for it. A check that raised counts as invalid
+        """
+        future = self.submit(product)
+        try:
+            return future.result()
+        except Exception as e:
+            logging.error(f"could not validate {product.product_name} {e}")
+            return False, None
+
+    def invalid(self, product):
+        """
+        :param product: an S1Product
+        :return: True if the product has already been found to be invalid. Does not wait for a check to finish
+        """
+        with self.lock:
+            future = self.futures.get(product.product_name)
+        return future is not None and future.done() and not self.result(product)[0]
+
+    def validate(self, product_first, product_last):
+        """
+        Wait for the checks of both products and check them as a pair.
+
+        :return: True if the products are valid and can make a pair
+        """
+        return validate_pair(product_first, product_last, self.result(product_first), self.result(product_last))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
 if __name__ == '__main__':
 
     args = parse_args()
 
-    if not validate_input(args.input, args.first, args.last):
+    if not validate_input(args.input, args.first, args.last, args.full):
         logging.error("Problems found with input images")
         sys.exit(2)
     else:
@@ -1,77 +1,163 @@
 #!python
 import argparse
 import logging
+import multiprocessing
 import numpy as np
 import rasterio
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from s1_ard_pypeline.utils import data_validation
 
 """
-This checks that a geographic image result from the run tools is reasonably sensible. 
+This checks that a geographic image result from the run tools is reasonably sensible.
 
 The file must contain some data.
 The file must not be at the origin of the coordinate system.
 The file must not contain a single value.
 The number of bands must match the expected number of bands.
 
-usage: validate_result.py [-h] -input INPUT [-bands BANDS]
+The image is read a block at a time and the reading stops as soon as each band is known to hold more than one value, so
+a good result is usually passed after reading a few blocks. Use -complete to read every block and log the statistics of
+the whole image. Gzipped results (.gz) are read without unpacking them first.
+
+usage: validate_result.py [-h] -input INPUT [INPUT ...] [-bands BANDS] [-processes PROCESSES] [-complete COMPLETE]
 """
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Validate a geographic image')
-    parser.add_argument("-input", help="path to input file", required=True)
+    parser.add_argument("-input", nargs="+", help="path to input files", required=True)
     # TODO: should this be an argument? All the results we generate have one band.
     # Think leaving as a default will allow future use easier.
     parser.add_argument("-bands", type=int, help="the number of expected bands", default=1)
+    parser.add_argument("-processes", type=int, default=1, help="how many images to check at the same time")
+    parser.add_argument("-complete", type=bool, default=False,
+                        help="read every block rather than stopping once the image is known to be valid")
     return parser.parse_args()
 
 
-def validate_image(path):
+def dataset_path(path):
+    """
+    :param path: location on disk of an image, which may be gzipped
+    :return: the path for gdal to open it with
+    """
+    if path.endswith(".gz"):
+        return f"/vsigzip/{path}"
+    return path
+
+
+def corners(transform, width, height):
+    """
+    :param transform: affine transform of an image
+    :return: the top left and bottom right corners of the image in its coordinate system
+    """
+    top_left = (transform.c, transform.f)
+    bottom_right = (
+        transform.a * width + transform.b * height + transform.c,
+        transform.d * width + transform.e * height + transform.f,
+    )
+    return top_left, bottom_right
+
+
+def validate_image(path, bands=1, complete=False):
     """
     Checks an image to make sure that it is sensible.
 
     Note: This does not check that the actual data is correct apart from not being all one value.
 
     :param path: location on disk of the image to check
+    :param bands: the number of bands the image should have
+    :param complete: read every block rather than stopping once each band is known to hold more than one value
     :return: true if the image is mostly sensible.
     """
     problems = False
     # Rasterio env is required to make sure that the gdal bindings are setup correctly.
     with rasterio.Env():
         try:
-            dataset = rasterio.open(path)
+            dataset = rasterio.open(dataset_path(path))
         except Exception as e:
-            logging.error("Could not open dataset", e)
+            logging.error(f"Could not open dataset {path} {e}")
             return False
 
-        # Check the bands have sort of sensible values
-        if dataset.count != args.bands:
-            logging.error(f"There is not the required number of bands. Expected {args.bands} found {dataset.count}")
-            problems = True
-
-        if not data_validation.check_data(dataset):
-            problems = True
-
-        # Validate coordinate box doesn't cover the origin.
-        # Also make sure that it has valid coordinates.
-        if dataset.transform:
-            top_left = dataset.transform * (0, 0)
-            bottom_right = dataset.transform * (dataset.width, dataset.height)
-            if np.sign(bottom_right[0]) != np.sign(top_left[0]) and np.sign(bottom_right[1]) != np.sign(top_left[1]):
-                logging.error(f"Data set appears to be over the origin of the coordinate space.")
+        with dataset:
+            # Check the bands have sort of sensible values
+            if dataset.count != bands:
+                logging.error(f"There is not the required number of bands. Expected {bands} found {dataset.count}")
+                problems = True
+
+            if dataset.width == 0 or dataset.height == 0:
+                logging.error("The image does not contain any data.")
+                problems = True
+            else:
+                for i in range(1, dataset.count + 1):
+                    stats, read_all = data_validation.band_stats(dataset, i, complete)
+                    extent = "" if read_all else " in the blocks read"
+                    logging.info(f"{path} band {i} min {stats.minimum} max {stats.maximum} "
+                                 f"nodata {stats.nodata_fraction():.1%}{extent}")
+                    if not stats.has_data():
+                        logging.error(f"Band {i} does not contain any data.")
+                        problems = True
+                    elif not stats.varied():
+                        logging.error(f"Band {i} only has a single value {stats.minimum}.")
+                        problems = True
+
+            # Validate coordinate box doesn't cover the origin.
+            # Also make sure that it has valid coordinates.
+            if dataset.transform:
+                top_left, bottom_right = corners(dataset.transform, dataset.width, dataset.height)
+                if np.sign(bottom_right[0]) != np.sign(top_left[0]) and \
+                        np.sign(bottom_right[1]) != np.sign(top_left[1]):
+                    logging.error(f"Data set appears to be over the origin of the coordinate space.")
+                    problems = True
+            else:
+                logging.error(f"Dataset transform is missing.")
                 problems = True
-        else:
-            logging.error(f"Dataset transform is missing.")
-            problems = True
     return not problems  # return true if the image is valid
 
 
+def validate_images(paths, bands=1, processes=1, complete=False):
+    """
+    Check several images, up to processes of them at the same time.
+
+    :param paths: locations on disk of the images to check
+    :param bands: the number of bands each image should have
+    :param processes: how many images to check at the same time
+    :param complete: read every block of each image
+    :return: list of True or False for each path, in the same order. A check that raised counts as invalid
+    """
+    if processes <= 1 or len(paths) <= 1:
+        results = []
+        for p in paths:
+            try:
+                results.append(validate_image(p, bands, complete))
+            except Exception as e:
+                logging.error(f"could not validate {p} {e}")
+                results.append(False)
+        return results
+
+    # gdal is not safe to fork from a process that has other threads running, so start the workers fresh
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(processes, len(paths)), mp_context=context) as executor:
+        futures = [executor.submit(validate_image, p, bands, complete) for p in paths]
+
+    results = []
+    for p, future in zip(paths, futures):
+        if future.exception() is not None:
+            logging.error(f"could not validate {p} {future.exception()}")
+            results.append(False)
+        else:
+            results.append(future.result())
+    return results
+
+
 if __name__ == '__main__':
 
     args = parse_args()
-    if not validate_image(args.input):
-        logging.error("Found problems with the data.")
+    results = validate_images(args.input, args.bands, args.processes, args.complete)
+    if not all(results):
+        for path, ok in zip(args.input, results):
+            if not ok:
+                logging.error(f"Found problems with the data in {path}.")
         sys.exit(2)
     else:
         logging.info("No problems found.")
@@ -19,7 +19,6 @@ requirements = [
     'shapely',
     'numpy',
     'python-logstash',
-    'asynchronousfilereader',
     'boto3',
     'urljoin',
     'botocore',
@@ -0,0 +1,65 @@
+import os
+import stat
+import sys
+
+"""
+Helpers for tests that need something to stand in for snap's gpt executable.
+"""
+
+# Runs a graph the way gpt would as far as the tests can tell. Fills in the -P arguments, writes a file for every
+# Write node and fails if any node uses the Fail operator. Each run appends a line to the file in FAKE_GPT_LOG and
+# first sleeps for FAKE_GPT_STARTUP seconds to stand in for the JVM starting up.
+GRAPH_GPT = """
+import os
+import re
+import sys
+import time
+import xml.etree.ElementTree as et
+
+time.sleep(float(os.environ.get("FAKE_GPT_STARTUP", 0)))
+args = dict(arg[2:].split("=", 1) for arg in sys.argv[2:] if arg.startswith("-P"))
+with open(sys.argv[1]) as f:
+    text = re.sub(r"\\$\\{(\\w+)\\}", lambda m: args.get(m.group(1), m.group(0)), f.read())
+graph = et.fromstring(text)
+
+if "FAKE_GPT_LOG" in os.environ:
+    with open(os.environ["FAKE_GPT_LOG"], "a") as f:
+        f.write(" ".join(node.get("id") for node in graph.findall("node")) + "\\n")
+
+ids = [node.get("id") for node in graph.findall("node")]
+for node in graph.findall("node"):
+    for source in node.find("sources") if node.find("sources") is not None else []:
+        if (source.get("refid") or source.text.strip()) not in ids:
+            print("missing source", file=sys.stderr)
+            sys.exit(2)
+    operator = node.find("operator").text
+    if operator == "Fail":
+        sys.exit(1)
+    if operator == "Write":
+        with open(node.find("parameters/file").text, "w") as f:
+            f.write(node.get("id"))
+"""
+
+
+def make_fake_gpt(directory, source):
+    """
+    Write an executable that runs the python source with the arguments it is given.
+
+    :param directory: where to put the executable
+    :param source: python source for the fake gpt
+    :return: path to the executable
+    """
+    script = os.path.join(directory, "fake_gpt.py")
+    with open(script, "w") as f:
+        f.write(source)
+
+    if sys.platform == "win32":
+        executable = os.path.join(directory, "gpt.bat")
+        with open(executable, "w") as f:
+            f.write(f'@"{sys.executable}" "{script}" %*\n')
+    else:
+        executable = os.path.join(directory, "gpt")
+        with open(executable, "w") as f:
+            f.write(f"#!/bin/sh\nexec '{sys.executable}' '{script}' \"$@\"\n")
+        os.chmod(executable, os.stat(executable).st_mode | stat.S_IEXEC)
+    return executable
@@ -1,8 +1,15 @@
 import logging
 import os
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
+from zipfile import ZipFile
 
 from s1_ard_pypeline.ard import ard
+from s1_ard_pypeline.utils import snap_utils
+from tests.ard.fake_gpt import make_fake_gpt
 
 
 class TestARDTools(unittest.TestCase):
@@ -68,6 +75,216 @@ class TestARDTools(unittest.TestCase):
             ]
         )
 
+    def test_process_chain_dependencies_in_order(self):
+        order = []
+        process = [
+            ard.Step("a", lambda: order.append("a"), []),
+            ard.Step("b", lambda: order.append("b"), ["a"]),
+            ard.Step("c", lambda: order.append("c"), ["a"]),
+            lambda: order.append("d"),
+        ]
+        ard.process_chain(process, "test")
+        self.assertEqual(["a", "b", "c", "d"], order)
+
+    def test_process_chain_parallel(self):
+        """
+        Independent steps should run at the same time. Neither step can get past the barrier unless both are running.
+        """
+        barrier = threading.Barrier(2, timeout=5)
+        order = []
+        process = [
+            ard.Step("a", lambda: barrier.wait(), []),
+            ard.Step("b", lambda: barrier.wait(), []),
+            ard.Step("c", lambda: order.append("c"), ["a", "b"]),
+        ]
+        ard.process_chain(process, "test", parallelism=2)
+        self.assertEqual(["c"], order)
+
+    def test_process_chain_waits_for_dependencies(self):
+        first_done = threading.Event()
+        process = [
+            ard.Step("a", lambda: first_done.set(), []),
+            ard.Step("b", lambda: self.assertTrue(first_done.is_set()), ["a"]),
+            ard.Step("c", lambda: self.assertTrue(first_done.is_set())),
+        ]
+        ard.process_chain(process, "test", parallelism=4)
+
+    def test_process_chain_fail_parallel(self):
+        process = [
+            ard.Step("a", lambda: self._boom(), []),
+            ard.Step("b", lambda: self.fail("should not get here"), ["a"]),
+        ]
+        with self.assertRaises(ard.ProcessError):
+            ard.process_chain(process, "test", parallelism=2)
+
+    def test_process_chain_unknown_dependency(self):
+        process = [
+            ard.Step("a", lambda: self.fail("should not get here"), ["b"]),
+            ard.Step("b", lambda: True, []),
+        ]
+        with self.assertRaises(ard.ProcessError):
+            ard.process_chain(process, "test")
+
+
+
+PRODUCT = "S1B_IW_SLC__1SDV_20170502T231339_20170502T231407_005426_009835_C052"
+
+
+class TestUnzipProduct(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.zip = os.path.join(self.directory.name, f"{PRODUCT}.zip")
+        self.destination = os.path.join(self.directory.name, "working")
+        safe = f"{PRODUCT}.SAFE"
+        self.members = {
+            f"{safe}/manifest.safe": b"manifest",
+            f"{safe}/support/s1-object-types.xsd": b"schema",
+            f"{safe}/preview/quick-look.png": b"png" * 100,
+            f"{safe}/preview/icons/logo.png": b"logo",
+        }
+        for swath in ["iw1", "iw2", "iw3"]:
+            for polarisation in ["vh", "vv"]:
+                name = f"s1b-{swath}-slc-{polarisation}-20170502t231339-20170502t231407-005426-009835-001"
+                self.members[f"{safe}/measurement/{name}.tiff"] = os.urandom(1000)
+                self.members[f"{safe}/annotation/{name}.xml"] = b"annotation"
+                self.members[f"{safe}/annotation/calibration/calibration-{name}.xml"] = b"calibration"
+                self.members[f"{safe}/annotation/calibration/noise-{name}.xml"] = b"noise"
+        with ZipFile(self.zip, "w") as f:
+            for name, data in self.members.items():
+                f.writestr(name, data)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _extracted(self):
+        result = []
+        for root, _, files in os.walk(self.destination):
+            for file in files:
+                result.append(os.path.relpath(os.path.join(root, file), self.destination).replace(os.sep, "/"))
+        return sorted(result)
+
+    def test_unzip_all(self):
+        ard.unzip_product(self.zip, self.destination, threads=4)
+        expected = sorted(name for name in self.members if "/preview/" not in name)
+        self.assertEqual(expected, self._extracted())
+        for name in expected:
+            with open(os.path.join(self.destination, name), "rb") as f:
+                self.assertEqual(self.members[name], f.read())
+
+    def test_unzip_one_polarisation(self):
+        ard.unzip_product(self.zip, self.destination, ["vv"])
+        extracted = self._extracted()
+
+        self.assertEqual(len(self.members) - 2 - 12, len(extracted))
+        self.assertFalse([name for name in extracted if "-vh-" in name])
+        self.assertIn(f"{PRODUCT}.SAFE/manifest.safe", extracted)
+
+    def test_unzip_adds_missing(self):
+        ard.unzip_product(self.zip, self.destination, ["vv"])
+        manifest = os.path.join(self.destination, f"{PRODUCT}.SAFE", "manifest.safe")
+        modified = os.path.getmtime(manifest) - 100
+        os.utime(manifest, (modified, modified))
+
+        ard.unzip_product(self.zip, self.destination, ["vh", "vv"])
+
+        self.assertEqual(len(self.members) - 2, len(self._extracted()))
+        # files that were already there are left alone
+        self.assertEqual(modified, os.path.getmtime(manifest))
+
+    def test_unzip_missing_zip(self):
+        with self.assertRaises(ard.ProcessError):
+            ard.unzip_product(os.path.join(self.directory.name, "missing.zip"), self.destination)
+
+    def test_unzip_many_new_folders(self):
+        # threads extracting into the same new folders must not trip over each other making them
+        many = os.path.join(self.directory.name, "many.zip")
+        with ZipFile(many, "w") as f:
+            f.writestr(f"{PRODUCT}.SAFE/support/", b"")
+            for folder in range(40):
+                for name in range(8):
+                    f.writestr(f"{PRODUCT}.SAFE/folder{folder}/deeper/file{name}.xml", b"x")
+        for attempt in range(5):
+            destination = os.path.join(self.directory.name, f"many{attempt}")
+            ard.unzip_product(many, destination, threads=16)
+            self.assertEqual(320, len([f for _, _, files in os.walk(destination) for f in files]))
+            self.assertTrue(os.path.isdir(os.path.join(destination, f"{PRODUCT}.SAFE", "support")))
+
+    def test_unzip_corrupt_member(self):
+        with open(self.zip, "rb") as f:
+            data = f.read()
+        # damage the contents of the manifest so its checksum does not match
+        start = data.index(self.members[f"{PRODUCT}.SAFE/manifest.safe"])
+        with open(self.zip, "wb") as f:
+            f.write(data[:start] + b"X" + data[start + 1:])
+        with self.assertRaises(ard.ProcessError):
+            ard.unzip_product(self.zip, self.destination, threads=4)
+
+
+
+# Stands in for snap's gpt. Prints a line to each stream, goes quiet for the time given by -Psleep and exits with the
+# status given by -Pexit
+FAKE_GPT = """
+import sys
+import time
+
+args = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if arg.startswith("-P"))
+print("fake gpt starting", flush=True)
+print("fake gpt warning", file=sys.stderr, flush=True)
+time.sleep(float(args.get("sleep", 0)))
+print("fake gpt done", flush=True)
+sys.exit(int(args.get("exit", 0)))
+"""
+
+
+class TestRunSnapCommand(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        executable = make_fake_gpt(self.directory.name, FAKE_GPT)
+        self.env = mock.patch.dict(os.environ, {"SNAP_GPT": executable})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.directory.cleanup()
+
+    def test_output_forwarded(self):
+        with self.assertLogs("snap_stdout", level="INFO") as stdout, \
+                self.assertLogs("snap_stderr", level="INFO") as stderr:
+            ard.gpt("graph.xml", {"sleep": 0})
+
+        self.assertEqual(["fake gpt starting", "fake gpt done"], [r.getMessage() for r in stdout.records])
+        self.assertEqual(["stderr:fake gpt warning"], [r.getMessage() for r in stderr.records])
+
+    def test_non_zero_exit(self):
+        with self.assertRaises(ard.ProcessError):
+            ard.gpt("graph.xml", {"exit": 3})
+
+    def test_missing_executable(self):
+        with mock.patch.dict(os.environ, {"SNAP_GPT": os.path.join(self.directory.name, "missing")}):
+            with self.assertRaises(ard.ProcessError):
+                ard.gpt("graph.xml", {})
+
+    def test_executable_from_snap_install(self):
+        with mock.patch.dict(os.environ, {"SNAP_PATH": self.directory.name}):
+            del os.environ["SNAP_GPT"]
+            self.assertEqual(os.path.join(self.directory.name, "bin", snap_utils.executable_name("gpt")),
+                             ard.gpt_executable())
+
+    def test_idle_cpu(self):
+        """
+        While snap is running but quiet we should be waiting on it, not spinning.
+        """
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        ard.gpt("graph.xml", {"sleep": 1})
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+
+        self.assertGreaterEqual(wall, 1)
+        self.assertLess(cpu, 0.1 * wall)
+
 
 def log_output(log, a, b):
     return lambda: log.info(f"('{a}', '{b}')")
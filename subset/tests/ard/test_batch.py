@@ -0,0 +1,156 @@
+import os
+import tempfile
+import time
+import unittest
+import xml.etree.ElementTree as et
+from unittest import mock
+
+from s1_ard_pypeline.ard import batch
+from tests.ard.fake_gpt import GRAPH_GPT, make_fake_gpt
+
+GRAPH = """<graph id="Graph">
+    <version>1.0</version>
+    <node id="Read">
+        <operator>Read</operator>
+        <sources/>
+        <parameters>
+            <file>${input}</file>
+        </parameters>
+    </node>
+    <node id="Write">
+        <operator>${operator}</operator>
+        <sources>
+            <sourceProduct refid="Read"/>
+        </sources>
+        <parameters>
+            <file>${output}</file>
+        </parameters>
+    </node>
+</graph>
+"""
+
+# Seconds the fake gpt takes to start, standing in for the JVM
+STARTUP = 0.2
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.graph = os.path.join(self.directory.name, "graph.xml")
+        with open(self.graph, "w") as f:
+            f.write(GRAPH)
+        self.log = os.path.join(self.directory.name, "gpt.log")
+        self.env = mock.patch.dict(os.environ, {
+            "SNAP_GPT": make_fake_gpt(self.directory.name, GRAPH_GPT),
+            "FAKE_GPT_LOG": self.log,
+            "FAKE_GPT_STARTUP": str(STARTUP),
+        })
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.directory.cleanup()
+
+    def _job(self, i, operator="Write"):
+        return self.graph, {
+            "input": f"input_{i}.zip",
+            "output": os.path.join(self.directory.name, f"output_{i}.tif"),
+            "operator": operator,
+        }
+
+    def _invocations(self):
+        if not os.path.exists(self.log):
+            return 0
+        with open(self.log) as f:
+            return len(f.readlines())
+
+    def test_merge_graphs(self):
+        merged = et.fromstring(batch.merge_graphs([self._job(0), self._job(1)]))
+        nodes = merged.findall("node")
+
+        self.assertEqual(["job0_Read", "job0_Write", "job1_Read", "job1_Write"], [n.get("id") for n in nodes])
+        self.assertEqual("job1_Read", nodes[3].find("sources/sourceProduct").get("refid"))
+        self.assertEqual("input_1.zip", nodes[2].find("parameters/file").text)
+
+    def test_merge_graphs_shares_nodes(self):
+        jobs = [(self.graph, dict(self._job(i)[1], input="tile.zip")) for i in range(3)]
+        merged = et.fromstring(batch.merge_graphs(jobs))
+        nodes = merged.findall("node")
+
+        self.assertEqual(["job0_Read", "job0_Write", "job1_Write", "job2_Write"], [n.get("id") for n in nodes])
+        self.assertEqual(["job0_Read"] * 3, [n.find("sources/sourceProduct").get("refid") for n in nodes[1:]])
+
+        unshared = et.fromstring(batch.merge_graphs(jobs, share_nodes=False))
+        self.assertEqual(6, len(unshared.findall("node")))
+
+    def test_merge_subset_graph(self):
+        """
+        A batch of subsets of one Sentinel 1 tile should read the tile once and fan out to a branch per polygon.
+        """
+        graph = os.path.join(os.path.dirname(__file__), "..", "..", "graphs", "subset_and_convert.xml")
+        jobs = [(graph, {"count": str(i).zfill(5), "confidence": 1, "polygon": f"POLYGON (({i} 0, {i} 1, 0 1, {i} 0))",
+                         "supplierId": "S1A_IW_GRDH", "tilepath": "tiles", "tifpath": "tifs", "size": 256})
+                for i in range(4)]
+        merged = et.fromstring(batch.merge_graphs(jobs))
+        operators = [n.findtext("operator") for n in merged.findall("node")]
+
+        self.assertEqual(1, operators.count("Read"))
+        self.assertEqual(4, operators.count("Subset"))
+        self.assertEqual(4, operators.count("Convert-Datatype"))
+        self.assertEqual(4, operators.count("Write"))
+
+    def test_merge_graphs_escapes_arguments(self):
+        merged = et.fromstring(batch.merge_graphs([(self.graph, {"input": "a&b<c"})]))
+        self.assertEqual("a&b<c", merged.find("node/parameters/file").text)
+        self.assertEqual("${output}", merged.findall("node")[1].find("parameters/file").text)
+
+    def test_run_batch(self):
+        jobs = [self._job(i) for i in range(5)]
+        self.assertEqual([None] * 5, batch.run_batch(jobs))
+        self.assertEqual(1, self._invocations())
+        for _, args in jobs:
+            self.assertTrue(os.path.exists(args["output"]))
+
+    def test_run_batch_failure_falls_back(self):
+        jobs = [self._job(0), self._job(1, "Fail"), self._job(2)]
+        errors = batch.run_batch(jobs)
+
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], batch.ard.ProcessError)
+        self.assertIsNone(errors[2])
+        # the batch and then each job on its own
+        self.assertEqual(4, self._invocations())
+
+    def test_pool_dispatch_overhead(self):
+        """
+        Running the jobs through the pool should pay the start up once per batch rather than once per job.
+        """
+        jobs = 12
+        start = time.perf_counter()
+        with batch.GptPool(batch_size=jobs, linger=0.1) as pool:
+            futures = [pool.submit(*self._job(i)) for i in range(jobs)]
+        pooled = time.perf_counter() - start
+
+        self.assertEqual([None] * jobs, [f.exception() for f in futures])
+        self.assertEqual(1, self._invocations())
+        # one process per job would take at least jobs * STARTUP
+        self.assertLess(pooled, jobs * STARTUP / 2)
+
+    def test_pool_submit_batch(self):
+        with batch.GptPool(batch_size=2, linger=0.1) as pool:
+            futures = pool.submit_batch([self._job(i) for i in range(5)])
+
+        self.assertEqual([None] * 5, [f.exception() for f in futures])
+        self.assertEqual(1, self._invocations())
+
+    def test_pool_batch_size(self):
+        with batch.GptPool(batch_size=4, workers=2, linger=0.1) as pool:
+            futures = [pool.submit(*self._job(i)) for i in range(10)]
+
+        self.assertTrue(all(f.done() for f in futures))
+        self.assertEqual(3, self._invocations())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from s1_ard_pypeline import _config
+from s1_ard_pypeline.ard import ard
+from s1_ard_pypeline.ard.cache import ProductCache, cache_key
+from s1_ard_pypeline.run_coherence import CoherenceChain
+from s1_ard_pypeline.utils import product_name
+
+PRODUCTS = [
+    product_name.S1Product("S1B_IW_SLC__1SDV_20170502T231339_20170502T231407_005426_009835_C052"),
+    product_name.S1Product("S1B_IW_SLC__1SDV_20170514T231340_20170514T231408_005601_009D4C_4D2C"),
+    product_name.S1Product("S1B_IW_SLC__1SDV_20170526T231341_20170526T231409_005776_00A20D_9A5E"),
+]
+
+
+def _write_targets(graph_path, args):
+    for key, value in args.items():
+        if key.startswith("target"):
+            with open(value, "w") as f:
+                f.write(graph_path)
+
+
+class TestProductCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.output = os.path.join(self.directory.name, "orb.dim")
+        self.key = cache_key("graph.xml", {"input": "a.SAFE", "target": self.output})
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _create(self):
+        with open(self.output, "w") as f:
+            f.write("dim")
+
+    def test_cache_key(self):
+        self.assertEqual(self.key, cache_key("graph.xml", {"target": self.output, "input": "a.SAFE"}))
+        self.assertNotEqual(self.key, cache_key("graph.xml", {"input": "b.SAFE", "target": self.output}))
+
+    def test_produce_once(self):
+        cache = ProductCache()
+        cache.retain(self.key)
+        cache.retain(self.key)
+        create = mock.Mock(side_effect=self._create)
+
+        self.assertTrue(cache.produce(self.key, [self.output], create))
+        self.assertFalse(cache.produce(self.key, [self.output], create))
+        self.assertEqual(1, create.call_count)
+
+    def test_produce_again_if_outputs_missing(self):
+        cache = ProductCache()
+        create = mock.Mock(side_effect=self._create)
+
+        cache.produce(self.key, [self.output], create)
+        os.remove(self.output)
+        cache.produce(self.key, [self.output], create)
+        self.assertEqual(2, create.call_count)
+
+    def test_release_removes_after_last_user(self):
+        cache = ProductCache()
+        cache.retain(self.key)
+        cache.retain(self.key)
+        cache.produce(self.key, [self.output], self._create)
+
+        with mock.patch.object(ard, "delete_dim") as delete_dim:
+            cache.release(self.key)
+            delete_dim.assert_not_called()
+            self.assertEqual(1, cache.refs(self.key))
+
+            cache.release(self.key)
+            delete_dim.assert_called_once_with(self.output)
+            self.assertEqual(0, cache.refs(self.key))
+
+    def test_release_keeps_files_without_clean(self):
+        cache = ProductCache(clean=False)
+        cache.retain(self.key)
+        cache.produce(self.key, [self.output], self._create)
+
+        with mock.patch.object(ard, "delete_dim") as delete_dim:
+            cache.release(self.key)
+            delete_dim.assert_not_called()
+
+    def test_consecutive_pairs_share_stage1(self):
+        """
+        The middle product of two consecutive pairs should only be split into swaths once, and the swaths kept until
+        the second pair is done with them.
+        """
+        _config.set("Dirs", "working", self.directory.name)
+        cache = ProductCache()
+        chains = [CoherenceChain("input", self.directory.name, first, last, False, True, cache)
+                  for first, last in zip(PRODUCTS, PRODUCTS[1:])]
+        for chain in chains:
+            cache.retain_all(chain.cache_keys())
+
+        stage1_inputs = []
+
+        def fake_gpt(graph_path, args):
+            if "stage1" in graph_path:
+                stage1_inputs.append(args["input"])
+            _write_targets(graph_path, args)
+
+        middle = product_name.create_result_name(self.directory.name, PRODUCTS[1], "vv", "Orb_iw1", ".dim")
+        with mock.patch.object(ard, "gpt", side_effect=fake_gpt), \
+                mock.patch.object(ard, "unzip_product"), \
+                mock.patch.object(ard, "delete_dim"), \
+                mock.patch.object(ard, "convert_to_tif"):
+            ard.process_chain(chains[0].build_chain(), chains[0].name())
+            self.assertTrue(os.path.exists(middle))
+            ard.process_chain(chains[1].build_chain(), chains[1].name())
+            deleted = [c[0][0] for c in ard.delete_dim.call_args_list]
+
+        # two polarisations of three products
+        self.assertEqual(6, len(stage1_inputs))
+        self.assertEqual(2, stage1_inputs.count(product_name.manifest_path(self.directory.name, PRODUCTS[1])))
+        self.assertEqual(1, deleted.count(middle))
+        self.assertEqual(0, cache.refs(chains[1].cache_keys()[0]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,279 @@
+import hashlib
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.cookiejar import Cookie, MozillaCookieJar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from s1_ard_pypeline import asf_downloader
+from s1_ard_pypeline.utils import s3_utils
+from tests import test_download
+from tests.utils.test_s3_utils import FakeListingClient
+
+FILES = dict((f"/S1B_{i}.zip", bytes([i]) * (3 * 1024 ** 2 + i)) for i in range(4))
+
+SESSION = "urs_user_already_logged=yes"
+
+
+METALINK = """<?xml version="1.0"?>
+<metalink xmlns="http://www.metalinker.org/" version="3.0">
+  <files>
+    <file name="S1B_0.zip">
+      <resources><url type="http">{url}</url></resources>
+      <verification><hash type="md5">{md5}</hash></verification>
+      <size>{size}</size>
+    </file>
+  </files>
+</metalink>
+"""
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    """
+    Serves FILES to requests carrying the session cookie, keeping track of how many are served at once. Honours range
+    requests, and the first response can be cut off part way through.
+    """
+
+    def do_GET(self):
+        self.server.ranges.append(self.headers.get("Range"))
+        if SESSION not in (self.headers.get("Cookie") or ""):
+            self.send_error(401)
+            return
+        if self.path not in FILES:
+            self.send_error(404)
+            return
+
+        with self.server.lock:
+            self.server.active += 1
+            self.server.most_active = max(self.server.most_active, self.server.active)
+        try:
+            time.sleep(self.server.delay)
+            body = FILES[self.path]
+            start = 0
+            match = re.match(r"bytes=(\d+)-", self.headers.get("Range") or "")
+            if match:
+                start = int(match.group(1))
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(len(body) - start))
+            self.end_headers()
+            if self.server.cut_after:
+                self.wfile.write(body[start:start + self.server.cut_after])
+                self.server.cut_after = 0
+            else:
+                self.wfile.write(body[start:])
+            self.close_connection = True
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeS3Utils(test_download.FakeS3Utils):
+
+    def __init__(self, existing=()):
+        super().__init__()
+        self.listing = FakeListingClient(existing)
+
+    def manifest(self, prefix, ttl=300):
+        return s3_utils.Manifest(self.listing, "bucket", prefix, ttl)
+
+    def exists(self, key):
+        return key in self.listing.sizes
+
+    def put_file(self, source, destination):
+        with open(source, "rb") as f:
+            self.client.objects[destination] = f.read()
+
+
+def _session_cookie(downloader):
+    downloader.cookie_jar = MozillaCookieJar()
+    name, value = SESSION.split("=")
+    downloader.cookie_jar.set_cookie(Cookie(0, name, value, None, False, "127.0.0.1", False, False, "/", True, False,
+                                            None, True, None, None, {}))
+    return True
+
+
+class TestBulkDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ArchiveHandler)
+        self.server.lock = threading.Lock()
+        self.server.active = 0
+        self.server.most_active = 0
+        self.server.delay = 0.2
+        self.server.ranges = []
+        self.server.cut_after = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _downloader(self, threads, existing=()):
+        self.s3 = FakeS3Utils(existing)
+        patches = [
+            mock.patch.object(sys, "argv", ["asf_downloader.py", f"--threads={threads}"]),
+            mock.patch.object(asf_downloader.s3_utils, "S3Utils", return_value=self.s3),
+            mock.patch.object(asf_downloader.bulk_downloader, "get_cookie", autospec=True,
+                              side_effect=_session_cookie),
+            mock.patch.object(asf_downloader, "UPLOAD_PART_SIZE", s3_utils.MIN_PART_SIZE),
+            mock.patch.object(asf_downloader, "CHUNK_SIZE", 1024 ** 2),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        downloader = asf_downloader.bulk_downloader()
+        downloader.files = [self.base + path for path in sorted(FILES)]
+        downloader.partial_dir = self.directory.name
+        return downloader
+
+    def test_downloads_at_once_into_s3(self):
+        downloader = self._downloader(threads=2)
+        downloader.download_files()
+
+        for path, body in FILES.items():
+            self.assertEqual(body, self.s3.client.objects[f"iipcom/download{path}"])
+        self.assertEqual(4, len(downloader.success))
+        self.assertEqual(sum(len(body) for body in FILES.values()), downloader.total_bytes)
+        # the pool is bounded by the number of threads
+        self.assertEqual(2, self.server.most_active)
+        self.assertGreater(downloader.wall_time, 0)
+
+    def test_existing_and_missing_files(self):
+        downloader = self._downloader(threads=3, existing=["iipcom/download/S1B_0.zip"])
+        downloader.files.append(self.base + "/S1B_missing.zip")
+        downloader.download_files()
+
+        self.assertEqual([self.base + "/S1B_0.zip"], downloader.skipped)
+        self.assertEqual([self.base + "/S1B_missing.zip"], downloader.failed)
+        self.assertEqual(3, len(downloader.success))
+        self.assertNotIn("iipcom/download/S1B_0.zip", self.s3.client.objects)
+
+    def test_many_files_are_checked_against_one_listing(self):
+        downloader = self._downloader(threads=2, existing=["iipcom/download/S1B_0.zip"])
+        self.assertTrue(downloader.in_s3("iipcom/download/S1B_0.zip"))
+        self.assertEqual(0, self.s3.listing.list_calls)
+
+        downloader.files = [f"{self.base}/S1B_{i}.zip" for i in range(s3_utils.HEAD_CHECK_LIMIT + 1)]
+        self.assertTrue(downloader.in_s3("iipcom/download/S1B_0.zip"))
+        self.assertFalse(downloader.in_s3("iipcom/download/S1B_1.zip"))
+        self.assertEqual(1, self.s3.listing.list_calls)
+
+    def test_interrupted_download_is_resumed(self):
+        self.server.delay = 0
+        self.server.cut_after = 1024 ** 2
+        downloader = self._downloader(threads=1)
+        url = self.base + "/S1B_1.zip"
+        downloader.files = [url]
+        downloader.download_files()
+
+        self.assertEqual([url], [success["file"] for success in downloader.success])
+        self.assertEqual(FILES["/S1B_1.zip"], self.s3.client.objects["iipcom/download/S1B_1.zip"])
+        self.assertEqual([None, f"bytes={1024 ** 2}-"], self.server.ranges)
+        # nothing is left behind once the file is in S3
+        self.assertEqual([], os.listdir(self.directory.name))
+
+    def test_interrupted_stream_is_resumed(self):
+        self.server.delay = 0
+        self.server.cut_after = 1024 ** 2
+        downloader = self._downloader(threads=2)
+        url = self.base + "/S1B_1.zip"
+        downloader.files = [url]
+        downloader.download_files()
+
+        self.assertEqual([url], [success["file"] for success in downloader.success])
+        self.assertEqual(FILES["/S1B_1.zip"], self.s3.client.objects["iipcom/download/S1B_1.zip"])
+        self.assertEqual([None, f"bytes={1024 ** 2}-"], self.server.ranges)
+        self.assertEqual([], self.s3.client.aborted)
+
+    def test_stream_not_resumable_is_not_uploaded(self):
+        self.server.delay = 0
+        self.server.cut_after = 1024 ** 2
+        downloader = self._downloader(threads=2)
+        downloader.files = [self.base + "/S1B_1.zip"]
+        with mock.patch.object(downloader, "get_range_total", return_value=5000):
+            downloader.download_files()
+
+        self.assertEqual(downloader.files, downloader.failed)
+        self.assertNotIn("iipcom/download/S1B_1.zip", self.s3.client.objects)
+        self.assertEqual(["iipcom/download/S1B_1.zip"], self.s3.client.aborted)
+
+    def test_partial_file_from_earlier_run_is_resumed(self):
+        self.server.delay = 0
+        downloader = self._downloader(threads=1)
+        url = self.base + "/S1B_2.zip"
+        part_path, state_path = downloader.partial_paths(url)
+        with open(part_path, "wb") as f:
+            f.write(FILES["/S1B_2.zip"][:1000])
+        downloader.save_partial(url, state_path, len(FILES["/S1B_2.zip"]))
+
+        self.assertEqual((len(FILES["/S1B_2.zip"]),) * 2, downloader.download_file_with_cookiejar(url, 1, 1))
+        self.assertEqual(FILES["/S1B_2.zip"], self.s3.client.objects["iipcom/download/S1B_2.zip"])
+        self.assertEqual(["bytes=1000-"], self.server.ranges)
+
+    def test_changed_file_is_downloaded_again(self):
+        self.server.delay = 0
+        downloader = self._downloader(threads=1)
+        url = self.base + "/S1B_2.zip"
+        part_path, state_path = downloader.partial_paths(url)
+        with open(part_path, "wb") as f:
+            f.write(b"x" * 1000)
+        downloader.save_partial(url, state_path, 5000)
+
+        downloader.download_file_with_cookiejar(url, 1, 1)
+        self.assertEqual(FILES["/S1B_2.zip"], self.s3.client.objects["iipcom/download/S1B_2.zip"])
+        self.assertEqual(["bytes=1000-", None], self.server.ranges)
+
+    def _metalink(self, md5):
+        path = os.path.join(self.directory.name, "downloads.metalink")
+        with open(path, "w") as f:
+            f.write(METALINK.format(url=self.base + "/S1B_0.zip", md5=md5, size=len(FILES["/S1B_0.zip"])))
+        return path
+
+    def test_checksum_from_metalink(self):
+        self.server.delay = 0
+        downloader = self._downloader(threads=1)
+        url = self.base + "/S1B_0.zip"
+        md5 = hashlib.md5(FILES["/S1B_0.zip"]).hexdigest()
+        self.assertEqual([url], downloader.process_metalink(self._metalink(md5.upper())))
+        self.assertEqual(md5, downloader.checksums[url])
+
+        downloader.files = [url]
+        downloader.download_files()
+        self.assertEqual(1, len(downloader.success))
+
+    def _check_mismatch_is_discarded(self, threads):
+        self.server.delay = 0
+        downloader = self._downloader(threads=threads)
+        downloader.process_metalink(self._metalink("0" * 32))
+        downloader.files = [self.base + "/S1B_0.zip"]
+        downloader.download_files()
+
+        self.assertEqual(downloader.files, downloader.failed)
+        self.assertNotIn("iipcom/download/S1B_0.zip", self.s3.client.objects)
+        self.assertEqual(["downloads.metalink"], os.listdir(self.directory.name))
+
+    def test_checksum_mismatch_is_discarded(self):
+        self._check_mismatch_is_discarded(threads=1)
+
+    def test_checksum_mismatch_is_not_uploaded(self):
+        self._check_mismatch_is_discarded(threads=2)
+        self.assertEqual(["iipcom/download/S1B_0.zip"], self.s3.client.aborted)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import re
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from s1_ard_pypeline import download
+from s1_ard_pypeline.utils import s3_utils
+from tests.utils.test_s3_utils import FakeS3Client
+
+DATA = bytes(range(256)) * 50000
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves DATA, honouring range requests. The first response can be cut off part way through.
+    """
+
+    def do_GET(self):
+        self.server.ranges.append(self.headers.get("Range"))
+        if self.path != "/product.zip":
+            self.send_error(404)
+            return
+
+        start = 0
+        match = re.match(r"bytes=(\d+)-", self.headers.get("Range") or "")
+        if match and self.server.support_ranges:
+            start = int(match.group(1))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(DATA) - 1}/{len(DATA)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(DATA) - start))
+        self.end_headers()
+
+        body = DATA[start:]
+        if self.server.cut_after:
+            body = body[:self.server.cut_after]
+            self.server.cut_after = 0
+        self.wfile.write(body)
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeS3Utils:
+
+    def __init__(self):
+        self.client = FakeS3Client()
+
+    def open_upload(self, destination, part_size, concurrency):
+        return s3_utils.MultipartUpload(self.client, "bucket", destination, part_size, concurrency)
+
+
+class TestDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+        self.server.ranges = []
+        self.server.cut_after = 0
+        self.server.support_ranges = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/product.zip"
+        self.s3 = FakeS3Utils()
+        self.patches = [
+            mock.patch.object(download, "UPLOAD_PART_SIZE", s3_utils.MIN_PART_SIZE),
+            mock.patch.object(download, "RETRY_DELAY", 0),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_streams_into_parts(self):
+        self.assertEqual(len(DATA), download.download_file(self.url, "out/product.zip", self.s3, chunk_size=1024 ** 2))
+        self.assertEqual(DATA, self.s3.client.objects["out/product.zip"])
+        # the file went up in parts rather than in one piece
+        self.assertEqual(3, len(self.s3.client.parts))
+        self.assertEqual([None], self.server.ranges)
+
+    def test_resumes_with_range(self):
+        self.server.cut_after = 5000000
+        download.download_file(self.url, "out/product.zip", self.s3, chunk_size=1024 ** 2)
+
+        self.assertEqual(DATA, self.s3.client.objects["out/product.zip"])
+        self.assertEqual([None, "bytes=5000000-"], self.server.ranges)
+
+    def test_gives_up_when_range_is_ignored(self):
+        self.server.cut_after = 5000000
+        self.server.support_ranges = False
+        with self.assertRaises(IOError):
+            download.download_file(self.url, "out/product.zip", self.s3, chunk_size=1024 ** 2)
+
+        self.assertNotIn("out/product.zip", self.s3.client.objects)
+        self.assertEqual(["out/product.zip"], self.s3.client.aborted)
+
+    def test_missing_file_is_not_retried(self):
+        with self.assertRaises(download.urllib.error.HTTPError):
+            download.download_file(self.url.replace("product", "missing"), "out/missing.zip", self.s3)
+        self.assertEqual(1, len(self.server.ranges))
+
+
+if __name__ == "__main__":
+    unittest.main()
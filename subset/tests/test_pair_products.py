@@ -1,9 +1,67 @@
+import random
 import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+from shapely.geometry import box
 
 from s1_ard_pypeline import pair_products
+from s1_ard_pypeline.utils.catalogue import Catalogue
+from s1_ard_pypeline.utils.footprint import FootprintIndex
 from s1_ard_pypeline.utils.product_name import S1Product
 
 
+def brute_force_pairs(_products):
+    """
+    The original pairing, comparing each product with every later one in its orbit.
+    """
+    _by_orbit = {}
+    for p in _products:
+        _by_orbit.setdefault(p.relative_orbit(), []).append(p)
+
+    _result = []
+    for v in _by_orbit.values():
+        sorted_products = sorted(v, key=lambda _p: _p.start_timestamp())
+        orbit_start = len(_result)
+        for i, pa in enumerate(sorted_products):
+            for pb in sorted_products[i + 1:]:
+                duration = (pb.start_timestamp() - pa.start_timestamp())
+                if timedelta(days=12, seconds=-30) > duration or duration > timedelta(days=24):
+                    continue
+                if pa.start_time <= pb.start_time < pa.stop_time or pb.start_time < pa.stop_time <= pb.stop_time or \
+                    pb.start_time <= pa.start_time < pb.stop_time or pa.start_time < pb.stop_time <= pa.stop_time:
+                    _result.append((pa, pb))
+                    break
+        if len(_result) >= 2 and orbit_start < len(_result) - 1 and \
+            _result[orbit_start][0].product_name == _result[-1][1].product_name:
+            _result = _result[:-1]
+    return _result
+
+
+def random_archive(seed, orbits=6, cycles=40):
+    """
+    Frames along a few relative orbits, revisited every 6 or 12 days with some passes missing and some jitter.
+    """
+    rng = random.Random(seed)
+    start = datetime(2017, 1, 1)
+    names = []
+    for relative in rng.sample(range(175), orbits):
+        first = start + timedelta(hours=rng.randint(0, 23), minutes=rng.randint(0, 50))
+        for cycle in range(cycles):
+            if rng.random() < 0.2:
+                continue
+            for satellite, offset in (("S1A", 0), ("S1B", 6)):
+                pass_start = first + timedelta(days=12 * cycle + offset, seconds=rng.randint(-20, 20))
+                for frame in range(rng.randint(1, 4)):
+                    frame_start = pass_start + timedelta(seconds=25 * frame)
+                    frame_stop = frame_start + timedelta(seconds=27)
+                    orbit = relative + 175 * (2 * cycle + offset // 6)
+                    names.append(f"{satellite}_IW_SLC__1SDV_{frame_start:%Y%m%dT%H%M%S}_{frame_stop:%Y%m%dT%H%M%S}_"
+                                 f"{orbit:06d}_{rng.randrange(16 ** 6):06X}_{rng.randrange(16 ** 4):04X}")
+    rng.shuffle(names)
+    return [S1Product(name) for name in names]
+
+
 class TestPairProducts(unittest.TestCase):
 
     def test_pair_basic(self):
@@ -104,3 +162,53 @@ class TestPairProducts(unittest.TestCase):
             ],
             product_names
         )
+
+    def test_matches_brute_force(self):
+        for seed in range(5):
+            products = random_archive(seed)
+            expected = [(a.product_name, b.product_name) for a, b in brute_force_pairs(products)]
+            result = [(a.product_name, b.product_name) for a, b in pair_products.pair_products(products)]
+            self.assertTrue(expected)
+            self.assertEqual(expected, result)
+
+    def test_catalogue_matches_list(self):
+        for seed in range(5):
+            products = random_archive(seed)
+            expected = [(a.product_name, b.product_name) for a, b in pair_products.pair_products(products)]
+            catalogue = Catalogue([p.product_name for p in products])
+            result = [(a.product_name, b.product_name) for a, b in pair_products.pair_products(catalogue)]
+            self.assertEqual(expected, result)
+
+    def test_pair_by_footprint(self):
+        first = "S1B_IW_SLC__1SDV_20161127T231340_20161127T231408_003151_0055C4_E29B"
+        # taken at the same time of day as first, but further along the track
+        south = "S1B_IW_SLC__1SDV_20161209T231340_20161209T231407_003326_005A00_AAAA"
+        north = "S1B_IW_SLC__1SDV_20161209T231410_20161209T231437_003326_005A00_BBBB"
+        names = [first, south, north]
+        footprints = FootprintIndex({first: box(0, 0, 2, 2), south: box(0, 3, 2, 5), north: box(0, 0.5, 2, 2.5)})
+
+        by_time = pair_products.pair_products([S1Product(n) for n in names])
+        self.assertEqual([(first, south)], [(a.product_name, b.product_name) for a, b in by_time])
+
+        for products in ([S1Product(n) for n in names], Catalogue(names)):
+            result = pair_products.pair_products(products, footprints)
+            self.assertEqual([(first, north)], [(a.product_name, b.product_name) for a, b in result])
+
+        # not enough of the footprints is shared
+        self.assertEqual([], pair_products.pair_products([S1Product(n) for n in names], footprints, 80))
+        self.assertEqual([], pair_products.pair_products(Catalogue(names), footprints, 80))
+
+    def test_catalogue_uses_footprint_index(self):
+        first = "S1B_IW_SLC__1SDV_20161127T231340_20161127T231408_003151_0055C4_E29B"
+        south = "S1B_IW_SLC__1SDV_20161209T231340_20161209T231407_003326_005A00_AAAA"
+        north = "S1B_IW_SLC__1SDV_20161209T231410_20161209T231437_003326_005A00_BBBB"
+        footprints = FootprintIndex({first: box(0, 0, 2, 2), south: box(0, 3, 2, 5), north: box(0, 0.5, 2, 2.5)})
+
+        with mock.patch.object(footprints, "query", wraps=footprints.query) as query, \
+                mock.patch.object(footprints, "overlap", wraps=footprints.overlap) as overlap:
+            result = pair_products.pair_products(Catalogue([first, south, north]), footprints)
+
+        self.assertEqual([(first, north)], [(a.product_name, b.product_name) for a, b in result])
+        # the index is asked once for first, and south is turned away without working out the overlap
+        self.assertEqual(1, query.call_count)
+        self.assertEqual([mock.call(first, north)], overlap.call_args_list)
@@ -1,7 +1,10 @@
 import os
+import threading
 import unittest
+from unittest import mock
 
 from s1_ard_pypeline import _config
+from s1_ard_pypeline.ard import ard
 from s1_ard_pypeline.run_coherence import CoherenceChain
 from s1_ard_pypeline.utils import product_name
 
@@ -19,3 +22,28 @@ class TestRunCoherence(unittest.TestCase):
         result = coherence_chain._create_dim_name("vh", "test")
 
         self.assertEqual(f"/foo/bar{os.sep}S1_20170502T231339_20170502T231339_test_vh.dim", result)
+
+    def test_stage2_runs_in_parallel(self):
+        """
+        The six stage2 gpt calls of a dual polarisation pair only depend on stage1 so they should all run at once.
+        """
+        first_product = product_name.S1Product("S1B_IW_SLC__1SDV_20170502T231339_20170502T231407_005426_009835_C052")
+        last_product = product_name.S1Product("S1B_IW_SLC__1SDV_20170514T231340_20170514T231408_005601_009D4C_4D2C")
+
+        _config.set("Dirs", "working", "/foo/bar")
+
+        coherence_chain = CoherenceChain("test_input", "test_output", first_product, last_product, True, True)
+
+        barrier = threading.Barrier(6, timeout=5)
+
+        def fake_gpt(graph_path, args):
+            if "stage2" in graph_path:
+                barrier.wait()
+
+        with mock.patch.object(ard, "gpt", side_effect=fake_gpt), \
+                mock.patch.object(ard, "unzip_product"), \
+                mock.patch.object(ard, "delete_dim"), \
+                mock.patch.object(ard, "delete_file"), \
+                mock.patch.object(ard, "convert_to_tif"), \
+                mock.patch.object(ard, "gzip_file"):
+            ard.process_chain(coherence_chain.build_chain(), coherence_chain.name(), parallelism=6)
@@ -0,0 +1,78 @@
+import os
+import tempfile
+import unittest
+
+import rasterio
+
+from s1_ard_pypeline import validate_coherence_input
+from s1_ard_pypeline.utils.product_name import S1Product
+
+FIRST = "S1B_IW_SLC__1SDV_20161127T231340_20161127T231408_003151_0055C4_E29B"
+LAST = "S1B_IW_SLC__1SDV_20161209T231340_20161209T231407_003326_005A00_AAAA"
+BROKEN = "S1B_IW_SLC__1SDV_20161221T231340_20161221T231407_003501_005FC5_4108"
+MISSING = "S1B_IW_SLC__1SDV_20170114T231338_20170114T231405_003851_006A05_36B2"
+
+
+def fake_check(path, name, full):
+    """
+    Stands in for validate_product in the worker processes, recording each product it is asked to check.
+    """
+    with open(os.path.join(path, f"{name}.checked"), "a") as f:
+        f.write("checked\n")
+    if name == MISSING:
+        raise IOError(f"{name} is not there")
+    return name != BROKEN, rasterio.coords.BoundingBox(0, 0, 10, 10)
+
+
+class TestProductValidator(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.validator = validate_coherence_input.ProductValidator(self.directory.name, processes=2, check=fake_check)
+
+    def tearDown(self):
+        self.validator.shutdown()
+        self.directory.cleanup()
+
+    def _checks(self, name):
+        with open(os.path.join(self.directory.name, f"{name}.checked")) as f:
+            return len(f.readlines())
+
+    def test_each_product_checked_once(self):
+        first, last = S1Product(FIRST), S1Product(LAST)
+        self.validator.submit(first)
+        self.validator.submit(last)
+
+        self.assertTrue(self.validator.validate(first, last))
+        self.assertTrue(self.validator.validate(S1Product(FIRST), last))
+        self.assertEqual(1, self._checks(FIRST))
+        self.assertEqual(1, self._checks(LAST))
+
+    def test_invalid_products(self):
+        broken, missing = S1Product(BROKEN), S1Product(MISSING)
+        # nothing is known about a product until it has been checked
+        self.assertFalse(self.validator.invalid(broken))
+
+        self.validator.submit(broken).exception()
+        self.validator.submit(missing).exception()
+        self.assertTrue(self.validator.invalid(broken))
+        self.assertTrue(self.validator.invalid(missing))
+        self.assertFalse(self.validator.validate(S1Product(FIRST), broken))
+
+
+class TestValidatePair(unittest.TestCase):
+
+    def test_pair_checks(self):
+        first, last = S1Product(FIRST), S1Product(LAST)
+        inside = (True, rasterio.coords.BoundingBox(0, 0, 10, 10))
+        apart = (True, rasterio.coords.BoundingBox(20, 20, 30, 30))
+
+        self.assertTrue(validate_coherence_input.validate_pair(first, last, inside, inside))
+        self.assertFalse(validate_coherence_input.validate_pair(first, last, inside, apart))
+        self.assertFalse(validate_coherence_input.validate_pair(first, last, inside, (False, None)))
+        # different satellites
+        self.assertFalse(validate_coherence_input.validate_metadata(first, S1Product("S1A" + LAST[3:])))
+
+
+if __name__ == "__main__":
+    unittest.main()
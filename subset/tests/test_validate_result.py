@@ -0,0 +1,95 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import rasterio.shutil
+
+from s1_ard_pypeline import validate_result
+from tests.utils.test_data_validation import write_image
+
+
+def write_result(path, bands, origin=(500000, 6000000), pixel=10, nodata=None):
+    """
+    Write a GeoTIFF of the given arrays with its top left corner at origin. The image is placed with a world file, and
+    gdal copies that into the GeoTIFF so it stays with the image when it is gzipped.
+    """
+    plain = os.path.splitext(path)[0] + "_plain.tif"
+    write_image(plain, bands, nodata=nodata)
+    with open(os.path.splitext(plain)[0] + ".tfw", "w") as f:
+        f.write(f"{pixel}\n0\n0\n{-pixel}\n{origin[0] + pixel / 2}\n{origin[1] - pixel / 2}\n")
+    rasterio.shutil.copy(plain, path, driver="GTiff", tiled=True, blockxsize=256, blockysize=256)
+    rasterio.shutil.delete(plain)
+
+
+class TestValidateImage(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "result.tif")
+        self.band = np.random.RandomState(0).rand(1024, 1024).astype(np.float32)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_valid_image(self):
+        write_result(self.path, [self.band])
+        self.assertTrue(validate_result.validate_image(self.path))
+        self.assertTrue(validate_result.validate_image(self.path, complete=True))
+
+    def test_gzipped_image(self):
+        write_result(self.path, [self.band])
+        with open(self.path, "rb") as source, gzip.open(self.path + ".gz", "wb") as destination:
+            shutil.copyfileobj(source, destination)
+        os.remove(self.path)
+        self.assertTrue(validate_result.validate_image(self.path + ".gz"))
+
+    def test_wrong_number_of_bands(self):
+        write_result(self.path, [self.band, self.band])
+        self.assertFalse(validate_result.validate_image(self.path))
+        self.assertTrue(validate_result.validate_image(self.path, bands=2))
+
+    def test_single_value(self):
+        write_result(self.path, [np.full((1024, 1024), 2, dtype=np.float32)])
+        self.assertFalse(validate_result.validate_image(self.path))
+
+    def test_only_nodata(self):
+        write_result(self.path, [np.full((1024, 1024), np.nan, dtype=np.float32)])
+        self.assertFalse(validate_result.validate_image(self.path))
+        write_result(self.path, [np.zeros((1024, 1024), dtype=np.int16)], nodata=0)
+        self.assertFalse(validate_result.validate_image(self.path))
+
+    def test_over_origin(self):
+        write_result(self.path, [self.band], origin=(-5000, 5000))
+        self.assertFalse(validate_result.validate_image(self.path))
+
+    def test_not_georeferenced(self):
+        write_image(self.path, [self.band])
+        self.assertFalse(validate_result.validate_image(self.path))
+
+    def test_missing_file(self):
+        self.assertFalse(validate_result.validate_image(self.path))
+
+    def test_corners(self):
+        transform = validate_result.rasterio.Affine(10, 0, 100, 0, -10, 200)
+        self.assertEqual(((100, 200), (300, 100)), validate_result.corners(transform, 20, 10))
+
+    def test_validate_images_in_parallel(self):
+        paths = [os.path.join(self.directory.name, f"result_{i}.tif") for i in range(3)]
+        write_result(paths[0], [self.band])
+        write_result(paths[1], [np.ones((512, 512), dtype=np.float32)])
+        write_result(paths[2], [self.band[:512, :512]])
+        self.assertEqual([True, False, True], validate_result.validate_images(paths, processes=2))
+        self.assertEqual([True, False, True], validate_result.validate_images(paths))
+
+    def test_check_that_raises_is_invalid(self):
+        write_result(self.path, [self.band])
+        with mock.patch.object(validate_result.data_validation, "band_stats", side_effect=IOError("unreadable block")):
+            self.assertEqual([False], validate_result.validate_images([self.path]))
+
+
+if __name__ == "__main__":
+    unittest.main()
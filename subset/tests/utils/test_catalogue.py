@@ -0,0 +1,76 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy as np
+
+from s1_ard_pypeline.utils.catalogue import Catalogue
+from s1_ard_pypeline.utils.product_name import S1Product
+
+NAMES = [
+    "S1B_IW_SLC__1SDV_20161127T231340_20161127T231408_003151_0055C4_E29B",
+    "S1A_IW_SLC__1SDV_20180609T104125_20180609T104152_022295_014BCA_99E0",
+    "S1B_IW_SLC__1SDV_20161221T231340_20161221T231407_003501_005FC5_4108",
+    "S1B_EW_SLC__1SDH_20170114T235959_20170115T000026_003851_006A05_36B2",
+]
+
+
+class TestCatalogue(unittest.TestCase):
+
+    def setUp(self):
+        self.catalogue = Catalogue(NAMES)
+
+    def test_columns_match_product(self):
+        for i, name in enumerate(NAMES):
+            product = S1Product(name)
+            self.assertEqual(product.satellite, self.catalogue.satellite[i].decode())
+            self.assertEqual(product.SAR_mode, self.catalogue.mode[i].decode())
+            self.assertEqual(product.product_type, self.catalogue.product_type[i].decode())
+            self.assertEqual(product.start_timestamp(), self.catalogue.start[i].astype(datetime))
+            self.assertEqual(product.stop_timestamp(), self.catalogue.stop[i].astype(datetime))
+            self.assertEqual(int(product.orbit), self.catalogue.orbit[i])
+            self.assertEqual(product.relative_orbit(), self.catalogue.relative_orbit[i])
+
+        self.assertEqual(23 * 3600 + 59 * 60 + 59, self.catalogue.start_time[3])
+        self.assertEqual(26, self.catalogue.stop_time[3])
+
+    def test_from_names_drops_invalid(self):
+        catalogue = Catalogue.from_names(NAMES + ["", f"{NAMES[0]}.zip"])
+        self.assertEqual(4, len(catalogue))
+
+    def test_read(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "products.txt")
+            with open(path, "w") as f:
+                f.write("\n".join(NAMES) + "\n\n")
+            self.assertEqual(NAMES, [p.product_name for p in Catalogue.read(path).products()])
+
+    def test_products_are_made_once(self):
+        self.assertIs(self.catalogue.product(2), self.catalogue.product(np.int64(2)))
+        self.assertEqual(S1Product(NAMES[2]), self.catalogue.product(2))
+        self.assertEqual(2, self.catalogue.index(NAMES[2]))
+        self.assertIsNone(self.catalogue.index("missing"))
+
+    def test_where(self):
+        self.assertEqual([0, 2, 3], np.flatnonzero(self.catalogue.where(satellite="S1B")).tolist())
+        self.assertEqual([0, 2], np.flatnonzero(self.catalogue.where(satellite="S1B", mode="IW")).tolist())
+        self.assertEqual([3], np.flatnonzero(self.catalogue.where(product_type="SLC__1SDH")).tolist())
+        self.assertEqual([1], np.flatnonzero(self.catalogue.where(relative_orbit=[70, 100])).tolist())
+        self.assertEqual([0, 2, 3], np.flatnonzero(self.catalogue.where(relative_orbit=1)).tolist())
+        self.assertEqual([2, 3], np.flatnonzero(
+            self.catalogue.where(start=datetime(2016, 12, 1), stop=datetime(2018, 1, 1))).tolist())
+
+        subset = self.catalogue.subset(self.catalogue.where(satellite="S1A"))
+        self.assertEqual([NAMES[1]], [p.product_name for p in subset.products()])
+
+    def test_group_by_relative_orbit(self):
+        names = [NAMES[2], NAMES[1], NAMES[0]]
+        groups = Catalogue(names).group_by_relative_orbit()
+        # groups in the order they first appear, sorted by start time
+        self.assertEqual([(1, [2, 0]), (70, [1])], [(orbit, indices.tolist()) for orbit, indices in groups])
+        self.assertEqual([], Catalogue([]).group_by_relative_orbit())
+
+
+if __name__ == "__main__":
+    unittest.main()
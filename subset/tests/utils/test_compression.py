@@ -0,0 +1,73 @@
+import gzip
+import io
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from s1_ard_pypeline.ard import ard
+from s1_ard_pypeline.utils import compression
+
+
+def sample_data(size, seed=0):
+    """
+    Half random bytes and half repetitive text, so the blocks have something to compress and something to refer back to
+    """
+    rng = random.Random(seed)
+    noise = bytes(rng.getrandbits(8) for _ in range(size // 2))
+    text = b"".join(b"line %d of the test data\n" % (i % 1000) for i in range(size // 40))
+    return noise + text[:size - len(noise)]
+
+
+class TestCompression(unittest.TestCase):
+
+    def _round_trip(self, data, **kwargs):
+        compressed = io.BytesIO()
+        size = compression.gzip_stream(io.BytesIO(data), compressed, **kwargs)
+        self.assertEqual(len(data), size)
+        self.assertEqual(data, gzip.decompress(compressed.getvalue()))
+        return compressed.getvalue()
+
+    def test_empty(self):
+        self._round_trip(b"")
+
+    def test_single_block(self):
+        self._round_trip(b"hello world")
+
+    def test_many_blocks(self):
+        data = sample_data(200000)
+        compressed = self._round_trip(data, threads=4, block_size=16 * 1024)
+        # priming each block with the one before keeps the ratio close to a single stream
+        self.assertLess(len(compressed), len(gzip.compress(data)) * 1.05)
+
+    def test_block_boundaries(self):
+        data = sample_data(64 * 1024)
+        for block_size in [1024, 32 * 1024, 64 * 1024, 64 * 1024 - 1]:
+            self._round_trip(data, threads=3, block_size=block_size)
+
+    def test_gzip_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, "source.tif")
+            target = os.path.join(directory, "source.tif.gz")
+            data = sample_data(100000)
+            with open(source, "wb") as f:
+                f.write(data)
+
+            ard.gzip_file(source, target, threads=2)
+
+            with gzip.open(target, "rb") as f:
+                self.assertEqual(data, f.read())
+
+            # the system gunzip should be happy with it too
+            if shutil.which("gzip"):
+                self.assertEqual(0, subprocess.call(["gzip", "-t", target]))
+
+    def test_gzip_file_missing(self):
+        with self.assertRaises(ard.ProcessError):
+            ard.gzip_file("does_not_exist.tif", "does_not_exist.tif.gz")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,29 @@
-import rasterio
+import os
+import tempfile
 import unittest
+from unittest import mock
+
+import numpy as np
+import rasterio
+from rasterio.control import GroundControlPoint
+
+from s1_ard_pypeline import validate_coherence_input
 from s1_ard_pypeline.utils import data_validation
 
 
+def write_image(path, bands, tiled=True, nodata=None):
+    """
+    Write a GeoTIFF of the given arrays, one per band, in 256 pixel tiles.
+    """
+    profile = {"driver": "GTiff", "height": bands[0].shape[0], "width": bands[0].shape[1], "count": len(bands),
+               "dtype": bands[0].dtype.name, "nodata": nodata}
+    if tiled:
+        profile.update(tiled=True, blockxsize=256, blockysize=256)
+    with rasterio.open(path, "w", **profile) as dst:
+        for i, band in enumerate(bands, 1):
+            dst.write(band, i)
+
+
 class TestDataValidation(unittest.TestCase):
 
     def test_bounding_box_to_wkt(self):
@@ -21,3 +42,109 @@ class TestDataValidation(unittest.TestCase):
         box_b = rasterio.coords.BoundingBox(-11, -11, -22, -22)
 
         self.assertFalse(data_validation.overlap(box_a, box_b))
+
+
+class TestCheckData(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "image.tif")
+        self.random = np.random.RandomState(0)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _check(self, bands, **kwargs):
+        write_image(self.path, bands, **kwargs)
+        with rasterio.open(self.path) as src:
+            return data_validation.check_data(src), data_validation.check_data_sampled(src)
+
+    def test_varied_data(self):
+        band = self.random.randint(0, 1000, (1024, 1024)).astype(np.int16)
+        self.assertEqual((True, True), self._check([band, band]))
+        self.assertEqual((True, True), self._check([band], tiled=False))
+
+    def test_constant_data(self):
+        self.assertEqual((False, False), self._check([np.full((1024, 1024), 7, dtype=np.int16)]))
+
+    def test_last_band_is_checked(self):
+        varied = self.random.randint(0, 1000, (512, 512)).astype(np.int16)
+        self.assertEqual((False, False), self._check([varied, np.zeros((512, 512), dtype=np.int16)]))
+
+    def test_data_missed_by_the_sample_is_found(self):
+        band = np.zeros((2048, 2048), dtype=np.float32)
+        band[1100:1400, 300:600] = self.random.rand(300, 300)
+        write_image(self.path, [band])
+        with rasterio.open(self.path) as src:
+            windows = data_validation.sample_windows(src, 1, 4)
+            self.assertTrue(all(not np.any(src.read(1, window=w)) for w in windows))
+            self.assertTrue(data_validation.check_data_sampled(src, samples=4))
+
+    def test_sample_reads_few_blocks(self):
+        band = self.random.randint(0, 1000, (2048, 2048)).astype(np.int16)
+        write_image(self.path, [band])
+        with rasterio.open(self.path) as src:
+            windows = data_validation.sample_windows(src, 1)
+            self.assertEqual(data_validation.SAMPLE_BLOCKS, len(windows))
+            self.assertEqual(len(windows), len(set((w.col_off, w.row_off) for w in windows)))
+
+            with mock.patch.object(src, "read", wraps=src.read) as read:
+                self.assertTrue(data_validation.check_data_sampled(src))
+            # two different values are found in the first block
+            self.assertEqual(1, read.call_count)
+
+
+class TestBandStats(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "image.tif")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_stops_once_values_differ(self):
+        band = np.zeros((1024, 1024), dtype=np.int16)
+        band[600:, 600:] = np.arange(424 * 424).reshape(424, 424) % 1000
+        write_image(self.path, [band], nodata=0)
+        with rasterio.open(self.path) as src:
+            stats, read_all = data_validation.band_stats(src, 1)
+            self.assertFalse(read_all)
+            self.assertTrue(stats.varied())
+            # the first blocks are all nodata, so the reading stops in the first block holding data
+            self.assertEqual(11 * 256 * 256, stats.pixels)
+
+            stats, read_all = data_validation.band_stats(src, 1, complete=True)
+            self.assertTrue(read_all)
+            self.assertEqual((1, 999), (stats.minimum, stats.maximum))
+            self.assertEqual(1024 * 1024 - 424 * 424 + (424 * 424 + 999) // 1000, stats.nodata)
+
+    def test_constant_and_empty_bands(self):
+        write_image(self.path, [np.full((512, 512), 3, dtype=np.int16), np.zeros((512, 512), dtype=np.int16)],
+                    nodata=0)
+        with rasterio.open(self.path) as src:
+            stats, read_all = data_validation.band_stats(src, 1)
+            self.assertTrue(read_all)
+            self.assertEqual((3, 3), (stats.minimum, stats.maximum))
+            self.assertFalse(stats.varied())
+
+            stats, _ = data_validation.band_stats(src, 2)
+            self.assertFalse(stats.has_data())
+            self.assertEqual(1.0, stats.nodata_fraction())
+
+    def test_nan_is_nodata(self):
+        band = np.full((256, 256), np.nan, dtype=np.float32)
+        band[0, :2] = [1.5, 2.5]
+        write_image(self.path, [band])
+        with rasterio.open(self.path) as src:
+            stats, _ = data_validation.band_stats(src, 1, complete=True)
+        self.assertEqual((1.5, 2.5), (stats.minimum, stats.maximum))
+        self.assertEqual(256 * 256 - 2, stats.nodata)
+
+
+class TestGroundControlPoints(unittest.TestCase):
+
+    def test_bounds_cover_every_point(self):
+        gcps = [GroundControlPoint(0, 0, x, y) for x, y in [(2, 5), (-1, 3), (4, -2), (1, 1)]]
+        self.assertEqual(rasterio.coords.BoundingBox(-1, -2, 4, 5),
+                         validate_coherence_input.ground_control_points_to_bounds(gcps))
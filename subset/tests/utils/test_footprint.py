@@ -0,0 +1,115 @@
+import os
+import tempfile
+import unittest
+import zipfile
+
+from shapely.geometry import box
+
+from s1_ard_pypeline.utils import footprint
+from s1_ard_pypeline.utils.product_name import S1Product
+
+FIRST = "S1B_IW_SLC__1SDV_20161127T231340_20161127T231408_003151_0055C4_E29B"
+SOUTH = "S1B_IW_SLC__1SDV_20161209T231340_20161209T231407_003326_005A00_AAAA"
+NORTH = "S1B_IW_SLC__1SDV_20161209T231410_20161209T231437_003326_005A00_BBBB"
+OTHER_ORBIT = "S1A_IW_SLC__1SDV_20180609T104125_20180609T104152_022295_014BCA_99E0"
+
+MANIFEST = """<?xml version="1.0" encoding="UTF-8"?>
+<xfdu:XFDU xmlns:xfdu="urn:ccsds:schema:xfdu:1" xmlns:safe="http://www.esa.int/safe/sentinel-1.0"
+           xmlns:gml="http://www.opengis.net/gml">
+  <metadataSection>
+    <metadataObject ID="measurementFrameSet">
+      <metadataWrap>
+        <xmlData>
+          <safe:frameSet>
+            <safe:frame>
+              <safe:footPrint srsName="http://www.opengis.net/gml/srs/epsg.xml#4326">
+                <gml:coordinates>{coordinates}</gml:coordinates>
+              </safe:footPrint>
+            </safe:frame>
+          </safe:frameSet>
+        </xmlData>
+      </metadataWrap>
+    </metadataObject>
+  </metadataSection>
+</xfdu:XFDU>
+"""
+
+
+def manifest(left, bottom, right, top):
+    corners = [(bottom, left), (bottom, right), (top, right), (top, left)]
+    return MANIFEST.format(coordinates=" ".join(f"{lat},{lon}" for lat, lon in corners))
+
+
+class TestFootprints(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_manifests_in_folders_and_zips(self):
+        safe = os.path.join(self.directory.name, f"{FIRST}.SAFE")
+        os.makedirs(safe)
+        with open(os.path.join(safe, "manifest.safe"), "w") as f:
+            f.write(manifest(0, 0, 2, 2))
+        with zipfile.ZipFile(os.path.join(self.directory.name, f"{SOUTH}.zip"), "w") as z:
+            z.writestr(f"{SOUTH}.SAFE/manifest.safe", manifest(0, 3, 2, 5))
+        with open(os.path.join(self.directory.name, "notes.txt"), "w") as f:
+            f.write("not a product")
+
+        footprints = footprint.read_footprints(self.directory.name)
+
+        self.assertEqual({FIRST, SOUTH}, set(footprints))
+        self.assertTrue(footprints[FIRST].equals(box(0, 0, 2, 2)))
+        self.assertTrue(footprints[SOUTH].equals(box(0, 3, 2, 5)))
+
+    def test_asf_catalogue(self):
+        path = os.path.join(self.directory.name, "search.csv")
+        with open(path, "w") as f:
+            f.write("Granule Name,Near Start Lat,Near Start Lon,Far Start Lat,Far Start Lon,"
+                    "Near End Lat,Near End Lon,Far End Lat,Far End Lon\n")
+            f.write(f"{FIRST},0,0,0,2,2,0,2,2\n")
+            f.write("not a product,0,0,0,2,2,0,2,2\n")
+
+        footprints = footprint.read_footprints(path)
+        self.assertEqual([FIRST], list(footprints))
+        self.assertTrue(footprints[FIRST].equals(box(0, 0, 2, 2)))
+
+    def test_wkt_catalogue(self):
+        path = os.path.join(self.directory.name, "catalogue.csv")
+        with open(path, "w") as f:
+            f.write("name,footprint\n")
+            f.write(f'{FIRST},"POLYGON((0 0, 2 0, 2 2, 0 2, 0 0))"\n')
+        self.assertTrue(footprint.read_footprints(path)[FIRST].equals(box(0, 0, 2, 2)))
+
+        with open(path, "w") as f:
+            f.write("name,size\n")
+        with self.assertRaises(ValueError):
+            footprint.read_footprints(path)
+
+
+class TestFootprintIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = footprint.FootprintIndex({
+            FIRST: box(0, 0, 2, 2),
+            SOUTH: box(0, 3, 2, 5),
+            NORTH: box(0, 0.5, 2, 2.5),
+            OTHER_ORBIT: box(0, 0, 2, 2),
+        })
+
+    def test_query_same_orbit(self):
+        self.assertEqual({NORTH}, self.index.query(S1Product(FIRST)))
+        self.assertEqual({FIRST}, self.index.query(S1Product(NORTH)))
+        self.assertEqual(set(), self.index.query(S1Product(SOUTH)))
+        self.assertEqual(set(), self.index.query(S1Product(OTHER_ORBIT)))
+
+    def test_overlap(self):
+        self.assertAlmostEqual(75.0, self.index.overlap(FIRST, NORTH))
+        self.assertEqual(0.0, self.index.overlap(FIRST, SOUTH))
+        self.assertIsNone(self.index.overlap(FIRST, "unknown"))
+
+
+if __name__ == "__main__":
+    unittest.main()
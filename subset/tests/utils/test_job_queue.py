@@ -0,0 +1,201 @@
+import hashlib
+import io
+import threading
+import time
+import unittest
+from datetime import datetime, timezone
+
+import botocore.exceptions
+
+from s1_ard_pypeline.utils.job_queue import Job, S3JobQueue
+
+PAIRS = [f"first_{i}, last_{i}" for i in range(6)]
+
+
+def _client_error(code, operation):
+    return botocore.exceptions.ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+class FakeObjectStore:
+    """
+    Stands in for MinIO. Keeps objects in memory and supports the conditional puts the queue relies on.
+    """
+
+    def __init__(self, page_size=4):
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.page_size = page_size
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None):
+        with self.lock:
+            existing = self.objects.get(Key)
+            if IfNoneMatch == "*" and existing is not None:
+                raise _client_error("PreconditionFailed", "PutObject")
+            if IfMatch is not None and (existing is None or existing["ETag"] != IfMatch):
+                raise _client_error("NoSuchKey" if existing is None else "PreconditionFailed", "PutObject")
+            etag = f'"{hashlib.md5(Body).hexdigest()}"'
+            self.objects[Key] = {"Body": Body, "ETag": etag, "LastModified": datetime.now(timezone.utc)}
+            return {"ETag": etag}
+
+    def get_object(self, Bucket, Key):
+        with self.lock:
+            if Key not in self.objects:
+                raise _client_error("NoSuchKey", "GetObject")
+            entry = self.objects[Key]
+            return {"Body": io.BytesIO(entry["Body"]), "ETag": entry["ETag"], "LastModified": entry["LastModified"]}
+
+    def delete_object(self, Bucket, Key, IfMatch=None):
+        with self.lock:
+            existing = self.objects.get(Key)
+            if IfMatch is not None and (existing is None or existing["ETag"] != IfMatch):
+                raise _client_error("NoSuchKey" if existing is None else "PreconditionFailed", "DeleteObject")
+            self.objects.pop(Key, None)
+
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken=None):
+        with self.lock:
+            keys = sorted(k for k in self.objects if k.startswith(Prefix))
+            start = int(ContinuationToken or 0)
+            page = keys[start:start + self.page_size]
+            response = {
+                "Contents": [{"Key": k, "ETag": self.objects[k]["ETag"], "LastModified": self.objects[k]["LastModified"]}
+                             for k in page],
+                "IsTruncated": start + self.page_size < len(keys),
+            }
+            if response["IsTruncated"]:
+                response["NextContinuationToken"] = str(start + self.page_size)
+            return response
+
+
+class TestS3JobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.store = FakeObjectStore()
+        S3JobQueue(self.store, "bucket", "batch").put_all(PAIRS)
+
+    def _queue(self, worker, lease=60, attempts=3):
+        return S3JobQueue(self.store, "bucket", "batch", lease=lease, attempts=attempts, worker=worker)
+
+    def test_claim_in_order(self):
+        queue = self._queue("a")
+        lines = [job.line for job in queue.jobs()]
+
+        self.assertEqual(PAIRS, lines)
+        self.assertEqual({"pending": 0, "claimed": 6, "done": 0, "failed": 0}, queue.status())
+
+    def test_put_all_appends(self):
+        queue = self._queue("a")
+        self.assertEqual(1, queue.put_all(["extra, line"]))
+        self.assertEqual(PAIRS + ["extra, line"], [job.line for job in queue.jobs()])
+
+    def test_workers_never_share_a_job(self):
+        claimed = []
+        lock = threading.Lock()
+
+        def work(name):
+            queue = self._queue(name)
+            for job in queue.jobs():
+                with lock:
+                    claimed.append(job.line)
+                queue.complete(job)
+
+        threads = [threading.Thread(target=work, args=(f"worker{i}",)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(sorted(PAIRS), sorted(claimed))
+        self.assertEqual(6, self._queue("a").status()["done"])
+
+    def test_slow_worker_does_not_hold_up_the_rest(self):
+        done = {"slow": 0, "fast": 0}
+
+        def work(name, seconds):
+            queue = self._queue(name)
+            for job in queue.jobs():
+                time.sleep(seconds)
+                queue.complete(job)
+                done[name] += 1
+
+        threads = [threading.Thread(target=work, args=("slow", 0.5)), threading.Thread(target=work, args=("fast", 0.01))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(6, done["slow"] + done["fast"])
+        self.assertGreater(done["fast"], done["slow"])
+
+    def test_expired_lease_is_taken_over(self):
+        stalled = self._queue("stalled", lease=0.2)
+        job = stalled.claim()
+
+        other = self._queue("other", lease=0.2)
+        self.assertNotEqual(job.index, other.claim().index)
+
+        time.sleep(0.3)
+        taken = other.claim()
+        self.assertEqual(job.index, taken.index)
+        self.assertEqual(2, taken.attempt)
+        # the stalled worker finds out when it next heart beats
+        self.assertFalse(stalled.heartbeat(job))
+
+    def test_stalled_worker_leaves_the_new_claim(self):
+        stalled = self._queue("stalled", lease=0.2)
+        job = stalled.claim()
+        time.sleep(0.3)
+        other = self._queue("other", lease=0.2)
+        taken = other.claim()
+        self.assertEqual(job.index, taken.index)
+
+        # the stalled worker finishes late, without having heart beaten
+        stalled.fail(job)
+        stalled.complete(job)
+        self.assertIn("batch/claims/00000000", self.store.objects)
+        self.assertTrue(other.heartbeat(taken))
+        other.complete(taken)
+        self.assertNotIn("batch/claims/00000000", self.store.objects)
+
+    def test_release_after_renewed_claim(self):
+        queue = self._queue("a")
+        job = queue.claim()
+        stale = Job(job.index, job.line, job.etag, job.attempt)
+        time.sleep(0.01)
+        queue.heartbeat(job)
+        # a heartbeat renewed the claim after the etag was read, it is still ours to release
+        queue.abandon(stale)
+        self.assertNotIn("batch/claims/00000000", self.store.objects)
+
+    def test_heartbeat_keeps_the_lease(self):
+        with self._queue("alive", lease=0.3) as alive:
+            job = alive.claim()
+            time.sleep(0.5)
+            other = self._queue("other", lease=0.3)
+            self.assertNotEqual(job.index, other.claim().index)
+            alive.complete(job)
+
+    def test_failed_job_is_retried_then_given_up(self):
+        queue = self._queue("a", attempts=2)
+        job = queue.claim()
+        queue.fail(job)
+
+        retry = queue.claim()
+        self.assertEqual(job.index, retry.index)
+        self.assertEqual(2, retry.attempt)
+        queue.fail(retry)
+
+        self.assertNotEqual(job.index, queue.claim().index)
+        self.assertEqual(1, queue.status()["failed"])
+
+    def test_abandon_does_not_count_an_attempt(self):
+        queue = self._queue("a")
+        job = queue.claim()
+        queue.abandon_all()
+
+        again = queue.claim()
+        self.assertEqual(job.index, again.index)
+        self.assertEqual(1, again.attempt)
+
+
+if __name__ == "__main__":
+    unittest.main()
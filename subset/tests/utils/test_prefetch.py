@@ -0,0 +1,177 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from s1_ard_pypeline.utils.prefetch import Prefetcher, SkippedPair
+from s1_ard_pypeline.utils.product_name import S1Product
+
+PRODUCTS = [
+    S1Product("S1B_IW_SLC__1SDV_20161127T231340_20161127T231408_003151_0055C4_E29B"),
+    S1Product("S1B_IW_SLC__1SDV_20161221T231340_20161221T231407_003501_005FC5_4108"),
+    S1Product("S1B_IW_SLC__1SDV_20170114T231338_20170114T231405_003851_006A05_36B2"),
+    S1Product("S1B_IW_SLC__1SDV_20170207T231337_20170207T231405_004201_007477_1305"),
+]
+
+# Bytes written for each fake product
+SIZE = 100
+
+
+class TestPrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.lock = threading.Lock()
+        self.fetched = []
+        self.released = []
+        # consecutive pairs share a product, like the output of pair_products
+        self.pairs = list(zip(PRODUCTS, PRODUCTS[1:]))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _path(self, product):
+        return os.path.join(self.directory.name, f"{product.product_name}.zip")
+
+    def _fetch(self, product):
+        with open(self._path(product), "wb") as f:
+            f.write(b"0" * SIZE)
+        with self.lock:
+            self.fetched.append(product.product_name)
+
+    def _release(self, product):
+        os.remove(self._path(product))
+        self.released.append(product.product_name)
+
+    def _wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def _prefetcher(self, **kwargs):
+        return Prefetcher(self.pairs, self._fetch, self._path, on_release=self._release, **kwargs)
+
+    def test_shared_products_fetched_once(self):
+        prefetcher = self._prefetcher(depth=1)
+        for pair, error in prefetcher:
+            self.assertIsNone(error)
+            self.assertTrue(all(os.path.exists(self._path(p)) for p in pair))
+            prefetcher.release(pair)
+
+        names = [p.product_name for p in PRODUCTS]
+        self.assertEqual(names, self.fetched)
+        self.assertEqual(names, self.released)
+
+    def test_release_waits_for_last_pair(self):
+        prefetcher = self._prefetcher(depth=1)
+        pairs = iter(prefetcher)
+
+        first, _ = next(pairs)
+        prefetcher.release(first)
+        # the second product is still needed by the next pair
+        self.assertEqual([PRODUCTS[0].product_name], self.released)
+
+    def test_prefetches_next_pair_while_processing(self):
+        prefetcher = self._prefetcher(depth=1)
+        pairs = iter(prefetcher)
+
+        next(pairs)
+        self._wait_for(lambda: len(self.fetched) == 3)
+        time.sleep(0.1)
+        # the next pair is downloaded but not the one after it
+        self.assertEqual([p.product_name for p in PRODUCTS[:3]], self.fetched)
+
+    def test_budget_limits_prefetch(self):
+        prefetcher = self._prefetcher(depth=5, budget=2 * SIZE + SIZE // 2)
+        pairs = iter(prefetcher)
+
+        first, _ = next(pairs)
+        time.sleep(0.1)
+        # the third product does not fit until the first has been released
+        self.assertEqual([p.product_name for p in PRODUCTS[:2]], self.fetched)
+
+        prefetcher.release(first)
+        self._wait_for(lambda: len(self.fetched) == 3)
+        self.assertEqual(PRODUCTS[2].product_name, self.fetched[2])
+        self.assertLessEqual(prefetcher.used(), 2 * SIZE + SIZE // 2)
+
+    def test_pairs_taken_lazily(self):
+        """
+        Pairs claimed from a job queue should only be taken as they are needed.
+        """
+        taken = []
+
+        def claim():
+            for pair in self.pairs:
+                taken.append(pair)
+                yield pair
+
+        prefetcher = Prefetcher(claim(), self._fetch, self._path, depth=1, on_release=self._release)
+        pairs = iter(prefetcher)
+        first, _ = next(pairs)
+        time.sleep(0.1)
+        self.assertEqual(2, len(taken))
+
+        prefetcher.release(first)
+        remaining = []
+        for pair, _ in pairs:
+            remaining.append(pair)
+            prefetcher.release(pair)
+        self.assertEqual(self.pairs[1:], remaining)
+
+    def test_fetch_error_is_returned_with_pair(self):
+        def fetch(product):
+            if product is PRODUCTS[2]:
+                raise IOError("download failed")
+            self._fetch(product)
+
+        prefetcher = Prefetcher(self.pairs, fetch, self._path, depth=1)
+        errors = []
+        for pair, error in prefetcher:
+            errors.append(error)
+            prefetcher.release(pair)
+
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], IOError)
+        self.assertIsInstance(errors[2], IOError)
+
+    def test_pair_with_invalid_product_is_not_downloaded(self):
+        checked = []
+
+        def skip(pair):
+            # the second product is found to be invalid once it has been downloaded
+            if PRODUCTS[1].product_name in checked and PRODUCTS[1] in pair:
+                return "invalid"
+            return None
+
+        prefetcher = Prefetcher(self.pairs, self._fetch, self._path, depth=2, on_release=self._release,
+                                on_fetched=lambda p: checked.append(p.product_name), skip=skip)
+        errors = []
+        for pair, error in prefetcher:
+            errors.append(error)
+            prefetcher.release(pair)
+
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], SkippedPair)
+        self.assertIsNone(errors[2])
+        self.assertEqual([p.product_name for p in PRODUCTS], checked)
+        # the third product was only downloaded for the last pair
+        self.assertEqual([p.product_name for p in PRODUCTS], self.fetched)
+        self.assertEqual(sorted(p.product_name for p in PRODUCTS), sorted(self.released))
+
+    def test_skipped_before_anything_is_downloaded(self):
+        prefetcher = Prefetcher(self.pairs[:2], self._fetch, self._path, depth=1,
+                                skip=lambda pair: "invalid" if PRODUCTS[2] in pair else None)
+        errors = []
+        for pair, error in prefetcher:
+            errors.append(error)
+            prefetcher.release(pair)
+
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], SkippedPair)
+        self.assertEqual([p.product_name for p in PRODUCTS[:2]], self.fetched)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -23,6 +23,14 @@ class TestProductName(unittest.TestCase):
             expected
         )
 
+    def test_timestamps_cached(self):
+        product = product_name.S1Product("S1B_IW_SLC__1SDV_20170502T231339_20170502T231407_005426_009835_C052")
+        self.assertIs(product.start_timestamp(), product.start_timestamp())
+        self.assertIs(product.stop_timestamp(), product.stop_timestamp())
+        # no per instance dictionary
+        with self.assertRaises(AttributeError):
+            product.extra = 1
+
 
 def test_empty(self):
     expected = product_name.S1Product("")
@@ -0,0 +1,319 @@
+import gzip
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import botocore.exceptions
+
+from s1_ard_pypeline.utils import compression, s3_utils
+
+
+class FakeS3Client:
+    """
+    Keeps multipart uploads in memory, so several can be in progress at once
+    """
+
+    def __init__(self, fail_part=None):
+        self.lock = threading.Lock()
+        self.parts = {}
+        self.objects = {}
+        self.aborted = []
+        self.fail_part = fail_part
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {"UploadId": "upload-1"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_part:
+            raise IOError("part failed")
+        with self.lock:
+            self.parts[(Key, PartNumber)] = Body
+        return {"ETag": f"etag-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+        self.objects[Key] = b"".join(self.parts[(Key, number)] for number in numbers)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(Key)
+
+
+class FakePaginator:
+
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket, Prefix):
+        keys = sorted(k for k in self.client.sizes if k.startswith(Prefix))
+        for start in range(0, max(len(keys), 1), self.client.page_size):
+            self.client.list_calls += 1
+            page = keys[start:start + self.client.page_size]
+            yield {"KeyCount": len(page), "Contents": [{"Key": k, "Size": self.client.sizes[k]} for k in page]}
+
+
+class FakeListingClient:
+    """
+    Answers listings a page at a time and HEAD requests, counting the requests made
+    """
+
+    def __init__(self, keys, page_size=1000):
+        self.sizes = dict((key, 10) for key in keys)
+        self.page_size = page_size
+        self.list_calls = 0
+        self.head_calls = 0
+
+    def get_paginator(self, operation):
+        return FakePaginator(self)
+
+    def head_object(self, Bucket, Key):
+        self.head_calls += 1
+        if Key not in self.sizes:
+            raise botocore.exceptions.ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        return {"ContentLength": self.sizes[Key]}
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeListingClient([f"download/file_{i}.zip" for i in range(2500)] + ["other/file.zip"])
+
+    def test_one_listing_for_many_checks(self):
+        manifest = s3_utils.Manifest(self.client, "bucket", "download/")
+        found = [f"download/file_{i}.zip" in manifest for i in range(3000)]
+
+        self.assertEqual([True] * 2500 + [False] * 500, found)
+        self.assertNotIn("other/file.zip", manifest)
+        # one listing of three pages
+        self.assertEqual(3, self.client.list_calls)
+        self.assertEqual(2500, len(manifest))
+
+    def test_added_keys(self):
+        manifest = s3_utils.Manifest(self.client, "bucket", "download/")
+        self.assertNotIn("download/new.zip", manifest)
+        manifest.add("download/new.zip", 5)
+        self.assertIn("download/new.zip", manifest)
+        self.assertEqual(5, manifest.size("download/new.zip"))
+
+    def test_listed_again_after_ttl(self):
+        manifest = s3_utils.Manifest(self.client, "bucket", "download/", ttl=0.1)
+        self.assertNotIn("download/late.zip", manifest)
+        self.client.sizes["download/late.zip"] = 10
+        self.assertNotIn("download/late.zip", manifest)
+
+        time.sleep(0.2)
+        self.assertIn("download/late.zip", manifest)
+        self.assertEqual(6, self.client.list_calls)
+
+    def test_keys_added_during_a_listing_are_kept(self):
+        manifest = s3_utils.Manifest(self.client, "bucket", "download/")
+        paginate = FakePaginator.paginate
+
+        def add_between_pages(paginator, Bucket, Prefix):
+            for number, page in enumerate(paginate(paginator, Bucket, Prefix)):
+                if number == 1:
+                    # an upload finishing while the listing is part way through, too late to be in it
+                    manifest.add("download/uploaded.zip", 7)
+                yield page
+
+        with mock.patch.object(FakePaginator, "paginate", add_between_pages):
+            manifest.refresh()
+        self.assertEqual(7, manifest.size("download/uploaded.zip"))
+        self.assertEqual(2501, len(manifest))
+
+
+class TestS3Utils(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeListingClient([f"download/file_{i}.zip" for i in range(2500)], page_size=1000)
+        self.s3 = s3_utils.S3Utils()
+        self.s3.client = self.client
+
+    def test_exists(self):
+        self.assertTrue(self.s3.exists("download/file_1.zip"))
+        self.assertFalse(self.s3.exists("download/file_1"))
+        self.assertEqual(2, self.client.head_calls)
+        self.assertEqual(0, self.client.list_calls)
+
+    def test_count(self):
+        self.assertEqual(2500, self.s3.count())
+        self.assertEqual(3, self.client.list_calls)
+
+    def test_manifest_is_shared(self):
+        self.assertIs(self.s3.manifest("download/"), self.s3.manifest("download/"))
+
+
+class FakeTransferClient:
+    """
+    Stands in for S3 when moving whole files. Each transfer takes a fixed time, as if it were limited by the network
+    """
+
+    def __init__(self, seconds=0.1, fail=()):
+        self.seconds = seconds
+        self.fail = fail
+        self.objects = {}
+        self.configs = []
+        self.lock = threading.Lock()
+
+    def head_object(self, Bucket, Key):
+        return {"ContentLength": len(self.objects[Key])}
+
+    def upload_file(self, Filename, Bucket, Key, Config=None):
+        if Key in self.fail:
+            raise IOError(f"could not upload {Key}")
+        time.sleep(self.seconds)
+        with open(Filename, "rb") as f, self.lock:
+            self.objects[Key] = f.read()
+            self.configs.append(Config)
+
+    def download_file(self, Bucket, Key, Filename, Config=None):
+        time.sleep(self.seconds)
+        with open(Filename, "wb") as f:
+            f.write(self.objects[Key])
+
+
+class TestTransfers(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.client = FakeTransferClient()
+        self.s3 = s3_utils.S3Utils()
+        self.s3.s3_client = self.client
+        self.s3.client = FakeListingClient([])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _files(self, count):
+        files = []
+        for i in range(count):
+            name = os.path.join(self.directory.name, f"file_{i}")
+            with open(name, "wb") as f:
+                f.write(bytes([i]) * 1000)
+            files.append(name)
+        return files
+
+    def test_transfer_config(self):
+        mb = 1024 ** 2
+        product = s3_utils.transfer_config(1900 * mb)
+        self.assertEqual(s3_utils.MULTIPART_THRESHOLD, product.multipart_threshold)
+        self.assertEqual(64 * mb, product.multipart_chunksize)
+        self.assertEqual(s3_utils.DEFAULT_CONCURRENCY, product.max_concurrency)
+
+        self.assertEqual(128 * mb, s3_utils.transfer_config(10 * 1024 * mb).multipart_chunksize)
+        # never more parts than S3 allows
+        huge = 4 * 1024 ** 4
+        self.assertLessEqual(huge / s3_utils.transfer_config(huge).multipart_chunksize, s3_utils.MAX_PARTS)
+        # no more connections than parts
+        self.assertEqual(2, s3_utils.transfer_config(100 * mb).max_concurrency)
+
+    def test_concurrency_follows_throughput(self):
+        size = 10 * 1024 ** 3
+        slow = s3_utils.transfer_config(size, throughput=s3_utils.STREAM_THROUGHPUT)
+        fast = s3_utils.transfer_config(size, throughput=20 * s3_utils.STREAM_THROUGHPUT)
+        very_fast = s3_utils.transfer_config(size, throughput=1000 * s3_utils.STREAM_THROUGHPUT)
+
+        self.assertEqual(s3_utils.MIN_CONCURRENCY, slow.max_concurrency)
+        self.assertEqual(s3_utils.MAX_CONCURRENCY, fast.max_concurrency)
+        self.assertEqual(s3_utils.MAX_CONCURRENCY, very_fast.max_concurrency)
+
+    def test_stats(self):
+        stats = s3_utils.TransferStats(smoothing=0.5)
+        stats.record(1000, 1)
+        self.assertIsNone(stats.throughput())
+
+        size = s3_utils.MULTIPART_THRESHOLD
+        stats.record(size, 1)
+        stats.record(size, 0.5)
+        self.assertEqual(1.5 * size, stats.throughput())
+
+    def test_put_files_concurrently(self):
+        files = self._files(8)
+        manifest = self.s3.manifest("out/")
+        self.assertNotIn("out/file_0", manifest)
+        start = time.perf_counter()
+        errors = self.s3.put_files([(f, f"out/{os.path.basename(f)}") for f in files], concurrency=8)
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual([None] * 8, errors)
+        self.assertEqual(8, len(self.client.objects))
+        self.assertIn("out/file_0", manifest)
+        # one at a time would take 8 * 0.1 seconds
+        self.assertLess(elapsed, 0.4)
+        self.assertEqual(8, self.s3.stats.transfers)
+
+    def test_fetch_files(self):
+        files = self._files(3)
+        self.s3.put_files([(f, os.path.basename(f)) for f in files])
+        targets = [(os.path.basename(f), f + ".fetched") for f in files]
+
+        self.assertEqual([None] * 3, self.s3.fetch_files(targets))
+        for f in files:
+            with open(f, "rb") as a, open(f + ".fetched", "rb") as b:
+                self.assertEqual(a.read(), b.read())
+
+    def test_failed_file_does_not_stop_the_others(self):
+        self.client.fail = ["file_1"]
+        errors = self.s3.put_files([(f, os.path.basename(f)) for f in self._files(3)])
+
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], IOError)
+        self.assertIsNone(errors[2])
+
+
+class TestMultipartUpload(unittest.TestCase):
+
+    def test_parts(self):
+        client = FakeS3Client()
+        data = bytes(range(256)) * 50000
+        with s3_utils.MultipartUpload(client, "bucket", "key", part_size=s3_utils.MIN_PART_SIZE) as upload:
+            for i in range(0, len(data), 100000):
+                upload.write(data[i:i + 100000])
+
+        self.assertEqual(data, client.objects["key"])
+        self.assertEqual(3, len(client.parts))
+        self.assertEqual(s3_utils.MIN_PART_SIZE, len(client.parts[("key", 1)]))
+
+    def test_empty(self):
+        client = FakeS3Client()
+        with s3_utils.MultipartUpload(client, "bucket", "key"):
+            pass
+        self.assertEqual(b"", client.objects["key"])
+
+    def test_abort_on_error(self):
+        client = FakeS3Client()
+        with self.assertRaises(ValueError):
+            with s3_utils.MultipartUpload(client, "bucket", "key") as upload:
+                upload.write(b"some data")
+                raise ValueError("boom")
+        self.assertEqual(["key"], client.aborted)
+        self.assertNotIn("key", client.objects)
+
+    def test_failed_part(self):
+        client = FakeS3Client(fail_part=2)
+        with self.assertRaises(IOError):
+            with s3_utils.MultipartUpload(client, "bucket", "key", part_size=s3_utils.MIN_PART_SIZE) as upload:
+                upload.write(b"x" * (3 * s3_utils.MIN_PART_SIZE))
+        self.assertNotIn("key", client.objects)
+        self.assertEqual(["key"], client.aborted)
+
+    def test_on_complete(self):
+        client = FakeS3Client()
+        completed = []
+        with s3_utils.MultipartUpload(client, "bucket", "key", on_complete=lambda *a: completed.append(a)) as upload:
+            upload.write(b"data")
+        self.assertEqual([("key", 4)], completed)
+
+    def test_gzip_stream_to_upload(self):
+        client = FakeS3Client()
+        data = b"some result data " * 1000000
+        with s3_utils.MultipartUpload(client, "bucket", "result.tif.gz", part_size=s3_utils.MIN_PART_SIZE) as upload:
+            compression.gzip_stream(io.BytesIO(data), upload, threads=2, block_size=1024 * 1024)
+        self.assertEqual(data, gzip.decompress(client.objects["result.tif.gz"]))
+
+
+if __name__ == "__main__":
+    unittest.main()